@@ -1,13 +1,20 @@
 #!/usr/bin/python
 # -*- coding: latin-1 -*-
-from astropy.io import fits, ascii
+from astropy.io import fits
 from shutil import copyfile
 from glob import glob
 from pkg_resources import resource_filename
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import astropy.constants as ac
 import astropy.units as q
 import numpy as np
 import os
+import h5py
+from . import utils
+from .modelgrid import CACHE_VERSION
+
+# The factor to convert [erg/cm2/s/hz/ster]*c to [erg/s/cm2/cm]
+ATLAS9_UNITS = (ac.c*q.erg/q.cm**4/q.s/q.Hz).to(q.erg/q.s/q.cm**3).value
 
 def external_files():
     """
@@ -25,6 +32,173 @@ def external_files():
 
     return metadata.get('external_files')
 
+def ATLAS9_blocks(filepath):
+    """
+    Read an ATLAS9 file one (Teff, log(g), Fe/H) block at a time,
+    so that the whole file is never in memory
+
+    Parameters
+    ----------
+    filepath: str
+        The path to the ATLAS9 file
+
+    Yields
+    ------
+    list
+        The lines of the block, starting with the TEFF header line
+    """
+    block = []
+    with open(filepath, encoding='utf-8') as f:
+        for l in f:
+            if l.startswith('TEFF'):
+                if block:
+                    yield block[:-4]
+                block = []
+            if block or l.startswith('TEFF'):
+                block.append(l)
+
+    # The last block ends one line earlier
+    if block:
+        yield block[:-5]
+
+
+def parse_ATLAS9(block):
+    """
+    Parse a block of an ATLAS9 file, converting the fixed width
+    columns with NumPy rather than line by line
+
+    Parameters
+    ----------
+    block: list
+        The lines of the block, starting with the TEFF header line
+
+    Returns
+    -------
+    dict
+        The parameters of the model, the mu values, the wavelength [A]
+        and the (mu, wavelength) flux array [erg/s/cm2/cm]
+    """
+    # Get the parameters
+    h = block[0].strip().split()
+    model = {'Teff': int(h[1].split('.')[0]), 'logg': float(h[3][:3]),
+             'FeH': float(h[6].replace('[', '').replace(']', '')),
+             'vturb': float(h[8]), 'xlen': float(h[11])}
+
+    # Get the mu values from the column names
+    cols = block[2].strip().split()
+    n_cols = len(cols)+1
+
+    # Make a character array of the rows, with the wavelength and
+    # I(mu=1) in the first 19 characters and 6 per column after that
+    width = 19+6*(n_cols-2)
+    rows = [l.rstrip('\r\n').ljust(width)[:width] for l in block[3:]]
+    chars = np.frombuffer(''.join(rows).encode('latin-1'), dtype='S1')
+    chars = chars.reshape(len(rows), width)
+
+    # Put a space before each 6 character column and parse them all at once
+    spaced = np.full((len(rows), n_cols-2, 7), b' ', dtype='S1')
+    spaced[:, :, 1:] = chars[:, 19:].reshape(len(rows), n_cols-2, 6)
+    text = np.hstack([chars[:, :19], spaced.reshape(len(rows), -1),
+                      np.full((len(rows), 1), b' ', dtype='S1')])
+    data = np.fromstring(text.tobytes(), sep=' ')
+    if data.size != len(rows)*n_cols:
+        raise ValueError('Could not parse the block for Teff={Teff}, '
+                         'logg={logg}, FeH={FeH}'.format(**model))
+    data = data.reshape(len(rows), n_cols)
+
+    # Put intensity array for increasing mu values in a cube
+    flux = data[:, 1:].T[::-1].copy()
+
+    # Scale the flux values by the flux(mu=1) value
+    flux[:-1] *= flux[-1]
+    flux[-1] *= 1E5
+
+    # Get the wavelength and convert from nm to A
+    wave = data[:, 0]*q.nm.to(q.AA)
+
+    # Convert the flux from [erg/cm2/s/hz/ster] to [erg/s/cm2/cm]
+    # by multiplying by c/lambda**2
+    flux *= ATLAS9_UNITS/wave**2*1E16
+
+    model['mu'] = np.array(list(map(float, cols))[::-1])
+    model['wave'] = wave
+    model['flux'] = flux
+
+    return model
+
+
+def ATLAS9_filename(model):
+    """
+    The name of the FITS file of a parsed ATLAS9 model
+
+    Parameters
+    ----------
+    model: dict
+        The parsed model
+
+    Returns
+    -------
+    str
+        The filename
+    """
+    logg_txt = str(abs(int(model['logg']*10.))).zfill(2)
+    feh_txt = '{}{}'.format('m' if model['FeH'] < 0 else 'p',
+                            str(abs(int(model['FeH']*10.))).zfill(2))
+
+    return 'ATLAS9_{}_{}_{}.fits'.format(model['Teff'], logg_txt, feh_txt)
+
+
+def write_ATLAS9(model, destination='', template=resource_filename('ExoCTK', 'data/core/ModelGrid_tmp.fits')):
+    """
+    Write a parsed ATLAS9 model to a FITS file like the PHOENIX models
+
+    Parameters
+    ----------
+    model: dict
+        The parsed model
+    destination: str
+        The destination for the file
+    template: str
+        The path to the FITS template file to use
+    """
+    # Copy the old HDU list
+    new_file = destination+ATLAS9_filename(model)
+    if template and os.path.isfile(template):
+        HDU = fits.open(template)
+    else:
+        HDU = fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU()])
+
+    # Write the new data
+    HDU[0].data = model['flux']
+    HDU[1].data = model['mu']
+
+    # Write the new key/values
+    HDU[0].header['PHXTEFF'] = model['Teff']
+    HDU[0].header['PHXLOGG'] = model['logg']
+    HDU[0].header['PHXM_H'] = model['FeH']
+    HDU[0].header['PHXXI_L'] = model['vturb']
+    HDU[0].header['PHXXI_M'] = model['vturb']
+    HDU[0].header['PHXXI_N'] = model['vturb']
+    HDU[0].header['PHXEOS'] = 'ATLAS9'
+    HDU[0].header['PHXMXLEN'] = model['xlen']
+    HDU[0].header['PHXREFF'] = '-'
+    HDU[0].header['PHXBUILD'] = '-'
+    HDU[0].header['PHXVER'] = '-'
+    HDU[0].header['DATE'] = '-'
+    HDU[0].header['PHXMASS'] = '-'
+    HDU[0].header['PHXLUM'] = '-'
+    HDU[0].header['CRVAL1'] = '-'
+    HDU[0].header['CDELT1'] = '-'
+
+    # Create a WAVELENGTH extension
+    HDU.append(fits.ImageHDU(model['wave'], name='WAVELENGTH'))
+
+    # Write the new file
+    fits.HDUList(HDU).writeto(new_file, overwrite=True)
+
+    HDU.close()
+
+
 def convert_ATLAS9(filepath, destination='', template=resource_filename('ExoCTK', 'data/core/ModelGrid_tmp.fits')):
     """
     Split ATLAS9 FITS files into separate files containing one Teff, log(g), and Fe/H
@@ -35,113 +209,195 @@ def convert_ATLAS9(filepath, destination='', template=resource_filename('ExoCTK'
     ----------
     filepath: str
         The path to the ATLAS9 FITS file to convert
-    feh: float
-        The metallicity for the grid
     destination: str
         The destination for the split files
     template: str
         The path to the FITS template file to use
-    """        
-    # Get all the data
-    L = open(filepath, encoding='utf-8').readlines()
-    
-    # Get the indexes of each log(g) chunk
-    start = []
-    for idx,l in enumerate(L):
-        if l.startswith('TEFF'):
-            start.append(idx)
-            
-    # Break up into chunks
-    for n,idx in enumerate(start):
-        
+    """
+    # Convert one chunk at a time
+    for block in ATLAS9_blocks(filepath):
+
         try:
-        
-            # Get the parameters
-            h = L[idx].strip().split()
-            teff = int(h[1].split('.')[0])
-            logg = float(h[3][:3])
-            vturb = float(h[8])
-            xlen = float(h[11])
-            feh = float(h[6].replace('[','').replace(']',''))
-            
-            # Parse the data
-            try:
-                end = start[n+1]
-            except:
-                end = -1
-            data = L[idx+3:end-4]
-            
-            # Fix column spacing
-            for n,l in enumerate(data):
-                data[n] = l[:19]+' '+' '.join([l[idx:idx+6] for idx in np.arange(19,len(l),6)])
-                
-            # Get cols and data
-            cols = ['wl']+L[idx+2].strip().split()
-            data = ascii.read(data, names=cols)
-            
-            # Put intensity array for increasing mu values in a cube
-            data_cube = np.array([data[cols][n] for n in cols[1:]])[::-1]
-            
-            # Scale the flux values by the flux(mu=1) value
-            data_cube[:-1] *= data_cube[-1]
-            data_cube[-1] *= 1E5
-            
-            # Apply units
-            data_cube = data_cube*q.erg/q.cm**2/q.s/q.steradian/q.Hz
-            
-            # mu values
-            mu = list(map(float,cols[1:]))[::-1]
-            
-            # Get the wavelength and convert from nm to A
-            wave = np.array(data['wl'])*q.nm.to(q.AA)
-            
-            # Convert the flux from [erg/cm2/s/hz/ster] to [erg*m/cm**2/Hz/s**2/sr]
-            # by multiplying by c/lambda**2
-            data_cube = data_cube*ac.c/(wave**2)
-            
-            # Convert [m/sr] to [cm-1]
-            data_cube = data_cube*q.steradian/q.cm**2
-            
-            # Convert to [erg/s/cm2/cm]
-            data_cube = data_cube.to(q.erg/q.s/q.cm**3)*1E16
-            
-            # Copy the old HDU list
-            logg_txt = str(abs(int(logg*10.))).zfill(2)
-            feh_txt = '{}{}'.format('m' if feh<0 else 'p', str(abs(int(feh*10.))).zfill(2))
-            new_file = destination+'ATLAS9_{}_{}_{}.fits'.format(teff,logg_txt,feh_txt)
-            HDU = fits.open(template)
-            
-            # Write the new data
-            HDU[0].data = data_cube.value
-            HDU[1].data = mu
-            
-            # Write the new key/values
-            HDU[0].header['PHXTEFF'] = teff
-            HDU[0].header['PHXLOGG'] = logg
-            HDU[0].header['PHXM_H'] = feh
-            HDU[0].header['PHXXI_L'] = vturb
-            HDU[0].header['PHXXI_M'] = vturb
-            HDU[0].header['PHXXI_N'] = vturb
-            HDU[0].header['PHXEOS'] = 'ATLAS9'
-            HDU[0].header['PHXMXLEN'] = xlen
-            HDU[0].header['PHXREFF'] = '-'
-            HDU[0].header['PHXBUILD'] = '-'
-            HDU[0].header['PHXVER'] = '-'
-            HDU[0].header['DATE'] = '-'
-            HDU[0].header['PHXMASS'] = '-'
-            HDU[0].header['PHXLUM'] = '-'
-            HDU[0].header['CRVAL1'] = '-'
-            HDU[0].header['CDELT1'] = '-'
-            
-            # Create a WAVELENGTH extension
-            ext = fits.ImageHDU(wave)
-            ext.update_ext_name('WAVELENGTH')
-            HDU.append(ext)
-            
-            # Write the new file
-            fits.HDUList(HDU).writeto(new_file, clobber=True)
-            
-            HDU.close()
-            
-        except:
-            pass
+            write_ATLAS9(parse_ATLAS9(block), destination, template)
+
+        except (ValueError, IndexError, IOError) as err:
+            print('Could not convert block', block[0].strip(), ':', err)
+
+
+def convert_ATLAS9_cube(filepaths, cube_file, fits_dir='', template=resource_filename('ExoCTK', 'data/core/ModelGrid_tmp.fits'), workers=1, precision='float64', compression=None):
+    """
+    Convert ATLAS9 files straight into the HDF5 flux cube format of
+    modelgrid.ModelGrid, parsing the blocks in parallel and writing each
+    model as it arrives. The cube file can be given to ModelGrid in
+    place of a directory of model files.
+
+    Parameters
+    ----------
+    filepaths: str, list
+        The path(s) to the ATLAS9 files to convert
+    cube_file: str
+        The path to the HDF5 file to write
+    fits_dir: str (optional)
+        The destination for FITS files of the models, if any
+    template: str
+        The path to the FITS template file to use
+    workers: int
+        The maximum number of blocks to parse concurrently
+    precision: str
+        The storage type of the flux cube, as in ModelGrid
+    compression: str (optional)
+        The HDF5 compression filter of the flux cube, as in ModelGrid
+    """
+    if isinstance(filepaths, str):
+        filepaths = [filepaths]
+
+    # Get the parameter axes from the header lines
+    params = []
+    for filepath in filepaths:
+        with open(filepath, encoding='utf-8') as f:
+            for l in f:
+                if l.startswith('TEFF'):
+                    h = l.strip().split()
+                    params.append((int(h[1].split('.')[0]), float(h[3][:3]),
+                                   float(h[6].replace('[', '').replace(']', ''))))
+    if not params:
+        raise IOError('No models found in {}'.format(filepaths))
+    T, G, M = [np.unique(p) for p in zip(*params)]
+
+    def blocks():
+        for filepath in filepaths:
+            for block in ATLAS9_blocks(filepath):
+                yield block
+
+    # Write the cube to a partial file, removing it if anything goes wrong
+    part_file = cube_file+'.part'
+    try:
+        with h5py.File(part_file, "w") as f:
+            n_models = _write_ATLAS9_cube(f, blocks(), (T, G, M), fits_dir,
+                                          template, workers, precision,
+                                          compression)
+    except BaseException:
+        if os.path.isfile(part_file):
+            os.remove(part_file)
+        raise
+
+    os.replace(part_file, cube_file)
+    print(n_models, 'models written to', cube_file)
+
+
+def _write_ATLAS9_cube(f, blocks, axes, fits_dir, template, workers,
+                       precision, compression):
+    """
+    Parse ATLAS9 blocks in parallel and write each model to an open
+    HDF5 file in the flux cache format of modelgrid.ModelGrid
+
+    Parameters
+    ----------
+    f: h5py.File
+        The open file
+    blocks: iterable
+        The blocks of lines from ATLAS9_blocks
+    axes: tuple
+        The Teff, logg and FeH values of the grid
+    fits_dir: str
+        The destination for FITS files of the models, if any
+    template: str
+        The path to the FITS template file to use
+    workers: int
+        The maximum number of blocks to parse concurrently
+    precision: str
+        The storage type of the flux cube
+    compression: str
+        The HDF5 compression filter of the flux cube
+
+    Returns
+    -------
+    int
+        The number of models written
+    """
+    T, G, M = axes
+    shp = (len(T), len(G), len(M))
+    dtype = np.dtype(precision)
+
+    def convert(block):
+        model = parse_ATLAS9(block)
+        if fits_dir:
+            write_ATLAS9(model, fits_dir, template)
+        return model
+
+    # Parse the blocks with a bounded number in flight
+    rows, W = [], None
+    workers = max(1, workers)
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        while True:
+            for block in blocks:
+                pending.add(ex.submit(convert, block))
+                if len(pending) >= 2*workers:
+                    break
+            if not pending:
+                break
+
+            # Write each model straight to the cube
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                model = fut.result()
+
+                # Convert the wavelength to um and trim it like ModelGrid
+                wave = model['wave']*q.AA.to(q.um)
+                if W is None:
+                    W = slice(wave.searchsorted(0),
+                              wave.searchsorted(40, side='right'))
+                    wavelength = wave[W]
+                    cube_shp = shp+(len(model['mu']), len(wavelength))
+                    f.create_dataset('flux', shape=cube_shp, dtype=dtype,
+                                     chunks=utils.flux_chunks(
+                                         cube_shp, itemsize=dtype.itemsize),
+                                     compression=compression,
+                                     shuffle=bool(compression))
+                    if dtype in utils.SCALED_TYPES:
+                        f.create_dataset('scale', shape=cube_shp[:-1],
+                                         dtype=np.float32)
+                    f.create_dataset('mu', shape=cube_shp[:-1], dtype=float)
+                    f.create_dataset('r_eff', data=np.full(shp, np.nan))
+                    f.create_dataset('done', shape=shp, dtype=bool)
+                    f.create_dataset('wavelength', data=wavelength)
+
+                # The models must share one wavelength axis
+                if not np.array_equal(wave[W], wavelength):
+                    raise ValueError('The wavelengths of {} differ from '
+                                     'those of the other models.'
+                                     .format(ATLAS9_filename(model)))
+
+                point = (T.searchsorted(model['Teff']),
+                         G.searchsorted(model['logg']),
+                         M.searchsorted(model['FeH']))
+                flux, scale = utils.encode_flux(model['flux'][:, W], dtype)
+                f['flux'][point] = flux
+                if scale is not None:
+                    f['scale'][point] = scale
+                f['mu'][point] = model['mu']
+                f['done'][point] = True
+                rows.append((model['Teff'], model['logg'], model['FeH'],
+                             model['vturb'], model['xlen'],
+                             ATLAS9_filename(model)))
+
+    if not rows:
+        raise IOError('No models could be read.')
+
+    # Store the table of models with the PHOENIX header keys
+    rows.sort()
+    f.create_dataset('models', data=np.array(rows, dtype=[
+        ('PHXTEFF', int), ('PHXLOGG', float), ('PHXM_H', float),
+        ('PHXXI_L', float), ('PHXMXLEN', float), ('filename', 'S64')]))
+
+    # Store the axes and the settings ModelGrid checks
+    for name, vals in zip(['Teff_vals', 'logg_vals', 'FeH_vals'], axes):
+        f.create_dataset(name, data=vals)
+    meta = {'version': CACHE_VERSION, 'wave_rng': np.array([0., 40.]),
+            'resolution': '', 'wl_units': str(q.um),
+            'precision': dtype.name}
+    for key, val in meta.items():
+        f.attrs[key] = val
+
+    return len(rows)
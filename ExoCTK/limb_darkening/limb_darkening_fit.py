@@ -106,6 +106,43 @@ def ld_profile(name='quadratic', latex=False):
         return
 
 
+def mean_intensity(model_grid, Teff, logg, FeH):
+    """
+    Average the intensity of the interpolated spectrum over wavelength
+    one block at a time, so that the whole spectrum is never in memory
+
+    Parameters
+    ----------
+    model_grid: modelgrid.ModelGrid object
+        The grid of synthetic spectra
+    Teff: int
+        The effective temperature of the model
+    logg: float
+        The logarithm of the surface gravity
+    FeH: float
+        The logarithm of the metallicity
+
+    Returns
+    -------
+    dict
+        The grid point with the mean intensity at each mu value
+        as the (mu, 1) flux array and the wavelength array
+    """
+    total = count = 0
+    try:
+        for block in model_grid.stream(Teff, logg, FeH):
+            total = total + np.nansum(block['flux'], axis=-1)
+            count = count + np.sum(~np.isnan(block['flux']), axis=-1)
+    except (ValueError, IOError):
+        return
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        block['flux'] = (total / count)[:, None]
+    block['wave'] = model_grid.wavelength
+
+    return block
+
+
 def ldc(Teff, logg, FeH, model_grid, profiles, mu_min=0.05, ld_min=1E-6,
         bandpass='', grid_point='', plot=False, save=False, **kwargs):
     """
@@ -162,9 +199,13 @@ def ldc(Teff, logg, FeH, model_grid, profiles, mu_min=0.05, ld_min=1E-6,
     model_grid = modelgrid.ModelGrid(fits_files, resolution=700)
     results = lf.ldc(4500, 5.0, 0.0, model_grid, ['quadratic','linear'])
     """
-    # Get the model, interpolating if necessary
+    # Get the model, interpolating if necessary, or average it over
+    # wavelength in blocks if the grid has a memory limit
     if not grid_point:
-        grid_point = model_grid.get(Teff, logg, FeH)
+        if model_grid.max_memory and not isinstance(bandpass, svo.Filter):
+            grid_point = mean_intensity(model_grid, Teff, logg, FeH)
+        else:
+            grid_point = model_grid.get(Teff, logg, FeH)
 
     # If the model exists, continue
     if grid_point:
@@ -215,6 +256,7 @@ def ldc(Teff, logg, FeH, model_grid, profiles, mu_min=0.05, ld_min=1E-6,
         muz = np.interp(ld_min, ld_avg, mu) if any(ld_avg < ld_min) else 0
         mu = (mu - muz) / (1 - muz)
         grid_point['scaled_mu'] = mu
+        grid_point['mu_zero'] = muz
         grid_point['ld_raw'] = ld
 
         # Trim to useful mu range
@@ -320,6 +362,58 @@ def ldc(Teff, logg, FeH, model_grid, profiles, mu_min=0.05, ld_min=1E-6,
         return
 
 
+def compare_ldcs(reference, model_grid, Teff, logg, FeH,
+                 profile='quadratic', **kwargs):
+    """
+    Compare the limb darkening coefficients calculated from a grid,
+    e.g. one stored in reduced precision, with those calculated from
+    a reference grid of the same models
+
+    Parameters
+    ----------
+    reference: modelgrid.ModelGrid object
+        The reference grid of synthetic spectra
+    model_grid: modelgrid.ModelGrid object
+        The grid of synthetic spectra to compare
+    Teff: array-like
+        The effective temperatures of the models
+    logg: array-like
+        The logarithms of the surface gravity
+    FeH: array-like
+        The logarithms of the metallicity
+    profile: str
+        The name of the limb darkening profile function to use
+
+    Returns
+    -------
+    astropy.table.Table
+        The largest absolute difference of each coefficient
+        over the wavelength bins at each point
+    """
+    # Get the coefficient names for the profile
+    n = len(inspect.signature(ld_profile(profile)).parameters) - 1
+    cols = ['c{}'.format(i + 1) for i in range(n)]
+
+    rows = []
+    for t, g, m in zip(*[np.atleast_1d(v) for v in [Teff, logg, FeH]]):
+
+        # Calculate the coefficients from both grids
+        results = [ldc(t, g, m, grid, profile, **kwargs)
+                   for grid in [reference, model_grid]]
+
+        if all(results):
+            ref, new = [r[profile]['coeffs'] for r in results]
+            diffs = [np.max(np.abs(np.asarray(new[c]) - np.asarray(ref[c])))
+                     for c in cols]
+        else:
+            diffs = [np.nan] * n
+
+        rows.append([t, g, m] + diffs)
+
+    return at.Table(rows=rows, names=['Teff', 'logg', 'FeH']
+                    + ['d' + c for c in cols])
+
+
 def ldc_grid(model_grid, profile, write_to='', mu_min=0.05,
              plot=False, **kwargs):
     """
@@ -350,14 +444,15 @@ def ldc_grid(model_grid, profile, write_to='', mu_min=0.05,
         radii calculated from the input modelgrid.ModelGrid
 
     """
-    # Get the arguments for the limb darkening profile
-    C = inspect.getargspec(ld_profile(profile)).args
+    # Get the coefficient names for the limb darkening profile
+    n = len(inspect.signature(ld_profile(profile)).parameters) - 1
+    cols = ['c{}'.format(i + 1) for i in range(n)]
 
     # Initialize limb darkening coefficient, mu, and effecive radius grids
     T = model_grid.Teff_vals
     G = model_grid.logg_vals
     M = model_grid.FeH_vals
-    coeff_grid = np.zeros((len(C) - 1, len(T), len(G), len(M)))
+    coeff_grid = np.zeros((n, len(T), len(G), len(M)))
     mu_grid = np.zeros((len(T), len(G), len(M)))
     r_grid = np.zeros((len(T), len(G), len(M)))
 
@@ -385,17 +480,20 @@ def ldc_grid(model_grid, profile, write_to='', mu_min=0.05,
         t, g, m = [f[p] for p in ['Teff', 'logg', 'FeH']]
 
         # Locate the grid position for this model
-        t_idx, g_idx, m_idx = [np.where(A == a)[0][0] for A, a in
-                               zip([T, G, M], [t, g, m])]
+        t_idx, g_idx, m_idx = [model_grid.positions[p][a] for p, a in
+                               zip(['Teff', 'logg', 'FeH'], [t, g, m])]
 
         # Fit limb darkening to get limb darkening coefficients (LDCs)
-        coeffs, muz, radius = ldc(t, g, m, model_grid, profile,
-                                  mu_min, plot=fig, **kwargs)
+        result = ldc(t, g, m, model_grid, profile, mu_min, plot=fig,
+                     **kwargs)
+        if not result:
+            continue
 
         # Add the coefficients, mu values and effective radius to grids
-        coeff_grid[:, t_idx, g_idx, m_idx] = coeffs
-        mu_grid[t_idx, g_idx, m_idx] = muz
-        r_grid[t_idx, g_idx, m_idx] = radius
+        coeffs = result[profile]['coeffs']
+        coeff_grid[:, t_idx, g_idx, m_idx] = [coeffs[c][0] for c in cols]
+        mu_grid[t_idx, g_idx, m_idx] = result['mu_zero']
+        r_grid[t_idx, g_idx, m_idx] = result['r_eff']
 
     # Write legend
     if plot and not isinstance(plot, plt.Figure):
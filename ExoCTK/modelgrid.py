@@ -4,16 +4,25 @@
 A module for creating and managing grids of model spectra
 """
 from glob import glob
+from itertools import product
 from astropy.io import fits
 from astropy.utils.exceptions import AstropyWarning
-from scipy.interpolate import RegularGridInterpolator
-from scipy.ndimage import zoom
-from functools import partial
-import multiprocessing
+from scipy.spatial import cKDTree
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    wait, FIRST_COMPLETED
 import astropy.table as at
 import astropy.units as q
-import pickle
+import copy
+import functools
+import hashlib
+import json
+import multiprocessing
+import shutil
+import tempfile
+import threading
 import warnings
+import weakref
 import numpy as np
 import os
 import time
@@ -22,6 +31,478 @@ from . import utils
 
 warnings.simplefilter('ignore', category=AstropyWarning)
 
+# The version of the HDF5 flux cache layout
+CACHE_VERSION = 2
+
+# The version of the stored triangulations
+TRIANGULATION_VERSION = 2
+
+# Memory-mapped flux arrays opened by each pool worker
+_shared_flux = {}
+
+# The arrays of a flux cache published to shared memory
+SHARED_ARRAYS = ['flux', 'scale', 'mu', 'r_eff', 'wavelength', 'Teff_vals',
+                 'logg_vals', 'FeH_vals']
+
+
+def _interp_chunk(filename, cell, weights, wave_slc, scale=None):
+    """
+    Interpolate a wavelength chunk of a memory-mapped flux cube
+    in a worker process
+
+    Parameters
+    ----------
+    filename: str
+        The path to the .npy file of the flux cube
+    cell: tuple
+        The slices of the bracketing cell along each grid axis
+    weights: np.ndarray
+        The corner weights of the cell
+    wave_slc: slice
+        The slice of the wavelength axis to interpolate
+    scale: np.ndarray (optional)
+        The scale factors of the cell of an encoded flux cube
+
+    Returns
+    -------
+    np.ndarray
+        The interpolated (mu, wavelength) chunk
+    """
+    # Open the memory map once per worker
+    if filename not in _shared_flux:
+        _shared_flux.clear()
+        _shared_flux[filename] = np.load(filename, mmap_mode='r')
+
+    slab = _shared_flux[filename][cell+(Ellipsis, wave_slc)]
+
+    return utils.interp_cell(slab, (slice(None),)*len(cell), weights, scale)
+
+
+def _locked(method):
+    """
+    Run a ModelGrid method while holding the lock of the grid, so that
+    threads sharing a grid load its arrays once and never see them
+    half made
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def _on_axis(spec, wave):
+    """
+    Put the flux of a model onto a wavelength axis, e.g. that of the
+    flux cube if the model has a shifted axis
+
+    Parameters
+    ----------
+    spec: dict
+        The model spectrum, as returned by ModelGrid.read_model
+    wave: np.ndarray
+        The wavelength axis
+
+    Returns
+    -------
+    np.ndarray
+        The (mu, wavelength) flux on the given axis
+    """
+    if np.array_equal(spec['wave'], wave):
+        return spec['flux']
+
+    return np.array([np.interp(wave, spec['wave'], f) for f in spec['flux']])
+
+
+def _close_pool(pool, pool_file, pid):
+    """
+    Shut down a worker pool and remove its memory-mapped flux file,
+    unless this is a process forked from the one which started it
+
+    Parameters
+    ----------
+    pool: multiprocessing.Pool
+        The worker pool
+    pool_file: str
+        The path to the .npy file of the flux cube written for the pool,
+        if any
+    pid: int
+        The process ID of the process which started the pool
+    """
+    if os.getpid() != pid:
+        return
+
+    pool.close()
+    pool.join()
+    if pool_file and os.path.isfile(pool_file):
+        os.remove(pool_file)
+
+
+def _release_shared(directory, pid):
+    """
+    Remove a process from the users of a shared flux cube, removing
+    the cube and its lock file after the last user. A process forked
+    from the user, e.g. a web server worker, leaves it alone.
+
+    Parameters
+    ----------
+    directory: str
+        The shared memory directory
+    pid: int
+        The process ID of the user
+    """
+    if os.getpid() != pid:
+        return
+
+    refs = os.path.join(directory, 'refs.json')
+    with utils.file_lock(directory+'.lock'):
+
+        # Remove this process from the users
+        pids = []
+        if os.path.isfile(refs):
+            with open(refs) as f:
+                pids = json.load(f)
+            if pid in pids:
+                pids.remove(pid)
+            pids = [p for p in pids if _process_alive(p)]
+
+        # Remove the files and the lock after the last user...
+        if not pids:
+            shutil.rmtree(directory, ignore_errors=True)
+            try:
+                os.remove(directory+'.lock')
+            except OSError:
+                pass
+
+        # ...or update the users
+        else:
+            with open(refs, 'w') as f:
+                json.dump(pids, f)
+
+
+def _process_alive(pid):
+    """
+    Check whether a process is running
+
+    Parameters
+    ----------
+    pid: int
+        The process id
+
+    Returns
+    -------
+    bool
+        False if the process is known to have exited
+    """
+    # Signal 0 only checks the process on POSIX systems
+    if os.name != 'posix':
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+
+    return True
+
+
+def _read_header(filepath):
+    """
+    Read the primary header of a model file into a dictionary
+
+    Parameters
+    ----------
+    filepath: str
+        The path to the FITS file
+
+    Returns
+    -------
+    dict
+        The header values, or None if the file could not be read
+    """
+    try:
+        header = fits.getheader(filepath)
+    except Exception:
+        return
+
+    rec = {}
+    for key in header.keys():
+        if key in ('', 'COMMENT', 'HISTORY'):
+            continue
+        val = header[key]
+        if isinstance(val, bool) or not isinstance(val, (int, float, str)):
+            val = str(val)
+        rec[key] = val
+
+    return rec
+
+
+def index_models(files, index_file='', workers=1, pool='thread'):
+    """
+    Read the FITS headers of the given model files into a table,
+    re-reading only the files which were added or changed since the
+    index file was last written
+
+    Parameters
+    ----------
+    files: list
+        The paths to the model files
+    index_file: str (optional)
+        The .npy file of header values, sizes and modification
+        times to update
+    workers: int (optional)
+        The maximum number of headers to read concurrently
+    pool: str (optional)
+        Read the headers with a 'thread' or 'process' pool
+
+    Returns
+    -------
+    astropy.table.Table
+        The table of header values with a 'filename' column and
+        a digest of the names, sizes and modification times of the
+        files in its meta
+    """
+    # Load the previous index
+    old = None
+    if index_file and os.path.isfile(index_file):
+        try:
+            old = np.load(index_file, allow_pickle=False)
+        except (IOError, ValueError):
+            print('Could not read', index_file)
+
+    # Get the size and modification time of each file
+    current = {}
+    for f in files:
+        if f.endswith('.fits'):
+            stat = os.stat(f)
+            current[os.path.basename(f)] = (f, stat.st_size, stat.st_mtime)
+
+    # Keep the indexed files which are unchanged
+    if old is not None:
+        keep = np.array([name in current and
+                         current[name][1:] == (size, mtime)
+                         for name, size, mtime in zip(old['filename'],
+                                                      old['size'],
+                                                      old['mtime'])],
+                        dtype=bool)
+        known = set(old['filename'][keep])
+    else:
+        keep, known = np.zeros(0, dtype=bool), set()
+    stale = sorted(name for name in current if name not in known)
+    changed = bool(stale) or not keep.all()
+
+    # Read the new or changed headers concurrently
+    new = OrderedDict()
+    n_new = 0
+    if stale:
+        print('Reading {} new or changed model headers...'.format(len(stale)))
+        start = time.time()
+        executor = ThreadPoolExecutor if pool == 'thread' \
+            else ProcessPoolExecutor
+        paths = [current[name][0] for name in stale]
+        with executor(max_workers=max(1, workers)) as ex:
+            for name, rec in zip(stale, ex.map(_read_header, paths)):
+
+                if rec is None:
+                    print(current[name][0],
+                          'could not be read into the model grid.')
+                    continue
+
+                # Add the values straight to the columns
+                rec.update(filename=name, size=current[name][1],
+                           mtime=current[name][2])
+                for key in rec:
+                    if key not in new:
+                        new[key] = ['']*n_new
+                for key, col in new.items():
+                    col.append(rec.get(key, ''))
+                n_new += 1
+
+        # Report the throughput
+        elapsed = max(time.time()-start, 1E-9)
+        print('Read {} headers in {:.2f} s ({:.0f} files/s)'
+              .format(len(stale), elapsed, len(stale)/elapsed))
+
+    # Combine the unchanged and new columns
+    names = list(old.dtype.names) if old is not None else []
+    names += [k for k in new if k not in names]
+    names = [n for n in names if n != 'filename']+['filename']
+    cols = []
+    for n in names:
+        if old is not None and n in old.dtype.names:
+            col = old[n][keep]
+        else:
+            col = np.array(['']*int(keep.sum()))
+        if n_new:
+            add = np.array(new.get(n, ['']*n_new))
+
+            # Keep the type of the new values if no old rows are kept
+            if not len(col):
+                col = add
+            else:
+                try:
+                    col = np.concatenate([col, add])
+                except (TypeError, ValueError):
+                    col = np.array(col.tolist()+add.tolist())
+        cols.append(col)
+
+    # Sort by filename and update the index file
+    order = np.argsort(cols[-1], kind='mergesort')
+    cols = [c[order] for c in cols]
+    if index_file and changed:
+        try:
+            np.save(index_file, np.rec.fromarrays(cols, names=names))
+        except IOError:
+            print('Could not write model index to', index_file)
+
+    # Make the table without the file stats
+    keep = [n not in ('size', 'mtime') for n in names]
+    table = at.Table([c for c, k in zip(cols, keep) if k],
+                     names=[n for n, k in zip(names, keep) if k])
+
+    # Digest the file stats so that caches can tell when a file changed
+    stats = [[str(name), int(current[str(name)][1]),
+              float(current[str(name)][2])] for name in cols[-1]]
+    key = json.dumps(stats).encode('utf-8')
+    table.meta['digest'] = hashlib.sha1(key).hexdigest()[:16]
+
+    return table
+
+
+class LazyFlux(object):
+    """
+    A read-only view of the flux cube in an HDF5 file which keeps
+    the dataset open and reads only the hyperslabs that are used
+
+    Slicing returns a new view without reading any data and the
+    values are read with `np.asarray`, so a view can be used in
+    place of the in-memory (Teff, logg, FeH, mu, wavelength) array.
+    If the file also has a wavelength-major copy of the cube, each
+    read uses the layout with the fewest chunk bytes to read.
+    """
+    def __init__(self, dataset, index=None, wave_major=None):
+        """
+        Parameters
+        ----------
+        dataset: h5py.Dataset
+            The open flux dataset
+        index: tuple (optional)
+            The slice or integer index into each dimension of the dataset
+        wave_major: h5py.Dataset (optional)
+            The open (wavelength, Teff, logg, FeH, mu) flux dataset
+        """
+        self.dataset = dataset
+        self.wave_major = wave_major
+        if index is None:
+            index = tuple(slice(0, n) for n in dataset.shape)
+        self.index = index
+
+    @property
+    def shape(self):
+        return tuple(s.stop-s.start for s in self.index
+                     if isinstance(s, slice))
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def dtype(self):
+        return self.dataset.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        # Expand an Ellipsis to full slices
+        if any(k is Ellipsis for k in key):
+            n = key.index(Ellipsis)
+            fill = (slice(None),)*(self.ndim-len(key)+1)
+            key = key[:n]+fill+key[n+1:]
+
+        if len(key) > self.ndim:
+            raise IndexError('Too many indices for LazyFlux.')
+
+        # Compose the key with the current index
+        free = [n for n, s in enumerate(self.index) if isinstance(s, slice)]
+        index = list(self.index)
+        for dim, k in zip(free, key):
+            start, length = index[dim].start, index[dim].stop-index[dim].start
+            if isinstance(k, slice):
+                i, j, step = k.indices(length)
+                if step != 1:
+                    raise IndexError('Only unit steps are supported.')
+                index[dim] = slice(start+i, start+max(i, j))
+            else:
+                k = int(k)+length if int(k) < 0 else int(k)
+                if not 0 <= k < length:
+                    raise IndexError('Index out of range.')
+                index[dim] = start+k
+
+        return LazyFlux(self.dataset, tuple(index), self.wave_major)
+
+    def read_bytes(self, layout='spectrum'):
+        """
+        The number of chunk bytes read to get the view from a layout
+
+        Parameters
+        ----------
+        layout: str
+            The 'spectrum' or 'wavelength' major dataset
+
+        Returns
+        -------
+        int
+            The number of bytes
+        """
+        data, index = self.dataset, self.index
+        if layout == 'wavelength':
+            data, index = self.wave_major, index[-1:]+index[:-1]
+
+        return utils.chunk_bytes(data.shape, data.chunks, index,
+                                 data.dtype.itemsize)
+
+    @property
+    def layout(self):
+        """
+        The layout which reads the fewest bytes for the view
+        """
+        if self.wave_major is not None and \
+                self.read_bytes('wavelength') < self.read_bytes('spectrum'):
+            return 'wavelength'
+
+        return 'spectrum'
+
+    def __array__(self, dtype=None, copy=None):
+
+        # Read the view from the wavelength-major copy...
+        if self.layout == 'wavelength':
+            data = self.wave_major[self.index[-1:]+self.index[:-1]]
+            if isinstance(self.index[-1], slice):
+                data = np.moveaxis(data, 0, -1)
+
+        # ...or from the cube
+        else:
+            data = self.dataset[self.index]
+
+        return data if dtype is None else data.astype(dtype)
+
+    def close(self):
+        """
+        Close the HDF5 file
+        """
+        self.dataset.file.close()
+
 
 class ModelGrid(object):
     """
@@ -34,7 +515,7 @@ class ModelGrid(object):
         The path to the directory of FITS files used to create the ModelGrid
     refs: list, str
         The references for the data contained in the ModelGrid
-    teff_rng: tuple
+    Teff_rng: tuple
         The range of effective temperatures [K]
     logg_rng: tuple
         The range of surface gravities [dex]
@@ -54,7 +535,11 @@ class ModelGrid(object):
                  names={'Teff': 'PHXTEFF', 'logg': 'PHXLOGG',
                         'FeH': 'PHXM_H', 'mass': 'PHXMASS',
                         'r_eff': 'PHXREFF', 'Lbol': 'PHXLUM'},
-                 resolution='', wl_units=q.um, **kwargs):
+                 resolution='', wl_units=q.um, processes=1, lazy=False,
+                 workers=1, cache_size=0, pyramid=(), precision='float64',
+                 compression=None, shared=False, max_memory=None,
+                 method='linear', mu_grid=None, wave_major=False,
+                 index_pool='thread', **kwargs):
         """
         Initializes the model grid by creating a table with a column
         for each parameter and ingests the spectra
@@ -63,7 +548,8 @@ class ModelGrid(object):
         ----------
         model_directory: str
             The path to the directory of FITS files of spectra,
-            which may include a filename with a wildcard caharacter
+            which may include a filename with a wildcard caharacter,
+            or to an HDF5 cube store, e.g. from helpers.convert_ATLAS9_cube
         bibcode: str, array-like (optional)
             The bibcode or list of bibcodes for this data set
         names: dict (optional)
@@ -73,123 +559,157 @@ class ModelGrid(object):
             The desired wavelength resolution (lambda/d_lambda)
             of the grid spectra
         wl_units: astropy.units.quantity
+        processes: int (optional)
+            The number of worker processes used for interpolation
+        lazy: bool (optional)
+            Keep the cached flux cube on disk and read only the
+            hyperslabs needed rather than loading it into memory
+        workers: int (optional)
+            The number of threads used to read FITS headers and files
+        cache_size: int (optional)
+            The number of recently retrieved spectra to keep in memory
+        pyramid: sequence (optional)
+            The resolving powers at which to store resampled flux
+            cubes, from which get() serves the nearest level
+        precision: str (optional)
+            The storage type of the flux cube, i.e. 'float64', 'float32'
+            or the 'float16' and 'int16' types scaled for each spectrum.
+            The reduced precision types are interpolated in float32.
+            A cube store keeps its own storage type.
+        compression: str (optional)
+            The HDF5 compression filter of the flux cache, e.g. 'gzip'
+        shared: bool (optional)
+            Attach to a read-only copy of the flux cube in shared memory,
+            publishing it first if no other process has, so that all
+            processes using the same cache share one copy
+        max_memory: int (optional)
+            The approximate memory limit in bytes for reading the flux
+            cube. A larger cube is kept on disk and streamed through
+            interpolation one wavelength block at a time.
+        method: str (optional)
+            The interpolation method, 'linear' for the bracketing cell of
+            the regular grid or 'delaunay' for the enclosing simplex of
+            the models which exist
+        mu_grid: array-like (optional)
+            The mu values onto which the intensity of every model is
+            resampled as it is read, e.g. from utils.mu_nodes, to shrink
+            the flux cube. mu=1 is added if missing since the limb
+            darkening is normalized there.
+        wave_major: bool (optional)
+            Also store the flux cache with wavelength outermost, chunked
+            in blocks of wavelength for every model, so that reading a
+            narrow wavelength bin of many models from disk touches only
+            the bytes of that bin
+        index_pool: str (optional)
+            Read the FITS headers of new or changed models with a
+            'thread' or 'process' pool of the given number of workers
         """
+        # Use a cube store in place of the model files
+        self.store = ''
+        if model_directory.endswith('.hdf5'):
+            self.store = model_directory
+
         # Make sure we can use glob if a directory
         # is given without a wildcard
-        if '*' not in model_directory:
+        elif '*' not in model_directory:
             model_directory += '*'
 
-        # Check for a precomputed pickle of this ModelGrid
-        model_grid = ''
+        # Print update...
         if model_directory.endswith('/*'):
-            # Location of model_grid pickle
-            file = model_directory.replace('*', 'model_grid.p')
-
-            if os.path.isfile(file):
-                model_grid = pickle.load(open(file, 'rb'))
-
-        # Instantiate the precomputed model grid
-        if model_grid:
+            print("Indexing models...")
+
+        # Create some attributes
+        self.path = os.path.dirname(model_directory)+'/'
+        self.refs = ''
+        self.wave_rng = (0, 40)
+        self.cube_wave_rng = self.wave_rng
+        self.index_file = ''
+        self.index_digest = ''
+        self.workers = workers
+        self.flux = ''
+        self.wavelength = ''
+        self.r_eff = ''
+        self.mu = ''
+        self.scale = None
+        self.wave_axis = (None, None)
+        self.store_check = (None, False)
+        self.lock = threading.RLock()
+        self.parent = None
+
+        # Save the refs to a References() object
+        if bibcode:
+            if isinstance(bibcode, (list, tuple)):
+                pass
+            elif bibcode and isinstance(bibcode, str):
+                bibcode = [bibcode]
+            else:
+                pass
 
-            for k, v in vars(model_grid).items():
-                setattr(self, k, v)
+            self.refs = bibcode
+            # _check_for_ref_object()
 
-            self.flux_file = self.path+'model_grid_flux.hdf5'
-            self.flux = ''
-            self.wavelength = ''
-            self.r_eff = ''
-            self.mu = ''
+        # Read the table of models from the cube store...
+        if self.store:
+            if not os.path.isfile(self.store):
+                print('No cube store', self.store, '.')
+                return
 
-            del model_grid
+            with h5py.File(self.store, "r") as f:
+                table = at.Table(f['models'][:])
+                precision = str(f.attrs['precision'])
+            for name in table.colnames:
+                if table[name].dtype.kind == 'S':
+                    table[name] = np.char.decode(table[name])
 
-        # Or compute it from scratch
+        # ...or index the spectral intensity files
         else:
-
-            # Print update...
-            if model_directory.endswith('/*'):
-                print("Indexing models...")
-
-            # Create some attributes
-            self.path = os.path.dirname(model_directory)+'/'
-            self.refs = ''
-            self.wave_rng = (0, 40)
-            self.flux_file = self.path+'model_grid_flux.hdf5'
-            self.flux = ''
-            self.wavelength = ''
-            self.r_eff = ''
-            self.mu = ''
-
-            # Save the refs to a References() object
-            if bibcode:
-                if isinstance(bibcode, (list, tuple)):
-                    pass
-                elif bibcode and isinstance(bibcode, str):
-                    bibcode = [bibcode]
-                else:
-                    pass
-
-                self.refs = bibcode
-                # _check_for_ref_object()
-
-            # Get list of spectral intensity files
             files = glob(model_directory)
-            filenames = []
             if not files:
                 print('No files match', model_directory, '.')
                 return
 
-            # Parse the FITS headers
-            vals, dtypes = [], []
-            for f in files:
-                if f.endswith('.fits'):
-                    try:
-                        header = fits.getheader(f)
-                        keys = np.array(header.cards).T[0]
-                        dtypes = [type(i[1]) for i in header.cards]
-                        vals.append([header.get(k) for k in keys])
-                        filenames.append(f.split('/')[-1])
-                    except:
-                        print(f, 'could not be read into the model grid.')
-
-            # Fix data types, trim extraneous values, and make the table
-            dtypes = [str if d == bool else d for d in dtypes]
-            vals = [v[: len(dtypes)] for v in vals]
-            table = at.Table(np.array(vals), names=keys, dtype=dtypes)
-
-            # Add the filenames as a column
-            table['filename'] = filenames
-
-            # Rename any columns
-            for new, old in names.items():
-                try:
-                    table.rename_column(old, new)
-                except:
-                    print('No column named', old)
-
-            # Remove columns where the values are all the same
-            # and store value as attribute instead
-            for n in table.colnames:
-                val = table[n][0]
-                exc = n not in ['Teff', 'logg', 'FeH']
-                if list(table[n]).count(val) == len(table[n]) and exc:
-                    setattr(self, n, val)
-                    table.remove_column(n)
-
-            # Store the table in the data attribute
-            self.data = table
-
-            # Store the parameter ranges
-            self.Teff_vals = np.asarray(np.unique(table['Teff']))
-            self.logg_vals = np.asarray(np.unique(table['logg']))
-            self.FeH_vals = np.asarray(np.unique(table['FeH']))
-
-            # Write an inventory file to this directory for future table loads
+            # Keep an index file in this directory for future table loads
             if model_directory.endswith('/*'):
-                self.file = file
-                try:
-                    pickle.dump(self, open(self.file, 'wb'))
-                except IOError:
-                    print('Could not write model grid to', self.file)
+                self.index_file = self.path+'model_grid_index.npy'
+
+            # Parse the FITS headers of new or changed files
+            table = index_models(files, self.index_file, workers=workers,
+                                 pool=index_pool)
+            self.index_digest = table.meta['digest']
+
+        # Rename any columns
+        for new, old in names.items():
+            try:
+                table.rename_column(old, new)
+            except:
+                print('No column named', old)
+
+        # Remove columns where the values are all the same
+        # and store value as attribute instead
+        for n in table.colnames:
+            val = table[n][0]
+            exc = n not in ['Teff', 'logg', 'FeH']
+            if list(table[n]).count(val) == len(table[n]) and exc:
+                setattr(self, n, val)
+                table.remove_column(n)
+
+        # Store the table in the data attribute
+        self.data = table
+
+        # Store the parameter ranges
+        self.Teff_vals = np.asarray(np.unique(table['Teff']))
+        self.logg_vals = np.asarray(np.unique(table['logg']))
+        self.FeH_vals = np.asarray(np.unique(table['FeH']))
+        self.index_points()
+        for name in ['Teff', 'logg', 'FeH']:
+            vals = getattr(self, name+'_vals')
+            setattr(self, name+'_rng', (vals[0], vals[-1]))
+
+        # Keep the full grid so customizations are views of it
+        self.full = {'data': table, 'points': self.points, 'flux': '',
+                     'scale': None, 'mu': '', 'r_eff': '', 'wavelength': ''}
+        for name in ['Teff_vals', 'logg_vals', 'FeH_vals']:
+            self.full[name] = getattr(self, name)
 
         # Print something
         print(len(self.data), 'models loaded from', self.path)
@@ -197,21 +717,67 @@ class ModelGrid(object):
         # In case no filter is used
         self.n_bins = 1
 
-        # Set the wavelength_units
-        self.wl_units = q.AA
-        if wl_units:
-            self.set_units(wl_units)
-        else:
-            self.const = 1
+        # Set the wavelength_units, converting the ranges from microns,
+        # or keep the Angstroms of the model files
+        self.wl_units = q.um
+        self.set_units(wl_units or q.AA)
 
         # Save the desired resolution
         self.resolution = resolution
 
+        # Keep the most recently used spectra
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.cache_stats = {'hits': 0, 'misses': 0}
+
+        # The worker pool is started on first use
+        self.processes = processes
+        self.pool = None
+        self.pool_file = ''
+        self._pool_flux = None
+        self._pool_owned = ''
+        self._pool_finalizer = None
+
+        # Read the flux cube from disk as needed
+        self.lazy = lazy
+
+        # Store the flux cube in reduced precision
+        self.precision = np.dtype(precision).name
+        self.compression = compression
+
+        # Share one copy of the flux cube between processes
+        self.shared = shared
+        self.attached = False
+        self._shared_finalizer = None
+
+        # The PCA emulator is loaded on first use
+        self.emulator = {}
+
+        # Stream the cube in wavelength blocks within the memory limit
+        self.max_memory = max_memory
+
+        # The triangulation of the models is loaded on first use
+        self.method = method
+        self.tri = {}
+
+        # Resample the intensities onto fewer mu values
+        self.mu_grid = None
+        if mu_grid is not None:
+            self.mu_grid = np.union1d(np.asarray(mu_grid, dtype=float), [1.])
+
+        # Keep a wavelength-major copy of the flux cache
+        self.wave_major = wave_major
+
+        # The resampled cubes are opened on first use
+        self.pyramid = sorted(pyramid)
+        self.levels = {}
+
         # Customize from the get-go
         if kwargs:
             self.customize(**kwargs)
 
-    def get(self, Teff, logg, FeH, resolution='', interp=True):
+    def get(self, Teff, logg, FeH, resolution='', interp=True, cache=True):
         """
         Retrieve the wavelength, flux, and effective radius
         for the spectrum of the given parameters
@@ -229,6 +795,8 @@ class ModelGrid(object):
             The desired wavelength resolution (lambda/d_lambda)
         interp: bool
             Interpolate the model if possible
+        cache: bool
+            Use the cache of recently retrieved spectra
 
         Returns
         -------
@@ -238,78 +806,46 @@ class ModelGrid(object):
 
         """
         # See if the model with the desired parameters is witin the grid
-        in_grid = all([(Teff >= min(self.Teff_vals)) &
-                       (Teff <= max(self.Teff_vals)) &
-                       (logg >= min(self.logg_vals)) &
-                       (logg <= max(self.logg_vals)) &
-                       (FeH >= min(self.FeH_vals)) &
-                       (FeH <= max(self.FeH_vals))])
+        in_grid = all([self.Teff_vals[0] <= Teff <= self.Teff_vals[-1],
+                       self.logg_vals[0] <= logg <= self.logg_vals[-1],
+                       self.FeH_vals[0] <= FeH <= self.FeH_vals[-1]])
 
         if in_grid:
 
+            # Serve points on and off the grid at the same resolution
+            resolution = resolution or self.resolution
+
             # See if the model with the desired parameters is a true grid point
-            on_grid = self.data[[(self.data['Teff'] == Teff) &
-                                 (self.data['logg'] == logg) &
-                                 (self.data['FeH'] == FeH)]]\
-                                 in self.data
+            row = self.points.get((Teff, logg, FeH))
 
             # Grab the data if the point is on the grid
-            if on_grid:
-
-                # Get the row index and filepath
-                row, = np.where((self.data['Teff'] == Teff) &
-                                (self.data['logg'] == logg) &
-                                (self.data['FeH'] == FeH))[0]
-
-                filepath = self.path+str(self.data[row]['filename'])
-
-                # Get the flux, mu, and abundance arrays
-                raw_flux = fits.getdata(filepath, 0)
-                mu = fits.getdata(filepath, 1)
-                # abund = fits.getdata(filepath, 2)
-
-                # Construct full wavelength scale and convert to microns
-                if self.CRVAL1 == '-':
-                    # Try to get data from WAVELENGTH extension...
-                    dat = fits.getdata(filepath, ext=-1)
-                    raw_wave = np.array(dat).squeeze()
+            if row is not None:
+
+                # Return the cached spectrum for these settings
+                key = ('get', Teff, logg, FeH, resolution, self.state_key())
+                spec_dict = self.cache_get(key) if cache else None
+                if spec_dict is not None:
+                    return spec_dict
+
+                # Read the spectrum from the nearest level of the
+                # pyramid or from the FITS file
+                if resolution and self.pyramid:
+                    spec_dict = self.read_level(self.data[row], resolution)
+                elif self.store:
+                    spec_dict = self.read_cube(self.data[row], resolution)
                 else:
-                    # ...or try to generate it
-                    b = self.CDELT1*np.arange(len(raw_flux[0]))
-                    raw_wave = np.array(self.CRVAL1+b).squeeze()
-
-                # Convert from A to desired units
-                raw_wave *= self.const
+                    spec_dict = self.read_model(self.data[row],
+                                                self.wave_rng, resolution)
 
-                # Trim the wavelength and flux arrays
-                idx, = np.where(np.logical_and(raw_wave >= self.wave_rng[0],
-                                               raw_wave <= self.wave_rng[1]))
-                flux = raw_flux[:, idx]
-                wave = raw_wave[idx]
-
-                # Bin the spectrum if necessary
-                if resolution or self.resolution:
-
-                    # Calculate zoom
-                    z = utils.calc_zoom(resolution or self.resolution, wave)
-                    wave = zoom(wave, z)
-                    flux = zoom(flux, (1, z))
-
-                # Make a dictionary of parameters
-                # This should really be a core.Spectrum() object!
-                row_data = self.data[row].as_void()
-                spec_dict = dict(zip(self.data.colnames, row_data))
-                spec_dict['wave'] = wave
-                spec_dict['flux'] = flux
-                spec_dict['mu'] = mu
-                spec_dict['r_eff'] = ''
-                # spec_dict['abund'] = abund
+                if cache:
+                    self.cache_put(key, spec_dict)
 
             # If not on the grid, interpolate to it
             else:
                 # Call grid_interp method
                 if interp:
-                    spec_dict = self.grid_interp(Teff, logg, FeH)
+                    spec_dict = self.grid_interp(Teff, logg, FeH, cache=cache,
+                                                 resolution=resolution)
                 else:
                     return
 
@@ -320,7 +856,250 @@ class ModelGrid(object):
                   ' model not in grid.')
             return
 
-    def grid_interp(self, Teff, logg, FeH, plot=False):
+    def read_model(self, row, wave_rng, resolution='', same_axis=False):
+        """
+        Read the spectrum of a model from its FITS file
+
+        Parameters
+        ----------
+        row: astropy.table.Row
+            The row of the model in the data table
+        wave_rng: array-like
+            The lower and upper inclusive bounds for the wavelength
+        resolution: int (optional)
+            The desired wavelength resolution (lambda/d_lambda)
+        same_axis: bool (optional)
+            Reuse the wavelength axis of the previous model of the same
+            size and end values without reading all of the WAVELENGTH
+            extension, as when reading the models of one cube, which
+            usually share one axis
+
+        Returns
+        -------
+        dict
+            A dictionary of arrays of the wavelength, flux, and
+            mu values and the effective radius for the given model
+        """
+        # Get the filepath
+        filepath = self.path+str(row['filename'])
+
+        # Open the file once and memory map the arrays
+        with fits.open(filepath, memmap=True) as hdul:
+            raw_flux = hdul[0].data
+            mu = np.array(hdul[1].data)
+            # abund = hdul[2].data
+
+            # Identify the wavelength scale by the size of the
+            # WAVELENGTH extension...
+            if self.CRVAL1 == '-':
+                dat = hdul[-1]
+                key = (tuple(dat.shape), self.const)
+
+            # ...or by its size, start and step
+            else:
+                dat = None
+                key = (raw_flux.shape[-1], self.CRVAL1, self.CDELT1,
+                       self.const)
+
+            # Reuse that of the previous model if it is the same,
+            # checking the ends of the WAVELENGTH extension so that a
+            # shifted axis of the same size is read in full
+            axis_key, raw_wave = self.wave_axis
+            reuse = axis_key == key
+            if reuse and dat is not None:
+                try:
+                    ends = [dat.section[tuple(n-1 if last else 0
+                                              for n in dat.shape)]
+                            for last in (False, True)]
+                    ends = np.array(ends, dtype=float)*self.const
+                    reuse = same_axis and \
+                        np.array_equal(ends, raw_wave[[0, -1]])
+                except (AttributeError, IndexError, TypeError):
+                    reuse = False
+
+            if not reuse:
+
+                # Get data from the WAVELENGTH extension...
+                if dat is not None:
+                    raw_wave = np.array(dat.data, dtype=float).squeeze()
+
+                # ...or generate it
+                else:
+                    b = self.CDELT1*np.arange(raw_flux.shape[-1])
+                    raw_wave = np.array(self.CRVAL1+b, dtype=float).squeeze()
+
+                # Convert from A to desired units
+                raw_wave *= self.const
+                self.wave_axis = (key, raw_wave)
+
+            # Read only the flux within the wavelength range, or within
+            # that of the cube if the spectrum is binned, so that its
+            # pixels are binned from the same pixels as those of the cube
+            rng = self.cube_wave_rng if resolution else wave_rng
+            i = raw_wave.searchsorted(rng[0])
+            j = raw_wave.searchsorted(rng[1], side='right')
+            flux = np.array(raw_flux[:, i:max(i, j)])
+            wave = raw_wave[i:max(i, j)].copy()
+
+        # Resample onto the mu grid if necessary
+        if self.mu_grid is not None:
+            flux = utils.resample_mu(mu, flux, self.mu_grid)
+            mu = self.mu_grid.copy()
+
+        # Bin the spectrum and trim it if necessary
+        if resolution:
+            wave, flux = utils.resample(wave, flux, resolution)
+            i = wave.searchsorted(wave_rng[0])
+            j = wave.searchsorted(wave_rng[1], side='right')
+            wave, flux = wave[i:max(i, j)], flux[:, i:max(i, j)]
+
+        # Make a dictionary of parameters
+        # This should really be a core.Spectrum() object!
+        spec_dict = dict(zip(row.colnames, row.as_void()))
+        spec_dict['wave'] = wave
+        spec_dict['flux'] = flux
+        spec_dict['mu'] = mu
+        spec_dict['r_eff'] = spec_dict.get('r_eff', '')
+        # spec_dict['abund'] = abund
+
+        return spec_dict
+
+    def read_cube(self, row, resolution=''):
+        """
+        Read the spectrum of a model from the flux cube, e.g. of a grid
+        with no model files, or from the cube store at its native
+        resolution if another resolution is requested
+
+        Parameters
+        ----------
+        row: astropy.table.Row
+            The row of the model in the data table
+        resolution: int (optional)
+            The desired wavelength resolution (lambda/d_lambda)
+
+        Returns
+        -------
+        dict
+            A dictionary of arrays of the wavelength, flux, and
+            mu values and the effective radius for the given model
+        """
+        if isinstance(self.flux, str):
+            self.load_flux()
+
+        # Get the position of the model in the full grid
+        full = self.full
+        t, g, m = [full[name+'_vals'].searchsorted(row[name])
+                   for name in ['Teff', 'logg', 'FeH']]
+
+        # Get the spectrum within the wavelength range from the cube...
+        if not resolution or str(resolution) == str(self.resolution):
+            W = self.cube_slices()[-1]
+            scale = None if full['scale'] is None else full['scale'][t, g, m]
+            flux = np.array(utils.decode_flux(full['flux'][t, g, m, :, W],
+                                              scale))
+            wave = full['wavelength'][W]
+            mu = full['mu'][t, g, m]
+
+        # ...or bin the native spectrum from the store
+        else:
+            with h5py.File(self.store, "r") as f:
+                unit = q.Unit(str(f.attrs['wl_units']))
+                wave = f['wavelength'][:]*unit.to(self.wl_units)
+                scale = f['scale'][t, g, m] if 'scale' in f else None
+                flux = np.array(utils.decode_flux(f['flux'][t, g, m],
+                                                  scale), dtype=float)
+                mu = f['mu'][t, g, m]
+
+            # Resample onto the mu grid if necessary
+            if self.mu_grid is not None:
+                flux = utils.resample_mu(mu, flux, self.mu_grid)
+                mu = self.mu_grid.copy()
+
+            # Bin the whole spectrum, like a cube, and trim it
+            wave, flux = utils.resample(wave, flux, resolution)
+            i = wave.searchsorted(self.wave_rng[0])
+            j = wave.searchsorted(self.wave_rng[1], side='right')
+            wave, flux = wave[i:max(i, j)], flux[:, i:max(i, j)]
+
+        # Make a dictionary of parameters
+        spec_dict = dict(zip(row.colnames, row.as_void()))
+        spec_dict['wave'] = wave
+        spec_dict['flux'] = flux
+        spec_dict['mu'] = mu
+        spec_dict['r_eff'] = spec_dict.get('r_eff', '')
+
+        return spec_dict
+
+    def read_level(self, row, resolution):
+        """
+        Read the spectrum of a model from the level of the pyramid
+        nearest the given resolution
+
+        Parameters
+        ----------
+        row: astropy.table.Row
+            The row of the model in the data table
+        resolution: int
+            The desired wavelength resolution (lambda/d_lambda)
+
+        Returns
+        -------
+        dict
+            A dictionary of arrays of the wavelength, flux, and
+            mu values and the effective radius for the given model
+        """
+        R, W = self.nearest_level(resolution)
+        level = self.levels[R]
+
+        # Get the position of the model in the full grid
+        t, g, m = [self.full[name+'_vals'].searchsorted(row[name])
+                   for name in ['Teff', 'logg', 'FeH']]
+
+        # Make a dictionary of parameters
+        spec_dict = dict(zip(row.colnames, row.as_void()))
+        spec_dict['wave'] = level['wavelength'][W]
+        scale = level['scale']
+        flux = level['flux'][t, g, m, :, W]
+        spec_dict['flux'] = np.array(utils.decode_flux(
+            flux, None if scale is None else scale[t, g, m]))
+        spec_dict['mu'] = level['mu'][t, g, m]
+        spec_dict['r_eff'] = spec_dict.get('r_eff', '')
+        spec_dict['resolution'] = R
+
+        return spec_dict
+
+    def nearest_level(self, resolution):
+        """
+        Find the level of the pyramid nearest the given resolution,
+        loading the pyramid if necessary
+
+        Parameters
+        ----------
+        resolution: int
+            The desired wavelength resolution (lambda/d_lambda)
+
+        Returns
+        -------
+        tuple
+            The resolving power of the level and the slice of its
+            wavelength axis within the current wavelength range
+        """
+        if not self.levels:
+            self.load_pyramid()
+
+        # Get the nearest resolving power
+        R = min(self.levels,
+                key=lambda r: abs(np.log(float(r)/float(resolution))))
+
+        # Trim the wavelength range
+        w = self.levels[R]['wavelength']
+        i, j = w.searchsorted(self.wave_rng[0]), \
+            w.searchsorted(self.wave_rng[1], side='right')
+
+        return R, slice(i, max(i, j))
+
+    def grid_interp(self, Teff, logg, FeH, plot=False, cache=True,
+                    emulator=False, method=None, resolution=''):
         """
         Interpolate the grid to the desired parameters
 
@@ -336,6 +1115,18 @@ class ModelGrid(object):
         plot: bool
             Plot the interpolated spectrum along
             with the 8 neighboring grid spectra
+        cache: bool
+            Use the cache of recently interpolated spectra
+        emulator: bool
+            Interpolate the weights of the PCA emulator and rebuild
+            the spectrum from them rather than interpolating the flux
+        method: str (optional)
+            The interpolation method, 'linear' or 'delaunay',
+            defaulting to that of the grid
+        resolution: int (optional)
+            The desired wavelength resolution (lambda/d_lambda), which
+            interpolates the nearest level of the pyramid, if any,
+            rather than the flux cube
 
         Returns
         -------
@@ -343,55 +1134,117 @@ class ModelGrid(object):
             A dictionary of arrays of the wavelength, flux, and
             mu values and the effective radius for the given model
         """
-        # Load the fluxes
-        if isinstance(self.flux, str):
-            self.load_flux()
+        # Return the cached spectrum for these settings
+        method = method or self.method
+        key = ('interp', Teff, logg, FeH, emulator, method, resolution,
+               self.state_key())
+        grid_point = self.cache_get(key) if cache else None
+        if grid_point is not None:
+            return grid_point
 
-        # Get the flux array
-        flux = self.flux.copy()
+        # Load the fluxes, unless the grid is lazy and has no flux cache
+        # yet, in which case only the neighboring model files are read
+        level = bool(resolution and self.pyramid and not emulator)
+        cold = isinstance(self.flux, str) and self.lazy and \
+            not self.shared and not self.store and not emulator and \
+            not level and method == 'linear' and \
+            not (os.path.isfile(self.flux_file) and self.check_cache())
+        if isinstance(self.flux, str) and not cold:
+            self.load_flux()
 
         # Get the interpolable parameters
-        params, values = [], []
-        for p, v in zip([self.Teff_vals, self.logg_vals, self.FeH_vals],
-                        [Teff, logg, FeH]):
-            if len(p) > 1:
-                params.append(p)
-                values.append(v)
-        values = np.asarray(values)
+        params = [self.Teff_vals, self.logg_vals, self.FeH_vals]
+        values = [Teff, logg, FeH]
         label = '{}/{}/{}'.format(Teff, logg, FeH)
 
         try:
-            # Interpolate flux values at each wavelength
-            # using a pool for multiple processes
+            # Find the bracketing grid cell and corner weights once
             print('Interpolating grid point [{}]...'.format(label))
-            processes = 4
-            mu_index = range(flux.shape[-2])
             start = time.time()
-            pool = multiprocessing.Pool(processes)
-            func = partial(utils.interp_flux, flux=flux, params=params,
-                           values=values)
-            new_flux, generators = zip(*pool.map(func, mu_index))
-            pool.close()
-            pool.join()
-
-            # Clean up and time of execution
-            new_flux = np.asarray(new_flux)
-            generators = np.asarray(generators)
+
+            # Use the simplex of the existing models around the point...
+            if method == 'delaunay':
+                verts, weights = self.simplex_weights(Teff, logg, FeH)
+                cube = self.read_vertices(verts, flux=not emulator,
+                                          resolution=level and resolution)
+                cell = (slice(None),)
+
+            # ...or the cell of the regular grid
+            else:
+                cell, weights = utils.grid_cell(params, values)
+
+            # Get the arrays to interpolate
+            gathered = cold or level or method == 'delaunay'
+            if cold:
+                cube = self.read_cell(cell)
+                cell = tuple(slice(None) for c in cell)
+            elif level and method != 'delaunay':
+                cube = self.level_cube(resolution)
+            elif method != 'delaunay':
+                cube = {'flux': self.flux, 'scale': self.scale,
+                        'mu': self.mu, 'r_eff': self.r_eff,
+                        'wavelength': self.wavelength}
+
+            # Rebuild the spectrum from the emulator...
+            if emulator:
+                if not self.emulator:
+                    self.load_emulator()
+                em = self.emulator
+                T, G, M, W = self.cube_slices()
+                ew = em['weights'][verts] if method == 'delaunay' \
+                    else em['weights'][T, G, M]
+                coeffs = utils.interp_cell(ew, cell, weights)
+                new_flux = em['mean'][:, W] + \
+                    np.tensordot(coeffs, em['basis'][:, :, W], axes=1)
+
+            # ...or stream it through in wavelength blocks...
+            elif self.max_memory and not gathered:
+                new_flux = np.concatenate([blk for W, blk in
+                                           self.interp_blocks(cell, weights)],
+                                          axis=-1)
+
+            # ...or interpolate the whole (mu, wavelength) slab at once...
+            elif self.processes > 1 and not gathered and \
+                    not isinstance(self.flux, LazyFlux):
+
+                # ...or split it across the worker pool, which reads
+                # the cell from the full cube, sending each task only
+                # the scale factors of the cell
+                owner = self.start_pool()
+                T, G, M, W = self.cube_slices()
+                full_cell = tuple(slice(c.start+o.start, c.stop+o.start)
+                                  for c, o in zip(cell, (T, G, M)))
+                scale = self.full['scale']
+                if scale is not None:
+                    scale = np.asarray(scale[full_cell])
+                edges = np.linspace(W.start, W.stop,
+                                    self.processes+1).astype(int)
+                args = [(owner.pool_file, full_cell, weights, slice(i, j),
+                         scale)
+                        for i, j in zip(edges[:-1], edges[1:]) if j > i]
+                new_flux = np.concatenate(owner.pool.starmap(_interp_chunk,
+                                                             args), axis=-1)
+
+            else:
+                new_flux = utils.interp_cell(cube['flux'], cell, weights,
+                                             cube['scale'])
             print('Run time in seconds: ', time.time()-start)
 
             # Interpolate mu value
-            interp_mu = RegularGridInterpolator(params, self.mu)
-            mu = interp_mu(np.array(values)).squeeze()
+            mu = utils.interp_cell(cube['mu'], cell, weights).squeeze()
 
             # Interpolate r_eff value
-            interp_r = RegularGridInterpolator(params, self.r_eff)
-            r_eff = interp_r(np.array(values)).squeeze()
+            r_eff = utils.interp_cell(cube['r_eff'], cell, weights).squeeze()
 
             # Make a dictionary to return
             grid_point = {'Teff': Teff, 'logg': logg, 'FeH': FeH,
                           'mu': mu, 'r_eff': r_eff,
-                          'flux': new_flux, 'wave': self.wavelength,
-                          'generators': generators}
+                          'flux': new_flux, 'wave': cube['wavelength']}
+            if level:
+                grid_point['resolution'] = self.nearest_level(resolution)[0]
+
+            if cache:
+                self.cache_put(key, grid_point)
 
             return grid_point
 
@@ -399,99 +1252,1389 @@ class ModelGrid(object):
             print('Grid too sparse. Could not interpolate.')
             return
 
-    def load_flux(self, reset=False):
+    def interp_blocks(self, cell, weights, verts=None):
         """
-        Retrieve the flux arrays for all models
-        and load into the ModelGrid.array attribute
-        with shape (Teff, logg, FeH, mu, wavelength)
+        Interpolate the flux cube one wavelength block at a time,
+        reading only as much of the bracketing cell as fits within
+        the memory limit
+
+        Parameters
+        ----------
+        cell: tuple
+            The slices of the cell along each grid axis
+        weights: np.ndarray
+            The corner weights of the cell
+        verts: tuple (optional)
+            The Teff, logg and FeH indexes in the full grid of the
+            simplex vertices to blend instead of the cell
+
+        Returns
+        -------
+        generator
+            The slice of the wavelength axis and the interpolated
+            (mu, wavelength) flux of each block
         """
-        if reset:
+        # Get the positions of the vertices in the current grid
+        if verts is not None:
+            offset = [s.start for s in self.cube_slices()[:3]]
+            corners = [tuple(int(i-o) for i, o in zip(vert, offset))
+                       for vert in zip(*verts)]
+
+        n_mu, n_wave = self.flux.shape[-2:]
+        bytes_per_wave = 8*n_mu*(2*weights.size+1)
+        for W in utils.wave_blocks(n_wave, bytes_per_wave, self.max_memory):
+            if verts is None:
+                yield W, utils.interp_cell(self.flux[..., W], cell, weights,
+                                           self.scale)
+            else:
+                slab = np.array([utils.decode_flux(
+                    self.flux[c+(slice(None), W)],
+                    None if self.scale is None else self.scale[c])
+                    for c in corners])
+                yield W, utils.interp_cell(slab, (slice(None),), weights)
 
-            # Delete the old file and clear the flux attribute
-            if os.path.isfile(self.flux_file):
-                os.remove(self.flux_file)
-            self.flux = ''
+    def stream(self, Teff, logg, FeH, method=None):
+        """
+        Interpolate the grid to the desired parameters one wavelength
+        block at a time, so that a spectrum which does not fit in memory
+        can be processed in pieces
 
-        if isinstance(self.flux, str):
+        Parameters
+        ----------
+        Teff: int
+            The effective temperature (K)
+        logg: float
+            The logarithm of the surface gravity (dex)
+        FeH: float
+            The logarithm of the ratio of the metallicity
+            and solar metallicity (dex)
+        method: str (optional)
+            The interpolation method, 'linear' or 'delaunay',
+            defaulting to that of the grid
 
-            print('Loading flux into table...')
+        Returns
+        -------
+        generator
+            A dictionary of the wavelength and flux arrays of each block
+            and the mu values and effective radius for the given model
+        """
+        if isinstance(self.flux, str):
+            self.load_flux()
 
-            if os.path.isfile(self.flux_file):
+        # Find the simplex of the existing models around the point...
+        method = method or self.method
+        if method == 'delaunay':
+            verts, weights = self.simplex_weights(Teff, logg, FeH)
+            cube = self.read_vertices(verts, flux=False)
+            cell = (slice(None),)
 
-                # Load the flux from the HDF5 file
-                f = h5py.File(self.flux_file, "r")
-                self.flux = f['flux'][:]
-                f.close()
+        # ...or the bracketing grid cell and corner weights
+        else:
+            params = [self.Teff_vals, self.logg_vals, self.FeH_vals]
+            cell, weights = utils.grid_cell(params, [Teff, logg, FeH])
+            cube, verts = {'mu': self.mu, 'r_eff': self.r_eff}, None
 
-            else:
+        mu = utils.interp_cell(cube['mu'], cell, weights).squeeze()
+        r_eff = utils.interp_cell(cube['r_eff'], cell, weights).squeeze()
 
-                # Get array dimensions
-                T, G, M = self.Teff_vals, self.logg_vals, self.FeH_vals
-                shp = [len(T), len(G), len(M)]
-                n, N = 1, np.prod(shp)
-
-                # Iterate through rows
-                for nt, teff in enumerate(T):
-                    for ng, logg in enumerate(G):
-                        for nm, feh in enumerate(M):
-
-                            try:
-
-                                # Retrieve flux using the `get()` method
-                                d = self.get(teff, logg, feh, interp=False)
-
-                                if d:
-
-                                    # Make sure arrays exist
-                                    if isinstance(self.flux, str):
-                                        new_shp = shp+list(d['flux'].shape)
-                                        self.flux = np.zeros(new_shp)
-                                    if isinstance(self.r_eff, str):
-                                        self.r_eff = np.zeros(shp)
-                                    if isinstance(self.mu, str):
-                                        new_shp = shp+list(d['mu'].shape)
-                                        self.mu = np.zeros(new_shp)
-
-                                    # Add data to respective arrays
-                                    self.flux[nt, ng, nm] = d['flux']
-                                    if d['r_eff'] is None:
-                                        self.r_eff[nt, ng, nm] = np.nan
-                                    else:
-                                        self.r_eff[nt, ng, nm] = d['r_eff']
-                                    self.mu[nt, ng, nm] = d['mu'].squeeze()
-
-                                    # Get the wavelength array
-                                    if isinstance(self.wavelength, str):
-                                        self.wavelength = d['wave']
-
-                                    # Garbage collection
-                                    del d
-
-                                    # Print update
-                                    n += 1
-                                    msg = "{: .2f}% complete.".format(n*100./N)
-                                    print(msg, end='\r')
-
-                            except IOError:
-                                # No model computed so reduce total
-                                N -= 1
-
-                # Load the flux into an HDF5 file
-                f = h5py.File(self.flux_file, "w")
-                # dset = f.create_dataset('flux', data=self.flux)
-                f.create_dataset('flux', data=self.flux)
-                f.close()
-                # del dset
-                print("100.00 percent complete!", end='\n')
+        for W, flux in self.interp_blocks(cell, weights, verts):
+            yield {'Teff': Teff, 'logg': logg, 'FeH': FeH, 'mu': mu,
+                   'r_eff': r_eff, 'flux': flux, 'wave': self.wavelength[W]}
 
-        else:
-            print('Data already loaded.')
+    @property
+    def triangulation_file(self):
+        """
+        The HDF5 file of the triangulations of the existing models
+        """
+        return self.flux_file.replace('.hdf5', '_delaunay.hdf5')
 
-    def customize(self, Teff_rng=(2300, 8000), logg_rng=(0, 6),
-                  FeH_rng=(-2, 1), wave_rng=(0, 40), n_bins=''):
+    def load_triangulation(self):
         """
-        Trims the model grid by the given ranges in effective temperature,
-        surface gravity, and metallicity. Also sets the wavelength range
+        Load the triangulation of the existing models within the current
+        ranges from the file next to the flux cache, making and storing
+        it if necessary. The models are triangulated by their positions
+        along the full parameter axes. The triangulation is kept until
+        the models within the current ranges change.
+        """
+        if self.tri.get('models') is self.points:
+            return
+
+        # Get the position of each model in the full grid
+        indices = np.unique(np.column_stack(
+            [self.full[n+'_vals'].searchsorted(np.asarray(self.data[n]))
+             for n in ['Teff', 'logg', 'FeH']]).astype(np.int64), axis=0)
+        key = indices.tobytes()+str(TRIANGULATION_VERSION).encode('utf-8')
+        digest = hashlib.sha1(key).hexdigest()[:16]
+        if self.tri.get('digest') == digest:
+            self.tri['models'] = self.points
+            return
+
+        with utils.file_lock(self.triangulation_file+'.lock', remove=True):
+            with h5py.File(self.triangulation_file, "a") as f:
+
+                # Triangulate the models and store the arrays
+                if digest not in f:
+                    print('Triangulating', len(indices), 'models...')
+                    if digest+'.part' in f:
+                        del f[digest+'.part']
+                    grp = f.create_group(digest+'.part')
+                    for name, val in utils.triangulate(indices).items():
+                        grp.create_dataset(name, data=val)
+                    f.move(digest+'.part', digest)
+
+                tri = {name: val[:] for name, val in f[digest].items()}
+
+        # Make the tree for finding the nearest model
+        tri['indices'] = indices
+        tri['digest'] = digest
+        tri['models'] = self.points
+        tri['tree'] = cKDTree(tri['points'])
+        self.tri = tri
+
+    def simplex_weights(self, Teff, logg, FeH):
+        """
+        Find the existing models at the vertices of the simplex which
+        contains the given parameters and their barycentric weights
+
+        Parameters
+        ----------
+        Teff: int
+            The effective temperature (K)
+        logg: float
+            The logarithm of the surface gravity (dex)
+        FeH: float
+            The logarithm of the ratio of the metallicity
+            and solar metallicity (dex)
+
+        Returns
+        -------
+        tuple
+            The Teff, logg and FeH indexes of the vertices
+            in the full grid and their weights
+        """
+        self.load_triangulation()
+
+        # Get the position along the full parameter axes
+        point = []
+        for name, val in zip(['Teff', 'logg', 'FeH'], [Teff, logg, FeH]):
+            rng = getattr(self, name+'_vals')
+            if val < rng[0] or val > rng[-1]:
+                raise ValueError('Value {} outside grid range {}-{}.'
+                                 .format(val, rng[0], rng[-1]))
+            vals = self.full[name+'_vals']
+            point.append(np.interp(val, vals, np.arange(len(vals))))
+
+        try:
+            verts, weights = utils.simplex_weights(self.tri, point,
+                                                   self.tri['tree'])
+        except ValueError:
+            raise IOError('No models surround the point.')
+
+        return tuple(self.tri['indices'][verts].T), weights
+
+    def simplex_groups(self, Teff, logg, FeH):
+        """
+        Find the simplex of existing models around each of many points
+        and group the points by simplex
+
+        Parameters
+        ----------
+        Teff: array-like
+            The effective temperatures (K)
+        logg: array-like
+            The logarithms of the surface gravity (dex)
+        FeH: array-like
+            The logarithms of the ratio of the metallicity
+            and solar metallicity (dex)
+
+        Returns
+        -------
+        tuple
+            The indexes of the points within the grid, the simplex of
+            each of them, the vertices of each simplex in the current
+            grid and the (n_points, n_vertices) array of weights
+        """
+        offset = [s.start for s in self.cube_slices()[:3]]
+        idx, group, corners, simplices = [], [], [], {}
+        weights = None
+        for n, point in enumerate(zip(Teff, logg, FeH)):
+            if not np.all(np.isfinite(point)):
+                continue
+            try:
+                verts, w = self.simplex_weights(*point)
+            except (ValueError, IOError):
+                continue
+
+            # Index the vertices in the current grid
+            verts = tuple(tuple(int(i-o) for i, o in zip(vert, offset))
+                          for vert in zip(*verts))
+            if verts not in simplices:
+                simplices[verts] = len(corners)
+                corners.append(list(verts))
+
+            if weights is None:
+                weights = np.zeros((len(Teff), len(w)))
+            weights[n] = w
+            idx.append(n)
+            group.append(simplices[verts])
+
+        if weights is None:
+            weights = np.zeros((len(Teff), 1))
+
+        return np.array(idx, dtype=int), np.array(group, dtype=int), \
+            corners, weights
+
+    def read_vertices(self, verts, flux=True, resolution=''):
+        """
+        Read the spectra of the given models of the full grid within
+        the current wavelength range
+
+        Parameters
+        ----------
+        verts: tuple
+            The Teff, logg and FeH indexes of the models in the full grid
+        flux: bool
+            Read the flux arrays, or only the mu and r_eff values
+        resolution: int (optional)
+            Read the spectra from the level of the pyramid nearest
+            this resolution, if any, rather than the flux cube
+
+        Returns
+        -------
+        dict
+            The stacked flux, mu and r_eff arrays
+            and the wavelength array
+        """
+        if isinstance(self.flux, str):
+            self.load_flux()
+
+        # Read from the nearest level of the pyramid...
+        full = self.full
+        if resolution and self.pyramid:
+            R, W = self.nearest_level(resolution)
+            source = self.levels[R]
+
+        # ...or the full cube
+        else:
+            W = self.cube_slices()[-1]
+            source = full
+
+        spectra = []
+        for vert in zip(*verts) if flux else []:
+            scale = None if source['scale'] is None \
+                else source['scale'][vert]
+            spectra.append(utils.decode_flux(
+                source['flux'][vert+(slice(None), W)], scale))
+
+        return {'flux': np.array(spectra), 'scale': None,
+                'mu': source['mu'][verts], 'r_eff': full['r_eff'][verts],
+                'wavelength': source['wavelength'][W]}
+
+    def level_cube(self, resolution):
+        """
+        Get the flux cube of the level of the pyramid nearest the given
+        resolution within the current parameter and wavelength ranges
+
+        Parameters
+        ----------
+        resolution: int
+            The desired wavelength resolution (lambda/d_lambda)
+
+        Returns
+        -------
+        dict
+            The flux, scale, mu and r_eff arrays
+            and the wavelength array
+        """
+        if isinstance(self.flux, str):
+            self.load_flux()
+
+        R, W = self.nearest_level(resolution)
+        level = self.levels[R]
+        T, G, M, _ = self.cube_slices()
+        scale = level['scale']
+
+        return {'flux': level['flux'][T, G, M, :, W],
+                'scale': None if scale is None else scale[T, G, M],
+                'mu': level['mu'][T, G, M], 'r_eff': self.r_eff,
+                'wavelength': level['wavelength'][W]}
+
+    def read_cell(self, cell):
+        """
+        Read the spectra of the grid points of a cell from their model
+        files in parallel, without loading the flux cube
+
+        Parameters
+        ----------
+        cell: tuple
+            The slices of the cell along each grid axis
+
+        Returns
+        -------
+        dict
+            The flux, mu and r_eff arrays of the cell, which are zero
+            for missing models, and the wavelength array
+        """
+        # Get the grid points of the cell
+        axes = [vals[slc] for vals, slc in
+                zip([self.Teff_vals, self.logg_vals, self.FeH_vals], cell)]
+        sizes = tuple(len(a) for a in axes)
+        rows = [self.points.get(pt) for pt in product(*axes)]
+
+        # Read the models like the flux cache does, reading the
+        # wavelength axis of the first one only
+        self.wave_axis = (None, None)
+
+        def read(row):
+            if row is not None:
+                return self.read_model(self.data[row], self.cube_wave_rng,
+                                       self.resolution, same_axis=True)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as ex:
+            spectra = list(ex.map(read, rows))
+
+        if not any(spectra):
+            raise IOError('No models in the grid cell.')
+
+        # Trim the wavelength range
+        d = [spec for spec in spectra if spec][0]
+        w = d['wave']
+        i, j = w.searchsorted(self.wave_rng[0]), \
+            w.searchsorted(self.wave_rng[1], side='right')
+        W = slice(i, max(i, j))
+
+        # Stack the spectra
+        flux = np.zeros((len(rows),)+d['flux'][:, W].shape)
+        mu = np.zeros((len(rows),)+d['mu'].squeeze().shape)
+        r_eff = np.zeros(len(rows))
+        for n, spec in enumerate(spectra):
+            if spec:
+                flux[n] = _on_axis(spec, w)[:, W]
+                mu[n] = spec['mu'].squeeze()
+                try:
+                    r_eff[n] = float(spec['r_eff'])
+                except (TypeError, ValueError):
+                    r_eff[n] = np.nan
+
+        return {'flux': flux.reshape(sizes+flux.shape[1:]), 'scale': None,
+                'mu': mu.reshape(sizes+mu.shape[1:]),
+                'r_eff': r_eff.reshape(sizes), 'wavelength': w[W]}
+
+    def get_many(self, Teff, logg, FeH, chunk_size=None, method=None):
+        """
+        Retrieve the interpolated spectra for arrays of stellar
+        parameters, reading each neighboring grid spectrum only once
+
+        Parameters
+        ----------
+        Teff: array-like
+            The effective temperatures (K)
+        logg: array-like
+            The logarithms of the surface gravity (dex)
+        FeH: array-like
+            The logarithms of the ratio of the metallicity
+            and solar metallicity (dex)
+        chunk_size: int (optional)
+            Yield the results in chunks of this many stars
+            rather than all at once
+        method: str (optional)
+            The interpolation method, 'linear' or 'delaunay',
+            defaulting to that of the grid
+
+        Returns
+        -------
+        dict, generator
+            A dictionary of the parameter arrays, the (n_stars, mu,
+            wavelength) flux array, the (n_stars, mu) mu array, the
+            effective radii and the wavelength array, or a generator
+            of such dictionaries for each chunk. Points outside the
+            grid are NaN.
+        """
+        Teff, logg, FeH = [np.atleast_1d(np.asarray(v, dtype=float))
+                           for v in [Teff, logg, FeH]]
+
+        # Stream the results in chunks...
+        if chunk_size:
+            return (self.get_many(Teff[n: n+chunk_size],
+                                  logg[n: n+chunk_size],
+                                  FeH[n: n+chunk_size], method=method)
+                    for n in range(0, len(Teff), chunk_size))
+
+        # ...or interpolate them all at once
+        if isinstance(self.flux, str):
+            self.load_flux()
+
+        # Group the points by the simplex of existing models around them...
+        method = method or self.method
+        if method == 'delaunay':
+            idx, group, corners, weights = self.simplex_groups(Teff, logg,
+                                                               FeH)
+            sizes = weights.shape[1:]
+
+        # ...or by the grid cell around them
+        else:
+            params = [self.Teff_vals, self.logg_vals, self.FeH_vals]
+            lower, sizes, weights, inside = utils.grid_cells(
+                params, [Teff, logg, FeH])
+            idx, = np.where(inside)
+            cells, group = np.unique(lower[idx], axis=0, return_inverse=True)
+            group = np.asarray(group).ravel()
+            corners = [list(product(*[range(i, i+j) for i, j in
+                                      zip(cell, sizes)])) for cell in cells]
+
+        n_out = len(Teff)-len(idx)
+        if n_out:
+            print(n_out, 'of', len(Teff), 'models not in grid.')
+
+        # Make the output arrays
+        n_mu, n_wave = self.flux.shape[-2:]
+        dtype = np.result_type(self.precision, np.float32)
+        flux = np.full((len(Teff), n_mu, n_wave), np.nan, dtype=dtype)
+        mu = np.full((len(Teff),)+self.mu.shape[3:], np.nan)
+        r_eff = np.full(len(Teff), np.nan)
+        unique = set(c for cs in corners for c in cs)
+        n_read = len(unique)
+
+        # Read the box around all the corners at once from a lazy cube
+        # if its best layout reads fewer bytes than one read per corner,
+        # e.g. a narrow wavelength bin from the wavelength-major copy
+        box = None
+        if isinstance(self.flux, LazyFlux) and method != 'delaunay' and \
+                len(cells):
+            lo = cells.min(axis=0)
+            slc = tuple(slice(i, j) for i, j in
+                        zip(lo, cells.max(axis=0)+np.array(sizes)))
+            view = self.flux[slc]
+            if view.read_bytes(view.layout) < \
+                    sum(self.flux[c].read_bytes() for c in unique):
+                box = slc
+                n_read = view.size//(n_mu*n_wave)
+
+        # Read each neighboring spectrum once per wavelength block
+        blocks = utils.wave_blocks(n_wave, 8*n_mu*n_read, self.max_memory)
+        for W in blocks:
+            spectra = {}
+            if box is not None:
+                slab = np.asarray(self.flux[box+(slice(None), W)])
+                for corner in unique:
+                    spectra[corner] = utils.decode_flux(
+                        slab[tuple(np.subtract(corner, lo))],
+                        None if self.scale is None else self.scale[corner])
+
+            for n in range(len(corners)):
+                for corner in corners[n]:
+                    if corner not in spectra:
+                        scale = None if self.scale is None \
+                            else self.scale[corner]
+                        spectra[corner] = utils.decode_flux(
+                            self.flux[corner+(slice(None), W)], scale)
+                slab = np.array([spectra[c] for c in corners[n]])
+                slab = slab.reshape(sizes+slab.shape[1:])
+
+                # Blend the slab for all points in the cell
+                pts = idx[group == n]
+                w = weights[pts].astype(dtype)
+                flux[pts, :, W] = np.tensordot(w, slab, axes=len(sizes))
+
+        # Blend the mu and r_eff values
+        for n in range(len(corners)):
+            pts = idx[group == n]
+            w = weights[pts]
+            vals = np.array([self.mu[c] for c in corners[n]])
+            mu[pts] = np.tensordot(w, vals.reshape(sizes+vals.shape[1:]),
+                                   axes=len(sizes))
+            vals = np.array([self.r_eff[c] for c in corners[n]])
+            r_eff[pts] = np.tensordot(w, vals.reshape(sizes),
+                                      axes=len(sizes))
+
+        return {'Teff': Teff, 'logg': logg, 'FeH': FeH, 'mu': mu,
+                'r_eff': r_eff, 'flux': flux, 'wave': self.wavelength}
+
+    def state_key(self):
+        """
+        The customization state which determines the retrieved spectra
+
+        Returns
+        -------
+        tuple
+            The hashable wavelength range, resolution, units, number
+            of bins and parameter axes
+        """
+        return (tuple(np.asarray(self.wave_rng, dtype=float)),
+                str(self.resolution), str(self.wl_units), self.n_bins,
+                tuple(self.Teff_vals), tuple(self.logg_vals),
+                tuple(self.FeH_vals))
+
+    def cache_get(self, key):
+        """
+        Retrieve a spectrum from the cache and mark it as recently used
+
+        Parameters
+        ----------
+        key: tuple
+            The parameters and state of the spectrum
+
+        Returns
+        -------
+        dict
+            A copy of the cached dictionary, or None
+        """
+        with self.cache_lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.cache_stats['hits'] += 1
+                return dict(self.cache[key])
+
+            self.cache_stats['misses'] += 1
+
+    def cache_put(self, key, spec_dict):
+        """
+        Add a spectrum to the cache, evicting the least recently used
+        spectra beyond the cache size
+
+        Parameters
+        ----------
+        key: tuple
+            The parameters and state of the spectrum
+        spec_dict: dict
+            The spectrum to cache
+        """
+        if self.cache_size > 0:
+            with self.cache_lock:
+                self.cache[key] = dict(spec_dict)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+    def cache_info(self):
+        """
+        Get the cache statistics
+
+        Returns
+        -------
+        dict
+            The number of hits, misses and cached spectra and the
+            maximum cache size
+        """
+        with self.cache_lock:
+            return dict(self.cache_stats, size=len(self.cache),
+                        maxsize=self.cache_size)
+
+    def clear_cache(self):
+        """
+        Empty the cache, which a grid shares with its views, and reset
+        its statistics
+        """
+        with self.cache_lock:
+            self.cache.clear()
+            self.cache_stats.update(hits=0, misses=0)
+
+    def index_points(self):
+        """
+        Make the hashed lookups of the table row of each (Teff, logg, FeH)
+        grid point and of the position of each value along its axis
+        """
+        self.points = {pt: n for n, pt in enumerate(zip(self.data['Teff'],
+                                                         self.data['logg'],
+                                                         self.data['FeH']))}
+        self.positions = {name: {v: n for n, v in
+                                 enumerate(getattr(self, name+'_vals'))}
+                          for name in ['Teff', 'logg', 'FeH']}
+
+    @_locked
+    def load_flux(self, reset=False):
+        """
+        Retrieve the flux arrays for all models
+        and load into the ModelGrid.array attribute
+        with shape (Teff, logg, FeH, mu, wavelength)
+        """
+        if reset:
+
+            # Delete the old file and clear the flux attribute
+            if isinstance(self.full['flux'], LazyFlux):
+                self.full['flux'].close()
+            if self.attached:
+                self.detach()
+            self.delete_cache()
+            self.emulator = {}
+            self.tri = {}
+            self.full['flux'] = self.flux = ''
+
+        if isinstance(self.full['flux'], str):
+
+            print('Loading flux into table...')
+
+            # Attach to the flux cube in shared memory...
+            if self.shared:
+                self.attach()
+                self.slice_cube()
+                return
+
+            # ...or build the cache if necessary
+            self.make_cache()
+
+            if os.path.isfile(self.flux_file):
+
+                # Load the axes and auxiliary arrays from the HDF5 file
+                f = h5py.File(self.flux_file, "r")
+                for name in ['wavelength', 'mu', 'r_eff']:
+                    self.full[name] = f[name][:]
+                self.full['scale'] = f['scale'][:] if 'scale' in f else None
+
+                # Keep the flux open and read hyperslabs as needed...
+                nbytes = f['flux'].size*f['flux'].dtype.itemsize
+                if self.lazy or (self.max_memory and
+                                 nbytes > self.max_memory):
+                    self.full['flux'] = LazyFlux(f['flux'],
+                                                 wave_major=f.get('flux_wave'))
+
+                # ...or load the whole cube into memory
+                else:
+                    self.full['flux'] = f['flux'][:]
+                    f.close()
+
+                # Slice the full cube to the current ranges
+                self.slice_cube()
+
+        else:
+            print('Data already loaded.')
+
+    @property
+    def shared_dir(self):
+        """
+        The shared memory directory of the flux cache, named by a hash
+        of its path and model files so that every process using it finds
+        the same copy and a cache rebuilt for changed files is not
+        mistaken for the published one
+        """
+        root = '/dev/shm' if os.path.isdir('/dev/shm') \
+            else tempfile.gettempdir()
+        key = os.path.abspath(self.flux_file)+self.index_digest
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+        return os.path.join(root, 'model_grid_{}'.format(digest))
+
+    def publish(self):
+        """
+        Copy the flux cache, with the mu, r_eff and axis arrays, to
+        memory-mapped files in the shared memory directory. The list of
+        attached processes is written last to mark it complete.
+        """
+        self.make_cache()
+        directory = self.shared_dir
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        print('Publishing', self.flux_file, 'to', directory)
+        with h5py.File(self.flux_file, "r") as f:
+            for name in SHARED_ARRAYS:
+                if name in f:
+                    ds = f[name]
+                    mmap = np.lib.format.open_memmap(
+                        os.path.join(directory, name+'.npy'), mode='w+',
+                        dtype=ds.dtype, shape=ds.shape)
+                    ds.read_direct(mmap)
+                    mmap.flush()
+                    del mmap
+
+        with open(os.path.join(directory, 'refs.json'), 'w') as f:
+            json.dump([], f)
+
+    def attach(self):
+        """
+        Open the read-only memory maps of the shared flux cube without
+        copying it, publishing it first if necessary, and count this
+        process among its users until it detaches, is garbage collected
+        or exits. A process killed before it can detach is dropped by
+        the next process to attach or detach.
+        """
+        directory = self.shared_dir
+        refs = os.path.join(directory, 'refs.json')
+        with utils.file_lock(directory+'.lock'):
+
+            # Publish the cube if no process has yet
+            if not os.path.isfile(refs):
+                self.publish()
+
+            # Add this process to the living users
+            with open(refs) as f:
+                pids = [pid for pid in json.load(f) if _process_alive(pid)]
+            pids.append(os.getpid())
+            with open(refs, 'w') as f:
+                json.dump(pids, f)
+
+            # Open the memory maps
+            for name in SHARED_ARRAYS:
+                filename = os.path.join(directory, name+'.npy')
+                if os.path.isfile(filename):
+                    self.full[name] = np.load(filename, mmap_mode='r')
+                elif name == 'scale':
+                    self.full[name] = None
+
+        # Release the cube even if this process never detaches
+        self._shared_finalizer = weakref.finalize(
+            self, _release_shared, directory, os.getpid())
+        self.attached = True
+
+    def detach(self):
+        """
+        Release the shared flux cube, removing it if no other
+        process is using it
+        """
+        if self._shared_finalizer is not None:
+            self._shared_finalizer()
+        else:
+            _release_shared(self.shared_dir, os.getpid())
+        self._shared_finalizer = None
+
+        self.full['flux'] = self.flux = ''
+        self.attached = False
+
+    def make_cache(self, resolution=None):
+        """
+        Build the HDF5 flux cache for the given resolution unless an
+        up to date one exists. The build is done under a lock so that
+        concurrent processes with the same settings share one file.
+
+        Parameters
+        ----------
+        resolution: int (optional)
+            The wavelength resolution of the cache, defaulting to
+            the grid resolution
+        """
+        filename = self.cache_file(resolution)
+        if not os.path.isfile(filename) or \
+                not self.check_cache(filename, resolution):
+            # The cube store cannot be rebuilt from model files
+            if filename == self.store:
+                raise IOError('{} does not match the grid settings.'
+                              .format(self.store))
+
+            with utils.file_lock(filename+'.lock', remove=True):
+
+                # Remove a cache written by an older version or for
+                # model files which have changed since
+                if os.path.isfile(filename) and \
+                        not self.check_cache(filename, resolution):
+                    print('Rebuilding out of date cache', filename)
+                    os.remove(filename)
+
+                # Build it unless another process just did
+                if not os.path.isfile(filename):
+                    self.build_flux(resolution)
+
+    def build_flux(self, resolution=None):
+        """
+        Build the HDF5 flux cache by reading the model files in parallel
+        and writing each spectrum to a pre-allocated dataset as it
+        arrives, so only a few spectra are held in memory at once.
+        An interrupted build is resumed from the partial file.
+        A resampled cache is made from the native resolution cache
+        instead if it exists.
+
+        Parameters
+        ----------
+        resolution: int (optional)
+            The wavelength resolution of the cache, defaulting to
+            the grid resolution
+        """
+        if resolution is None:
+            resolution = self.resolution
+
+        # Resample the native resolution cube or the cube store
+        # if there is one
+        native = self.cache_file('')
+        if resolution and os.path.isfile(native) and \
+                self.check_cache(native, ''):
+            self.resample_flux(resolution, native)
+            return
+        if self.store:
+            self.resample_flux(resolution, self.store)
+            return
+
+        filename = self.cache_file(resolution)
+        part_file = filename+'.part'
+        full = self.full
+        T, G, M = full['Teff_vals'], full['logg_vals'], full['FeH_vals']
+        shp = (len(T), len(G), len(M))
+        points = [(nt, ng, nm) for nt in range(shp[0])
+                  for ng in range(shp[1]) for nm in range(shp[2])]
+
+        # Read the wavelength axis of the first model only, since the
+        # cube has one
+        self.wave_axis = (None, None)
+
+        def read(point):
+            row = full['points'].get((T[point[0]], G[point[1]], M[point[2]]))
+            if row is None:
+                return
+            try:
+                return self.read_model(full['data'][row], self.cube_wave_rng,
+                                       resolution, same_axis=True)
+            except IOError:
+                return
+
+        # Resume a partial build with the same settings, starting over
+        # if the build was killed before the file could be closed...
+        f = None
+        if os.path.isfile(part_file):
+            try:
+                if self.check_cache(part_file, resolution):
+                    f = h5py.File(part_file, "r+")
+                    f['done'][:]
+                    print('Resuming build of', filename)
+            except (OSError, KeyError):
+                print('Could not resume build from', part_file)
+                if f is not None:
+                    f.close()
+                    f = None
+            if f is None:
+                os.remove(part_file)
+
+        # ...or allocate the datasets using the first model
+        first = None
+        if f is None:
+            for point in points:
+                d = read(point)
+                if d:
+                    break
+            else:
+                print('No models could be read from', self.path)
+                return
+
+            n_mu, n_wave = d['flux'].shape
+            f = h5py.File(part_file, "w")
+            self.create_flux(f, shp+(n_mu, n_wave))
+            f.create_dataset('mu', shape=shp+d['mu'].squeeze().shape,
+                             dtype=float)
+            f.create_dataset('r_eff', shape=shp, dtype=float)
+            f.create_dataset('done', shape=shp, dtype=bool)
+
+            # Store the axes and settings so a warm start needs no FITS files
+            f.create_dataset('wavelength', data=d['wave'])
+            for name in ['Teff_vals', 'logg_vals', 'FeH_vals']:
+                f.create_dataset(name, data=full[name])
+            for key, val in self.cache_meta(resolution).items():
+                f.attrs[key] = val
+            first = (point, d)
+            del d
+
+        # Write each spectrum straight to disk
+        wave = f['wavelength'][:]
+
+        def write(point, d):
+            if d:
+                flux, scale = utils.encode_flux(_on_axis(d, wave),
+                                                self.precision)
+                f['flux'][point] = flux
+                if scale is not None:
+                    f['scale'][point] = scale
+                f['mu'][point] = d['mu'].squeeze()
+                try:
+                    f['r_eff'][point] = float(d['r_eff'])
+                except (TypeError, ValueError):
+                    f['r_eff'][point] = np.nan
+
+            f['done'][point] = True
+
+        # Keep the first model rather than reading it again
+        if first is not None:
+            write(*first)
+            first = None
+
+        # Read the remaining models with a bounded number in flight,
+        # skipping the grid points which have no model file
+        done = f['done'][:]
+        todo = [p for p in points if not done[p] and
+                (T[p[0]], G[p[1]], M[p[2]]) in full['points']][::-1]
+        n, N = len(points)-len(todo), len(points)
+        workers = max(1, self.workers)
+        pending = {}
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            while todo or pending:
+                while todo and len(pending) < 2*workers:
+                    point = todo.pop()
+                    pending[ex.submit(read, point)] = point
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    write(pending.pop(fut), fut.result())
+
+                    # Print update
+                    n += 1
+                    msg = "{: .2f}% complete.".format(n*100./N)
+                    print(msg, end='\r')
+
+                f.flush()
+
+        # Move the finished cube into place
+        self.transpose_flux(f)
+        f.close()
+        os.replace(part_file, filename)
+        print("100.00 percent complete!", end='\n')
+
+    def resample_flux(self, resolution, source):
+        """
+        Build the HDF5 flux cache at the given resolution, mu grid and
+        wavelength units by resampling each spectrum of a native
+        resolution cache
+
+        Parameters
+        ----------
+        resolution: int
+            The wavelength resolution (lambda/d_lambda)
+        source: str
+            The native resolution cache or cube store to resample
+        """
+        filename = self.cache_file(resolution)
+        part_file = filename+'.part'
+        if resolution:
+            print('Resampling flux cube to R =', resolution)
+        elif self.mu_grid is not None:
+            print('Resampling flux cube to', len(self.mu_grid), 'mu values')
+        else:
+            print('Copying flux cube from', source)
+
+        with h5py.File(source, "r") as src, \
+                h5py.File(part_file, "w") as f:
+
+            # Make the new wavelength axis in the grid units
+            unit = q.Unit(str(src.attrs['wl_units']))
+            wave = src['wavelength'][:]*unit.to(self.wl_units)
+            matrix = None
+            if resolution:
+                wave, matrix = utils.resample_matrix(wave, resolution)
+
+            # Resample the mu axis too unless it is already the mu grid
+            shp = src['flux'].shape[:3]
+            mu = src['mu'][:]
+            remu = self.mu_grid is not None and \
+                (mu.shape[3:] != self.mu_grid.shape or
+                 not np.array_equal(mu, np.broadcast_to(self.mu_grid,
+                                                        mu.shape)))
+            if remu:
+                mu = np.broadcast_to(self.mu_grid, shp+self.mu_grid.shape)
+
+            self.create_flux(f, mu.shape+(len(wave),))
+            f.create_dataset('wavelength', data=wave)
+            f.create_dataset('mu', data=mu)
+
+            # Copy the other arrays and store the settings
+            for name in ['r_eff', 'done', 'Teff_vals', 'logg_vals',
+                         'FeH_vals']:
+                src.copy(name, f)
+            for key, val in self.cache_meta(resolution).items():
+                f.attrs[key] = val
+
+            # Resample one spectrum at a time
+            for point in product(*[range(n) for n in shp]):
+                scale = src['scale'][point] if 'scale' in src else None
+                flux = utils.decode_flux(src['flux'][point], scale)
+                if remu:
+                    flux = utils.resample_mu(src['mu'][point], flux,
+                                             self.mu_grid)
+                if matrix is not None:
+                    flux = matrix.dot(flux.T).T
+                flux, scale = utils.encode_flux(flux, self.precision)
+                f['flux'][point] = flux
+                if scale is not None:
+                    f['scale'][point] = scale
+
+            self.transpose_flux(f)
+
+        # Move the finished cube into place
+        os.replace(part_file, filename)
+
+    def transpose_flux(self, f):
+        """
+        Copy the flux of a finished cache file to a wavelength-major
+        (wavelength, Teff, logg, FeH, mu) dataset, if the grid keeps one.
+        Each pass reads whole columns of the chunks of the cube, as many
+        as fit within the memory limit, so every chunk is read once.
+
+        Parameters
+        ----------
+        f: h5py.File
+            The open cache file
+        """
+        if not self.wave_major:
+            return
+
+        if 'flux_wave' in f:
+            del f['flux_wave']
+
+        flux = f['flux']
+        shape = flux.shape[-1:]+flux.shape[:-1]
+        chunks = utils.wave_chunks(shape, itemsize=flux.dtype.itemsize)
+        dest = f.create_dataset('flux_wave', shape=shape, dtype=flux.dtype,
+                                chunks=chunks, compression=self.compression,
+                                shuffle=bool(self.compression))
+
+        # Write several chunks of wavelengths per column of cube chunks
+        width = flux.chunks[-1] if flux.chunks else shape[0]
+        per_wave = flux.size//max(shape[0], 1)*flux.dtype.itemsize
+        width *= max(1, (self.max_memory or 2**28)//max(per_wave*width, 1))
+        for n in range(0, shape[0], width):
+            W = slice(n, n+width)
+            dest[W] = np.moveaxis(flux[..., W], -1, 0)
+
+    def create_flux(self, f, shape):
+        """
+        Create the flux dataset of a cache file in the storage type,
+        and the dataset of scale factors if the type is scaled
+
+        Parameters
+        ----------
+        f: h5py.File
+            The open cache file
+        shape: tuple
+            The (Teff, logg, FeH, mu, wavelength) shape of the cube
+        """
+        dtype = np.dtype(self.precision)
+        f.create_dataset('flux', shape=shape, dtype=dtype,
+                         chunks=utils.flux_chunks(shape,
+                                                  itemsize=dtype.itemsize),
+                         compression=self.compression,
+                         shuffle=bool(self.compression))
+        if dtype in utils.SCALED_TYPES:
+            f.create_dataset('scale', shape=shape[:-1], dtype=np.float32)
+
+    def build_pyramid(self):
+        """
+        Build the flux caches at each resolving power of the pyramid
+        from the native resolution cache, so the model files are read
+        only once for all the levels
+        """
+        if self.pyramid:
+            self.make_cache('')
+            for R in self.pyramid:
+                self.make_cache(R)
+
+    @_locked
+    def load_pyramid(self):
+        """
+        Build the pyramid if necessary and open each level, reading
+        the flux as needed if the grid is lazy
+        """
+        self.build_pyramid()
+        levels = {}
+        for R in self.pyramid:
+            f = h5py.File(self.cache_file(R), "r")
+            level = {name: f[name][:] for name in ['wavelength', 'mu']}
+            level['scale'] = f['scale'][:] if 'scale' in f else None
+
+            if self.lazy:
+                level['flux'] = LazyFlux(f['flux'],
+                                         wave_major=f.get('flux_wave'))
+            else:
+                level['flux'] = f['flux'][:]
+                f.close()
+
+            levels[R] = level
+
+        self.levels = levels
+
+    @property
+    def emulator_file(self):
+        """
+        The HDF5 file of the PCA emulator of the flux cache
+        """
+        return self.flux_file.replace('.hdf5', '_pca.hdf5')
+
+    def build_emulator(self, n_components=20, chunk_bytes=None):
+        """
+        Build the PCA emulator of the flux cache, i.e. the mean spectrum,
+        the leading principal components of the (mu, wavelength) spectra
+        and the weights of each grid point. The components are found from
+        the Gram matrix of the spectra, reading the cube in wavelength
+        chunks so that only the chunks are held in memory at once.
+
+        Parameters
+        ----------
+        n_components: int
+            The number of principal components to keep
+        chunk_bytes: int (optional)
+            The approximate size of each chunk of the cube, defaulting
+            to the memory limit or else 64 MB
+        """
+        if isinstance(self.full['flux'], str):
+            self.load_flux()
+
+        full = self.full
+        shp = full['flux'].shape
+        n_mu, n_wave = shp[-2:]
+        n_pts = shp[0]*shp[1]*shp[2]
+        scale = full['scale']
+
+        # Get the index of each populated grid point
+        axes = [full[name] for name in ['Teff_vals', 'logg_vals',
+                                         'FeH_vals']]
+        pts = np.array([np.ravel_multi_index(
+            [a.searchsorted(v) for a, v in zip(axes, pt)], shp[:3])
+            for pt in full['points']])
+        chunks = utils.wave_blocks(n_wave, 8*n_pts*n_mu,
+                                   chunk_bytes or self.max_memory or 2**26)
+
+        def read(chunk):
+            flux = utils.decode_flux(full['flux'][..., chunk], scale)
+            return np.asarray(flux, dtype=float).reshape(n_pts, -1)
+
+        print('Building PCA emulator with', n_components, 'components...')
+        start = time.time()
+
+        # Get the mean spectrum and Gram matrix of the populated points
+        mean = np.zeros((n_mu, n_wave))
+        gram = np.zeros((len(pts), len(pts)))
+        for chunk in chunks:
+            X = read(chunk)[pts]
+            m = X.mean(axis=0)
+            mean[:, chunk] = m.reshape(n_mu, -1)
+            X -= m
+            gram += X.dot(X.T)
+
+        # Keep the leading eigenvectors
+        vals, vecs = np.linalg.eigh(gram)
+        order = np.argsort(vals)[::-1][:n_components]
+        order = order[vals[order] > vals.max()*1E-12]
+        vals, vecs = vals[order], vecs[:, order]
+        k = len(vals)
+
+        # Make the components and the weights of each grid point,
+        # i.e. the projection of its spectrum onto the components
+        basis = np.zeros((k, n_mu, n_wave))
+        weights = np.zeros((n_pts, k))
+        for chunk in chunks:
+            X = read(chunk)-mean[:, chunk].ravel()
+            B = vecs.T.dot(X[pts])/np.sqrt(vals)[:, None]
+            basis[:, :, chunk] = B.reshape(k, n_mu, -1)
+            weights += X.dot(B.T)
+
+        # Calculate the reconstruction error relative to the peak
+        peak = np.zeros(n_pts)
+        max_err = np.zeros(n_pts)
+        sq_err = np.zeros(n_pts)
+        for chunk in chunks:
+            X = read(chunk)
+            diff = X-mean[:, chunk].ravel()-weights.dot(
+                basis[:, :, chunk].reshape(k, -1))
+            peak = np.maximum(peak, np.abs(X).max(axis=1))
+            max_err = np.maximum(max_err, np.abs(diff).max(axis=1))
+            sq_err += (diff**2).sum(axis=1)
+        rms_err = np.full(n_pts, np.nan)
+        rms_err[pts] = np.sqrt(sq_err[pts]/(n_mu*n_wave))/peak[pts]
+        max_err[pts] /= peak[pts]
+        max_err[np.isnan(rms_err)] = np.nan
+
+        # Write the emulator next to the flux cache
+        part_file = self.emulator_file+'.part'
+        with h5py.File(part_file, "w") as f:
+            f.create_dataset('mean', data=mean)
+            f.create_dataset('basis', data=basis)
+            f.create_dataset('weights', data=weights.reshape(shp[:3]+(k,)))
+            f.create_dataset('max_err', data=max_err.reshape(shp[:3]))
+            f.create_dataset('rms_err', data=rms_err.reshape(shp[:3]))
+            f.attrs['n_components'] = n_components
+            f.attrs['source_mtime'] = os.path.getmtime(self.flux_file)
+        os.replace(part_file, self.emulator_file)
+
+        print('Run time in seconds: ', time.time()-start)
+        print('Reconstruction error of {} components: '
+              'max {:.2e}, RMS {:.2e} of the peak intensity'
+              .format(k, np.nanmax(max_err), np.nanmax(rms_err)))
+
+    @_locked
+    def load_emulator(self, n_components=None):
+        """
+        Load the PCA emulator of the flux cache, building it if it is
+        missing, has a different number of components or is older than
+        the flux cache
+
+        Parameters
+        ----------
+        n_components: int (optional)
+            The number of principal components to keep, defaulting to
+            those of the stored emulator or else 20
+        """
+        if isinstance(self.full['flux'], str):
+            self.load_flux()
+
+        with utils.file_lock(self.emulator_file+'.lock', remove=True):
+
+            # Check the emulator matches the flux cache
+            current = False
+            if os.path.isfile(self.emulator_file):
+                with h5py.File(self.emulator_file, "r") as f:
+                    mtime = os.path.getmtime(self.flux_file)
+                    current = f.attrs['source_mtime'] == mtime and \
+                        n_components in (None, f.attrs['n_components'])
+
+            if not current:
+                self.build_emulator(n_components or 20)
+
+        with h5py.File(self.emulator_file, "r") as f:
+            self.emulator = {name: f[name][:] for name in f}
+
+    @property
+    def flux_file(self):
+        """
+        The HDF5 flux cache file for the current settings
+        """
+        return self.cache_file(self.resolution)
+
+    def cache_file(self, resolution=None):
+        """
+        The HDF5 flux cache file, named by a hash of the parameter axes,
+        wavelength range, resolution, units and storage type so that
+        different settings never overwrite each other
+
+        Parameters
+        ----------
+        resolution: int (optional)
+            The wavelength resolution of the cache, defaulting to
+            the grid resolution
+
+        Returns
+        -------
+        str
+            The path to the file
+        """
+        # The cube store is the native resolution cache
+        if resolution is None:
+            resolution = self.resolution
+        if self.store and not resolution and self.mu_grid is None and \
+                not self.wave_major and self.store_current():
+            return self.store
+
+        # The digest of the model files is checked rather than hashed,
+        # so that a changed file replaces the cache in place
+        meta = self.cache_meta(resolution)
+        meta.pop('index', None)
+        for name in ['Teff_vals', 'logg_vals', 'FeH_vals']:
+            meta[name] = self.full[name]
+
+        # Tell apart the caches of different cube stores
+        if self.store:
+            stat = os.stat(self.store)
+            meta['store'] = [os.path.abspath(self.store), stat.st_size,
+                             stat.st_mtime]
+
+        key = json.dumps({k: np.asarray(v).tolist() for k, v in meta.items()},
+                         sort_keys=True)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+        return '{}model_grid_flux_{}.hdf5'.format(self.path, digest)
+
+    def store_current(self):
+        """
+        Check whether the cube store matches the current settings, so
+        that it can be used as the native resolution cache. A store with
+        other wavelength units or an older version is converted to a
+        cache instead.
+
+        Returns
+        -------
+        bool
+            True if the store has the current version, wavelength range
+            and units and storage type
+        """
+        key = (str(self.wl_units), os.path.getmtime(self.store))
+        if self.store_check[0] != key:
+            self.store_check = (key, self.check_cache(self.store, ''))
+
+        return self.store_check[1]
+
+    def cache_meta(self, resolution=None):
+        """
+        The settings which determine the contents of the flux cache
+
+        Parameters
+        ----------
+        resolution: int (optional)
+            The wavelength resolution of the cache, defaulting to
+            the grid resolution
+
+        Returns
+        -------
+        dict
+            The cache version, wavelength range, resolution,
+            wavelength units, storage type and digest of the
+            model files
+        """
+        if resolution is None:
+            resolution = self.resolution
+
+        meta = {'version': CACHE_VERSION,
+                'wave_rng': np.asarray(self.cube_wave_rng, dtype=float),
+                'resolution': str(resolution),
+                'wl_units': str(self.wl_units),
+                'precision': self.precision}
+
+        # Rebuild the caches when a model file is added or changed
+        if self.index_digest:
+            meta['index'] = self.index_digest
+
+        # Only binning in log wavelength, a resampled mu axis or the
+        # wavelength-major copy changes the settings of older caches
+        if resolution:
+            meta['sampling'] = 'log'
+        if self.mu_grid is not None:
+            meta['mu_grid'] = self.mu_grid
+        if self.wave_major:
+            meta['wave_major'] = True
+
+        return meta
+
+    def delete_cache(self):
+        """
+        Delete the HDF5 flux cache and any partial build for the
+        current settings, but never the cube store
+        """
+        if self.flux_file == self.store:
+            return
+
+        with utils.file_lock(self.flux_file+'.lock', remove=True):
+            for file in [self.flux_file, self.flux_file+'.part']:
+                if os.path.isfile(file):
+                    os.remove(file)
+
+    def check_cache(self, filename='', resolution=None):
+        """
+        Check that the HDF5 flux cache matches the current grid
+
+        Parameters
+        ----------
+        filename: str (optional)
+            The cache file to check, defaulting to the flux file
+        resolution: int (optional)
+            The wavelength resolution of the cache, defaulting to
+            the grid resolution
+
+        Returns
+        -------
+        bool
+            True if the cache has the current version, settings and
+            parameter axes
+        """
+        with h5py.File(filename or self.flux_file, "r") as f:
+
+            # Compare the settings
+            for key, val in self.cache_meta(resolution).items():
+                if key not in f.attrs or \
+                        not np.array_equal(f.attrs[key], val):
+                    return False
+
+            # Compare the parameter axes
+            for name in ['Teff_vals', 'logg_vals', 'FeH_vals']:
+                if name not in f or \
+                        not np.array_equal(f[name][:], self.full[name]):
+                    return False
+
+        return True
+
+    def customize(self, Teff_rng=(2300, 8000), logg_rng=(0, 6),
+                  FeH_rng=(-2, 1), wave_rng=(0, 40), n_bins=''):
+        """
+        Trims the model grid by the given ranges in effective temperature,
+        surface gravity, and metallicity. Also sets the wavelength range
         and number of bins for retrieved model spectra.
 
         Parameters
@@ -511,67 +2654,87 @@ class ModelGrid(object):
             The number of bins for the wavelength axis
 
         """
-        # Make a copy of the grid
-        grid = self.data.copy()
-        self.wave_rng = wave_rng
+        # Filter the full grid by given parameters
+        grid = self.full['data']
         self.n_bins = n_bins or self.n_bins
-
-        # Filter grid by given parameters
-        self.data = grid[[(grid['Teff'] >= Teff_rng[0])
-                         & (grid['Teff'] <= Teff_rng[1])
-                         & (grid['logg'] >= logg_rng[0])
-                         & (grid['logg'] <= logg_rng[1])
-                         & (grid['FeH'] >= FeH_rng[0])
-                         & (grid['FeH'] <= FeH_rng[1])]]
+        data = grid[(grid['Teff'] >= Teff_rng[0])
+                    & (grid['Teff'] <= Teff_rng[1])
+                    & (grid['logg'] >= logg_rng[0])
+                    & (grid['logg'] <= logg_rng[1])
+                    & (grid['FeH'] >= FeH_rng[0])
+                    & (grid['FeH'] <= FeH_rng[1])]
 
         # Print a summary of the returned grid
-        print('{}/{}'.format(len(self.data), len(grid)),
+        print('{}/{}'.format(len(data), len(grid)),
               'spectra in parameter range',
               'Teff: ', Teff_rng, ', logg: ', logg_rng,
               ', FeH: ', FeH_rng, ', wavelength: ', wave_rng)
 
         # Do nothing if he cut leaves the grid empty
-        if len(self.data) == 0:
-            self.data = grid
+        if len(data) == 0:
             print('The given param ranges would leave 0 models in the grid.')
             print('The model grid has not been updated. Please try again.')
             return
 
-        # Update the wavelength and flux attributes
-        if isinstance(self.wavelength, np.ndarray):
-            w = self.wavelength
-            W_idx, = np.where((w >= wave_rng[0]) & (w <= wave_rng[1]))
-            T_idx, = np.where((self.Teff_vals >= Teff_rng[0]) &
-                              (self.Teff_vals <= Teff_rng[1]))
-            G_idx, = np.where((self.logg_vals >= logg_rng[0]) &
-                              (self.logg_vals <= logg_rng[1]))
-            M_idx, = np.where((self.FeH_vals >= FeH_rng[0]) &
-                              (self.FeH_vals <= FeH_rng[1]))
-
-            # Trim arrays
-            self.wavelength = w[W_idx]
-            self.flux = self.flux[T_idx[0]: T_idx[-1]+1,
-                                  G_idx[0]: G_idx[-1]+1,
-                                  M_idx[0]: M_idx[-1]+1,
-                                  :,
-                                  W_idx[0]: W_idx[-1]+1]
-            self.mu = self.mu[T_idx[0]: T_idx[-1]+1,
-                              G_idx[0]: G_idx[-1]+1,
-                              M_idx[0]: M_idx[-1]+1]
-            self.r_eff = self.r_eff[T_idx[0]: T_idx[-1]+1,
-                                    G_idx[0]: G_idx[-1]+1,
-                                    M_idx[0]: M_idx[-1]+1]
-
-        # Update the parameter attributes
-        self.Teff_vals = np.unique(self.data['Teff'])
-        self.logg_vals = np.unique(self.data['logg'])
-        self.FeH_vals = np.unique(self.data['FeH'])
-
-        # Reload the flux array with the new grid parameters
-        self.load_flux(reset=True)
-
-        # Clear the grid copy from memory
-        del grid
+        # Update the parameter attributes with the contiguous
+        # ranges of the full axes
+        self.data = data
+        self.Teff_rng, self.logg_rng, self.FeH_rng = Teff_rng, logg_rng, \
+            FeH_rng
+        self.wave_rng = wave_rng
+        for name in ['Teff', 'logg', 'FeH']:
+            vals = self.full[name+'_vals']
+            vals = vals[(vals >= min(data[name])) & (vals <= max(data[name]))]
+            setattr(self, name+'_vals', vals)
+        self.index_points()
+
+        # Point the flux arrays at the new slice of the cached cube
+        self.slice_cube()
+
+    def slice_cube(self):
+        """
+        Point the flux, mu, r_eff and wavelength attributes at the
+        slices of the full cube within the current parameter and
+        wavelength ranges, without copying or rereading the cube
+        """
+        full = self.full
+        if isinstance(full['flux'], str):
+            return
+
+        # Make the views
+        T, G, M, W = self.cube_slices()
+        self.wavelength = full['wavelength'][W]
+        self.flux = full['flux'][T, G, M, :, W]
+        self.scale = None if full['scale'] is None else full['scale'][T, G, M]
+        self.mu = full['mu'][T, G, M]
+        self.r_eff = full['r_eff'][T, G, M]
+
+    def cube_slices(self):
+        """
+        Get the slices of the full cube within the current parameter
+        and wavelength ranges
+
+        Returns
+        -------
+        tuple
+            The Teff, logg, FeH and wavelength slices
+        """
+        full = self.full
+
+        # Get the slice of each parameter axis
+        slc = []
+        for name in ['Teff_vals', 'logg_vals', 'FeH_vals']:
+            vals = getattr(self, name)
+            i = full[name].searchsorted(vals[0])
+            slc.append(slice(i, i+len(vals)))
+
+        # Get the slice of the wavelength axis
+        w = full['wavelength']
+        i, j = w.searchsorted(self.wave_rng[0]), \
+            w.searchsorted(self.wave_rng[1], side='right')
+        slc.append(slice(i, max(i, j)))
+
+        return tuple(slc)
 
     def info(self):
         """
@@ -590,20 +2753,181 @@ class ModelGrid(object):
         table.sort('Attributes')
         table.pprint(max_width=-1, align=['>', '<'])
 
-    def reset(self):
+    def start_pool(self):
         """
-        Reset the current grid to the original state
+        Start the worker pool and share the full flux cube with the
+        workers through a memory-mapped file rather than pickled copies.
+        The workers read the published cube of a shared grid. Otherwise
+        the cube is moved to a file which this process maps as well, so
+        it is only held once. Views use the pool of the grid they were
+        made from.
+
+        Returns
+        -------
+        ModelGrid
+            The grid which owns the pool
+        """
+        # Slice the view from the mapped cube too
+        if self.parent is not None:
+            owner = self.parent.start_pool()
+            self.slice_cube()
+            return owner
+
+        with self.lock:
+            flux = self.full['flux']
+            if isinstance(flux, LazyFlux):
+                raise ValueError('The worker pool needs the flux cube in '
+                                 'memory, not a lazy grid.')
+
+            # Map the full flux cube if it changed
+            if flux is not self._pool_flux:
+
+                # Shut down the pool of the stale memory map
+                if self._pool_finalizer is not None:
+                    self._pool_finalizer()
+                    self.pool = None
+
+                # Use the cube published to shared memory...
+                if self.attached:
+                    self.pool_file = os.path.join(self.shared_dir,
+                                                  'flux.npy')
+                    owned = ''
+
+                # ...or move the cube to a file and map it in its place
+                else:
+                    fd, self.pool_file = tempfile.mkstemp(
+                        suffix='.npy', prefix='model_grid_')
+                    os.close(fd)
+                    mmap = np.lib.format.open_memmap(
+                        self.pool_file, mode='w+', dtype=flux.dtype,
+                        shape=flux.shape)
+                    bytes_per_wave = flux.size//max(flux.shape[-1], 1) * \
+                        flux.dtype.itemsize
+                    for W in utils.wave_blocks(flux.shape[-1],
+                                               bytes_per_wave,
+                                               self.max_memory or 2**28):
+                        mmap[..., W] = flux[..., W]
+                    mmap.flush()
+                    del mmap, flux
+                    self.full['flux'] = np.load(self.pool_file,
+                                                mmap_mode='r')
+                    self.slice_cube()
+                    owned = self.pool_file
+
+                self._pool_flux = self.full['flux']
+                self._pool_owned = owned
+
+            # Start the pool if it is not running, and make sure it is
+            # shut down and the file removed even if the grid is never
+            # closed
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.processes)
+                self._pool_finalizer = weakref.finalize(
+                    self, _close_pool, self.pool, self._pool_owned,
+                    os.getpid())
+
+        return self
+
+    def view(self, **kwargs):
         """
-        file = os.path.join(self.path+'model_grid_flux.hdf5')
+        Make a view of the grid for one thread, task or request. The
+        view shares the table, axes and flux cube of this grid, which
+        are never changed once loaded, but has its own ranges and bins.
+        It also shares the cache of recent spectra, whose keys include
+        the ranges, so a view made for each request finds the spectra
+        retrieved through earlier views. Many threads can then read from
+        one loaded grid at once, each customizing its own view, without
+        a lock around every call, e.g.
+
+            with ThreadPoolExecutor() as ex:
+                ex.map(lambda p: model_grid.view().get(*p), params)
 
-        if os.path.isfile(file):
-            os.remove(file)
+        Parameters
+        ----------
+        kwargs: dict
+            The ranges and number of bins, as in customize(),
+            defaulting to the current ones of this grid
 
-        self.__init__(self.path)
+        Returns
+        -------
+        ModelGrid
+            The view
+        """
+        # Load the arrays the views share first
+        if isinstance(self.full['flux'], str):
+            self.load_flux()
+        if self.pyramid and not self.levels:
+            self.load_pyramid()
+
+        # Copy the attributes which change per view
+        view = copy.copy(self)
+        view.lock = threading.RLock()
+        view.parent = self.parent or self
+        view.tri = {}
+        view.slice_cube()
+
+        # Narrow or widen the current ranges of this grid
+        if kwargs:
+            ranges = {name: getattr(self, name) for name in
+                      ['Teff_rng', 'logg_rng', 'FeH_rng', 'wave_rng']}
+            ranges.update(kwargs)
+            view.customize(**ranges)
+
+        return view
+
+    def close(self):
+        """
+        Shut down the worker pool and remove the shared flux file,
+        and release the flux cube, unless this is a view of another
+        grid which owns them
+        """
+        if self.parent is not None:
+            return
+
+        # Load the flux cube back from the file the pool used
+        if self._pool_owned and self.full['flux'] is self._pool_flux:
+            self.full['flux'] = np.array(self.full['flux'])
+            self.slice_cube()
+
+        if self._pool_finalizer is not None:
+            self._pool_finalizer()
+        self._pool_finalizer = None
+        self.pool = None
+        self.pool_file = ''
+        self._pool_flux = None
+        self._pool_owned = ''
+
+        # Release the shared flux cube
+        if self.attached:
+            self.detach()
+
+        # Close the HDF5 files of a lazy flux cube and pyramid
+        if isinstance(self.full['flux'], LazyFlux):
+            self.full['flux'].close()
+            self.full['flux'] = self.flux = ''
+        for level in self.levels.values():
+            if isinstance(level['flux'], LazyFlux):
+                level['flux'].close()
+        self.levels = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def reset(self):
+        """
+        Reset the current grid to the original state
+        """
+        self.close()
+        self.delete_cache()
+        self.__init__(self.store or self.path)
 
     def set_units(self, wl_units=q.um):
         """
-        Set the wavelength and flux units
+        Set the wavelength and flux units, converting the wavelength
+        ranges and loading the flux cube again in the new units
 
         Parameters
         ----------
@@ -614,5 +2938,64 @@ class ModelGrid(object):
         old_unit = self.wl_units
         self.wl_units = q.Unit(wl_units)
 
-        # Update the wavelength
-        self.const = (old_unit/self.wl_units).decompose()._scale
+        # Convert the wavelengths of the model files from Angstroms
+        self.const = q.AA.to(self.wl_units)
+
+        # Convert the wavelength ranges
+        factor = old_unit.to(self.wl_units)
+        if factor == 1:
+            return
+        self.wave_rng = tuple(np.asarray(self.wave_rng, dtype=float)*factor)
+        self.cube_wave_rng = tuple(np.array([0., 40.])*q.um.to(self.wl_units))
+
+        # Load the flux cube and the pyramid, emulator and triangulation
+        # made from it again in the new units, leaving those of the grid
+        # of a view alone
+        if not isinstance(self.full['flux'], str):
+            if self.parent is None:
+                self.close()
+            else:
+                self.full = dict(self.full)
+            self.full['flux'] = self.flux = ''
+            self.levels, self.emulator, self.tri = {}, {}, {}
+
+
+def compare_grids(reference, grid, Teff, logg, FeH):
+    """
+    Compare the interpolated intensities of a grid, e.g. one stored in
+    reduced precision, with those of a reference grid of the same models
+
+    Parameters
+    ----------
+    reference: ModelGrid
+        The reference grid
+    grid: ModelGrid
+        The grid to compare
+    Teff: array-like
+        The effective temperatures (K)
+    logg: array-like
+        The logarithms of the surface gravity (dex)
+    FeH: array-like
+        The logarithms of the ratio of the metallicity
+        and solar metallicity (dex)
+
+    Returns
+    -------
+    astropy.table.Table
+        The maximum error relative to the peak intensity of each mu
+        value and the RMS relative error at each point
+    """
+    ref = reference.get_many(Teff, logg, FeH)
+    new = grid.get_many(Teff, logg, FeH)
+
+    # Get the errors relative to the peak and to each intensity
+    diff = np.abs(new['flux']-ref['flux'])
+    peak = np.abs(ref['flux']).max(axis=-1)[..., None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        max_err = np.nanmax(np.where(peak > 0, diff/peak, np.nan),
+                            axis=(1, 2))
+        rel = np.where(ref['flux'] != 0, diff/np.abs(ref['flux']), np.nan)
+        rms_err = np.sqrt(np.nanmean(rel**2, axis=(1, 2)))
+
+    return at.Table([ref['Teff'], ref['logg'], ref['FeH'], max_err, rms_err],
+                    names=['Teff', 'logg', 'FeH', 'max_err', 'rms_err'])
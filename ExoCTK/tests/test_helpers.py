@@ -0,0 +1,142 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Tests of the ATLAS9 model conversion
+"""
+import os
+
+import astropy.constants as ac
+import astropy.units as q
+import h5py
+import numpy as np
+from astropy.io import ascii
+
+from .. import helpers, modelgrid
+
+
+def write_ATLAS9(filename, models=((3500, 4.0, -0.5), (4000, 4.5, 0.)),
+                 n_wave=40, n_mu=5):
+    """
+    Write a small file in the fixed width format of the ATLAS9 models
+    """
+    rng = np.random.RandomState(0)
+    mus = np.linspace(1, 0.1, n_mu)
+    lines = []
+    for Teff, logg, FeH in models:
+        lines.append('TEFF  {}.  GRAVITY {:.5f} LTE TITLE [{:+.1f}] VTURB '
+                     '2.0 L/H X 1.25\n'.format(Teff, logg, FeH))
+        lines.append(' header\n')
+        lines.append(' '.join('{:.3f}'.format(mu) for mu in mus)+'\n')
+        for n in range(n_wave):
+            lines.append('{:9.2f} {:9.3E}'.format(100.+20*n,
+                                                  rng.uniform(1, 9)*1E-5))
+            lines.append(''.join('{:6d}'.format(rng.randint(1, 99999))
+                                 for _ in range(n_mu-1))+'\n')
+        lines += ['trailer\n']*4
+    lines.append('end\n')
+
+    with open(filename, 'w') as f:
+        f.write(''.join(lines))
+
+
+def old_parse(lines, idx, end):
+    """
+    The line by line parse of a block which parse_ATLAS9 replaced
+    """
+    data = lines[idx+3:end-4]
+    for n, l in enumerate(data):
+        data[n] = l[:19]+' '+' '.join([l[i:i+6]
+                                       for i in np.arange(19, len(l), 6)])
+    cols = ['wl']+lines[idx+2].strip().split()
+    data = ascii.read(data, names=cols)
+    cube = np.array([data[cols][n] for n in cols[1:]])[::-1]
+    cube[:-1] *= cube[-1]
+    cube[-1] *= 1E5
+    cube = cube*q.erg/q.cm**2/q.s/q.steradian/q.Hz
+    wave = np.array(data['wl'])*q.nm.to(q.AA)
+    cube = cube*ac.c/(wave**2)*q.steradian/q.cm**2
+
+    return wave, cube.to(q.erg/q.s/q.cm**3).value*1E16
+
+
+def test_parse_ATLAS9(tmpdir):
+    """
+    Test that the blocks parse to the same models as the old parser
+    """
+    filename = os.path.join(str(tmpdir), 'atlas9.dat')
+    write_ATLAS9(filename)
+    with open(filename) as f:
+        lines = f.readlines()
+    start = [n for n, l in enumerate(lines) if l.startswith('TEFF')]
+
+    blocks = list(helpers.ATLAS9_blocks(filename))
+    assert len(blocks) == 2
+    for n, block in enumerate(blocks):
+        end = start[n+1] if n+1 < len(start) else -1
+        wave, flux = old_parse(lines, start[n], end)
+        model = helpers.parse_ATLAS9(block)
+        assert np.allclose(model['wave'], wave)
+        assert np.allclose(model['flux'], flux, rtol=1E-12)
+        assert np.allclose(model['mu'], np.linspace(0.1, 1, 5))
+
+    assert (model['Teff'], model['logg'], model['FeH']) == (4000, 4.5, 0.)
+    assert helpers.ATLAS9_filename(model) == 'ATLAS9_4000_45_p00.fits'
+
+
+def test_convert_ATLAS9_cube(tmpdir):
+    """
+    Test that the cube store holds the parsed models and serves the
+    same spectra as the FITS files converted from them
+    """
+    filename = os.path.join(str(tmpdir), 'atlas9.dat')
+    write_ATLAS9(filename)
+    cube_file = os.path.join(str(tmpdir), 'cube.hdf5')
+    fits_dir = str(tmpdir.mkdir('fits'))+'/'
+    helpers.convert_ATLAS9_cube(filename, cube_file, fits_dir=fits_dir,
+                                template='', workers=2)
+    models = [helpers.parse_ATLAS9(block)
+              for block in helpers.ATLAS9_blocks(filename)]
+
+    with h5py.File(cube_file, 'r') as f:
+        assert f['flux'].shape == (2, 2, 2, 5, 40)
+        assert np.array_equal(f['done'][:].nonzero(), [[0, 1]]*3)
+        assert np.allclose(f['wavelength'][:], models[0]['wave']/1E4)
+        for n, model in enumerate(models):
+            assert np.array_equal(f['flux'][n, n, n], model['flux'])
+            assert np.array_equal(f['mu'][n, n, n], model['mu'])
+
+    # The store and the FITS files give the same spectra
+    store = modelgrid.ModelGrid(cube_file)
+    files = modelgrid.ModelGrid(fits_dir)
+    for model in models:
+        params = (model['Teff'], model['logg'], model['FeH'])
+        spec = store.get(*params)
+        assert np.allclose(spec['wave'], model['wave']/1E4)
+        assert np.array_equal(spec['flux'], model['flux'])
+        assert np.allclose(files.get(*params)['flux'], spec['flux'])
+    assert store.flux_file == cube_file
+
+
+def test_store_units(tmpdir):
+    """
+    Test that a cube store opened in other wavelength units is converted
+    to a cache rather than used or refused
+    """
+    filename = os.path.join(str(tmpdir), 'atlas9.dat')
+    write_ATLAS9(filename)
+    cube_file = os.path.join(str(tmpdir), 'cube.hdf5')
+    helpers.convert_ATLAS9_cube(filename, cube_file, template='')
+    model = next(helpers.parse_ATLAS9(block)
+                 for block in helpers.ATLAS9_blocks(filename))
+    params = (model['Teff'], model['logg'], model['FeH'])
+
+    model_grid = modelgrid.ModelGrid(cube_file, wl_units=q.nm,
+                                     wave_rng=(0, 4E4))
+    assert model_grid.flux_file != cube_file
+    model_grid.load_flux()
+    spec = model_grid.get(*params)
+    assert np.allclose(spec['wave'], model['wave']/10.)
+    assert np.allclose(spec['flux'], model['flux'])
+
+    # Interpolated spectra use the converted cache too
+    between = model_grid.grid_interp(3750., 4.25, -0.25)
+    assert np.allclose(between['wave'], model['wave']/10.)
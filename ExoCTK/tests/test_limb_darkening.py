@@ -0,0 +1,77 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Tests of the limb darkening coefficients calculated from a model grid
+"""
+import os
+from itertools import product
+
+import numpy as np
+
+from .. import modelgrid
+from ..limb_darkening import limb_darkening_fit as lf
+from .test_modelgrid import write_grid
+
+
+def test_ldc_max_memory(tmpdir):
+    """
+    Test that the coefficients averaged over wavelength in blocks under
+    a memory limit match those of the whole spectrum
+    """
+    path = write_grid(str(tmpdir))
+    loaded = modelgrid.ModelGrid(path)
+    streamed = modelgrid.ModelGrid(path, max_memory=1000)
+    for params in [(3100., 4.5, 0.), (3050., 4.2, -0.3)]:
+        ref = lf.ldc(*params, loaded, 'quadratic')['quadratic']['coeffs']
+        new = lf.ldc(*params, streamed, 'quadratic')['quadratic']['coeffs']
+        for col in ['c1', 'c2']:
+            assert np.allclose(new[col], ref[col])
+    streamed.close()
+
+
+def test_ldc_outside_hull(tmpdir):
+    """
+    Test that a point within the parameter ranges but outside the models
+    of a sparse grid gives no coefficients rather than an error
+    """
+    path = write_grid(str(tmpdir))
+    os.remove(os.path.join(path, 'lte03200-5.00+0.0.fits'))
+    model_grid = modelgrid.ModelGrid(path, max_memory=1000,
+                                     method='delaunay')
+    assert lf.mean_intensity(model_grid, 3190., 4.95, -0.01) is None
+    assert lf.ldc(3190., 4.95, -0.01, model_grid, 'quadratic') is None
+    assert lf.ldc(3050., 4.2, -0.3, model_grid, 'quadratic')
+    model_grid.close()
+
+
+def test_compare_ldcs(tmpdir):
+    """
+    Test that the coefficients of a grid stored in reduced precision
+    are close to those of the float64 grid
+    """
+    path = write_grid(str(tmpdir))
+    reference = modelgrid.ModelGrid(path)
+    model_grid = modelgrid.ModelGrid(path, precision='int16')
+    table = lf.compare_ldcs(reference, model_grid, [3100., 3050.],
+                            [4.5, 4.2], [0., -0.3])
+    assert table.colnames == ['Teff', 'logg', 'FeH', 'dc1', 'dc2']
+    assert np.all(table['dc1'] < 1E-3) and np.all(table['dc2'] < 1E-3)
+
+
+def test_ldc_grid(tmpdir):
+    """
+    Test that the coefficients of each model of a customized grid are
+    put at its position along the customized axes
+    """
+    path = write_grid(str(tmpdir))
+    model_grid = modelgrid.ModelGrid(path)
+    model_grid.customize(Teff_rng=(3100, 3200), logg_rng=(4.5, 5.0))
+    coeffs, mu, r_eff = lf.ldc_grid(model_grid, 'quadratic')
+    assert coeffs.shape == (2, 2, 2, 2)
+    for (i, T), (j, G), (k, M) in product(
+            enumerate(model_grid.Teff_vals), enumerate(model_grid.logg_vals),
+            enumerate(model_grid.FeH_vals)):
+        ref = lf.ldc(T, G, M, model_grid, 'quadratic')
+        assert np.allclose(coeffs[:, i, j, k],
+                           [ref['quadratic']['coeffs'][c][0]
+                            for c in ['c1', 'c2']])
+        assert r_eff[i, j, k] == ref['r_eff']
@@ -0,0 +1,944 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Tests of the model index and the model grid
+"""
+import gc
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from itertools import product
+
+import astropy.units as q
+import h5py
+import numpy as np
+from astropy.io import fits
+
+from .. import modelgrid, utils
+
+
+def write_model(path, Teff, logg, FeH):
+    """
+    Write a small model file with the PHOENIX header keys
+    """
+    header = fits.Header()
+    header['PHXTEFF'] = Teff
+    header['PHXLOGG'] = logg
+    header['PHXM_H'] = FeH
+    filename = os.path.join(path, 'lte{:05d}-{:.2f}{:+.1f}.fits'
+                            .format(Teff, logg, FeH))
+    fits.PrimaryHDU(np.ones((2, 5)), header=header).writeto(filename,
+                                                            overwrite=True)
+
+    return filename
+
+
+def write_grid(path, Teff=(3000, 3100, 3200), logg=(4.0, 4.5, 5.0),
+               FeH=(-0.5, 0.), n_mu=4, n_wave=300):
+    """
+    Write a small grid of model files with PHOENIX header keys, mu
+    values and WAVELENGTH extensions, whose intensity varies smoothly
+    with the parameters
+    """
+    wave = np.linspace(5000., 30000., n_wave)
+    mu = np.linspace(0.1, 1, n_mu)
+    for T, G, M in product(Teff, logg, FeH):
+        flux = T/1000.*(1+0.1*G)*(1+0.05*M) * \
+            np.outer(mu**0.5, np.sin(wave/3000.)+2)
+        header = fits.Header()
+        header['PHXTEFF'] = float(T)
+        header['PHXLOGG'] = float(G)
+        header['PHXM_H'] = float(M)
+        header['PHXREFF'] = 1E10*(1+T/1E4+G/10.)
+        header['CRVAL1'] = '-'
+        hdu = fits.HDUList([fits.PrimaryHDU(flux, header=header),
+                            fits.ImageHDU(mu), fits.ImageHDU(np.zeros(3)),
+                            fits.ImageHDU(wave, name='WAVELENGTH')])
+        hdu.writeto(os.path.join(path, 'lte{:05d}-{:.2f}{:+.1f}.fits'
+                                 .format(T, G, M)), overwrite=True)
+
+    return path+'/'
+
+
+def test_index_models(tmpdir):
+    """
+    Test that the index picks up added, removed and changed files
+    """
+    path = str(tmpdir)
+    index_file = os.path.join(path, 'model_grid_index.npy')
+    files = [write_model(path, T, 4.5, 0.) for T in (3000, 3100, 3200)]
+
+    # A cold index keeps the header types
+    table = modelgrid.index_models(files, index_file)
+    assert os.path.isfile(index_file)
+    assert list(table['PHXTEFF']) == [3000, 3100, 3200]
+    assert table['PHXTEFF'].dtype.kind == 'i'
+    assert 'size' not in table.colnames and 'mtime' not in table.colnames
+
+    # An unchanged directory gives the same table
+    table = modelgrid.index_models(files, index_file)
+    assert list(table['PHXTEFF']) == [3000, 3100, 3200]
+
+    # Add a model and remove another
+    os.remove(files.pop(0))
+    files.append(write_model(path, 3300, 4.5, 0.))
+    table = modelgrid.index_models(files, index_file)
+    assert list(table['PHXTEFF']) == [3100, 3200, 3300]
+
+    # Rewrite a model with new header values and a new mtime
+    with fits.open(files[0]) as hdu:
+        hdu[0].header['PHXLOGG'] = 5.0
+        hdu.writeto(files[0], overwrite=True)
+    stat = os.stat(files[0])
+    os.utime(files[0], (stat.st_atime, stat.st_mtime+10))
+    table = modelgrid.index_models(files, index_file)
+    assert list(table['PHXLOGG']) == [5.0, 4.5, 4.5]
+
+
+def test_index_digest(tmpdir):
+    """
+    Test that the index digest changes only when the models change
+    """
+    path = str(tmpdir)
+    index_file = os.path.join(path, 'model_grid_index.npy')
+    files = [write_model(path, T, 4.5, 0.) for T in (3000, 3100)]
+    digest = modelgrid.index_models(files, index_file).meta['digest']
+    assert modelgrid.index_models(files, index_file).meta['digest'] == digest
+
+    # A new model and a rewritten model each give a new digest
+    files.append(write_model(path, 3200, 4.5, 0.))
+    new = modelgrid.index_models(files, index_file).meta['digest']
+    assert new != digest
+    stat = os.stat(files[0])
+    os.utime(files[0], (stat.st_atime, stat.st_mtime+10))
+    assert modelgrid.index_models(files, index_file).meta['digest'] != new
+
+
+def test_lazy_flux(tmpdir):
+    """
+    Test that slicing a lazy view composes with its index and reads
+    the same values as slicing the array
+    """
+    cube = np.arange(4*3*2*5*30, dtype=float).reshape(4, 3, 2, 5, 30)
+    filename = os.path.join(str(tmpdir), 'flux.hdf5')
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset('flux', data=cube, chunks=(1, 1, 1, 5, 30))
+
+    with h5py.File(filename, 'r') as f:
+        lazy = modelgrid.LazyFlux(f['flux'])
+        assert lazy.shape == cube.shape
+
+        view = lazy[1:4][:, 0:2][..., 3:10][-1]
+        assert view.shape == cube[1:4][:, 0:2][..., 3:10][-1].shape
+        assert np.array_equal(np.asarray(view),
+                              cube[1:4][:, 0:2][..., 3:10][-1])
+
+        # A single spectrum
+        assert np.array_equal(np.asarray(lazy[2, 1, 0]), cube[2, 1, 0])
+
+        try:
+            lazy[::2]
+        except IndexError:
+            pass
+        else:
+            raise AssertionError('No error for a stepped slice')
+
+
+def test_lazy_flux_wave_major(tmpdir):
+    """
+    Test that a lazy view reads the same values from the wavelength-major
+    copy and reads single wavelengths from it
+    """
+    cube = np.arange(4*3*2*5*30, dtype=float).reshape(4, 3, 2, 5, 30)
+    filename = os.path.join(str(tmpdir), 'flux.hdf5')
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset('flux', data=cube, chunks=(1, 1, 1, 5, 30))
+        f.create_dataset('flux_wave', data=np.moveaxis(cube, -1, 0),
+                         chunks=(1, 4, 3, 2, 5))
+
+    with h5py.File(filename, 'r') as f:
+        lazy = modelgrid.LazyFlux(f['flux'], wave_major=f['flux_wave'])
+        view = lazy[1:4][:, 0:2][..., 3:10][-1]
+        assert np.array_equal(np.asarray(view),
+                              cube[1:4][:, 0:2][..., 3:10][-1])
+
+        view = lazy[:, :, :, :, 7]
+        assert view.layout == 'wavelength'
+        assert np.array_equal(np.asarray(view), cube[..., 7])
+
+
+def test_build_resume(tmpdir):
+    """
+    Test that an interrupted cache build resumes from the partial file,
+    reading only the models it had not written, to the same cube
+    """
+    path = write_grid(str(tmpdir))
+    model_grid = modelgrid.ModelGrid(path)
+    read_model = model_grid.read_model
+    reads, limit = [], [6]
+
+    def counted(*args, **kwargs):
+        reads.append(args[0]['filename'])
+        if len(reads) > limit[0]:
+            raise RuntimeError('Interrupted')
+        return read_model(*args, **kwargs)
+
+    # Stop the build part way
+    model_grid.read_model = counted
+    try:
+        model_grid.make_cache()
+    except RuntimeError:
+        pass
+    gc.collect()
+    part_file = model_grid.flux_file+'.part'
+    assert os.path.isfile(part_file)
+    with h5py.File(part_file, 'r') as f:
+        n_done = int(f['done'][:].sum())
+    assert 0 < n_done < len(model_grid.data)
+
+    # Finish it, reading each remaining model once
+    reads[:], limit[0] = [], len(model_grid.data)
+    model_grid.make_cache()
+    assert len(reads) == len(model_grid.data)-n_done
+    assert not os.path.isfile(part_file)
+
+    # Compare with an uninterrupted build
+    other = modelgrid.ModelGrid(write_grid(str(tmpdir.mkdir('other'))))
+    other.make_cache()
+    with h5py.File(model_grid.flux_file, 'r') as f, \
+            h5py.File(other.flux_file, 'r') as g:
+        assert np.array_equal(f['flux'][:], g['flux'][:])
+
+
+def test_build_unreadable_part(tmpdir):
+    """
+    Test that a partial file left unreadable by a killed build is
+    replaced by a new build
+    """
+    path = write_grid(str(tmpdir))
+    model_grid = modelgrid.ModelGrid(path)
+    part_file = model_grid.flux_file+'.part'
+    model_grid.make_cache()
+    os.rename(model_grid.flux_file, part_file)
+
+    # Cut the file short
+    size = os.path.getsize(part_file)
+    with open(part_file, 'r+b') as f:
+        f.truncate(size//2)
+
+    model_grid.load_flux()
+    assert not os.path.isfile(part_file)
+    other = modelgrid.ModelGrid(write_grid(str(tmpdir.mkdir('other'))))
+    other.load_flux()
+    assert np.array_equal(model_grid.flux, other.flux)
+
+
+def test_customize_keeps_cache(tmpdir):
+    """
+    Test that customizing slices the cached cube without deleting or
+    rebuilding it, so the grid can be widened back again
+    """
+    model_grid = modelgrid.ModelGrid(write_grid(str(tmpdir)))
+    model_grid.load_flux()
+    flux_file = model_grid.flux_file
+    mtime = os.stat(flux_file).st_mtime
+    full = np.array(model_grid.flux)
+
+    # Narrow the parameter and wavelength ranges
+    model_grid.customize(Teff_rng=(3000, 3100), FeH_rng=(0, 0),
+                         wave_rng=(1, 2))
+    assert model_grid.flux.shape[:3] == (2, 3, 1)
+    assert np.all((model_grid.wavelength >= 1) & (model_grid.wavelength <= 2))
+    assert model_grid.flux_file == flux_file
+    assert os.stat(flux_file).st_mtime == mtime
+
+    # Widen them back
+    model_grid.customize()
+    assert model_grid.flux_file == flux_file
+    assert os.stat(flux_file).st_mtime == mtime
+    assert np.array_equal(model_grid.flux, full)
+
+
+def test_shared_refs(tmpdir):
+    """
+    Test that each grid attached to the shared cube is counted until it
+    detaches or is collected, that exited processes are dropped and that
+    the cube is removed after its last user
+    """
+    path = write_grid(str(tmpdir))
+    first = modelgrid.ModelGrid(path, shared=True)
+    first.load_flux()
+    directory = first.shared_dir
+    refs = os.path.join(directory, 'refs.json')
+
+    def users():
+        with open(refs) as f:
+            return json.load(f)
+
+    # Count each attached grid
+    second = modelgrid.ModelGrid(path, shared=True)
+    second.load_flux()
+    assert users() == [os.getpid()]*2
+    assert np.array_equal(second.flux, first.flux)
+
+    # Release a grid which is never detached when it is collected
+    third = modelgrid.ModelGrid(path, shared=True)
+    third.load_flux()
+    assert len(users()) == 3
+    del third
+    gc.collect()
+    assert len(users()) == 2
+
+    # Keep the cube while a grid is attached
+    first.detach()
+    assert users() == [os.getpid()]
+
+    # Drop an exited process and remove the cube after the last user
+    proc = subprocess.Popen([sys.executable, '-c', ''])
+    proc.wait()
+    with open(refs, 'w') as f:
+        json.dump([proc.pid, os.getpid()], f)
+    second.detach()
+    assert not os.path.exists(directory)
+    assert not os.path.exists(directory+'.lock')
+
+
+def test_fork_finalizers(tmpdir):
+    """
+    Test that a forked process which runs the inherited finalizers at
+    exit leaves the shared cube and the worker pool of its parent alone
+    """
+    if not hasattr(os, 'fork'):
+        return
+
+    path = write_grid(str(tmpdir))
+    shared = modelgrid.ModelGrid(path, shared=True)
+    shared.load_flux()
+    refs = os.path.join(shared.shared_dir, 'refs.json')
+    pooled = modelgrid.ModelGrid(path, processes=2)
+    pooled.grid_interp(3050., 4.2, -0.3)
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            shared._shared_finalizer()
+            pooled._pool_finalizer()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+    with open(refs) as f:
+        assert json.load(f) == [os.getpid()]
+    assert os.path.isfile(pooled.pool_file)
+    spec = pooled.grid_interp(3150., 4.7, -0.2, cache=False)
+    assert np.isfinite(spec['flux']).all()
+
+    pooled.close()
+    shared.detach()
+    assert not os.path.exists(shared.shared_dir)
+
+
+def test_concurrent_views(tmpdir):
+    """
+    Test that views customized at once from many threads each get the
+    spectra of their own ranges and leave the grid unchanged
+    """
+    model_grid = modelgrid.ModelGrid(write_grid(str(tmpdir)))
+    model_grid.load_flux()
+    shape = model_grid.flux.shape
+    ranges = [{'Teff_rng': (3000, 3200), 'wave_rng': (1, 2)},
+              {'Teff_rng': (3100, 3200), 'wave_rng': (0.5, 1.5)},
+              {'logg_rng': (4.5, 5), 'wave_rng': (2, 3)},
+              {}]
+    params = [(3150., 4.7, -0.2), (3120., 4.9, -0.1), (3110., 4.6, 0.),
+              (3050., 4.2, -0.3)]
+
+    def work(n):
+        view = model_grid.view(**ranges[n % 4])
+        spec = view.get(*params[n % 4])
+        return spec['wave'], spec['flux']
+
+    # Compare with the same views made one at a time
+    expected = [work(n) for n in range(4)]
+    assert np.all((expected[0][0] >= 1) & (expected[0][0] <= 2))
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        results = list(ex.map(work, range(64)))
+    for n, (wave, flux) in enumerate(results):
+        assert np.array_equal(wave, expected[n % 4][0])
+        assert np.array_equal(flux, expected[n % 4][1])
+    assert expected[0][1].shape != expected[2][1].shape
+
+    assert model_grid.flux.shape == shape
+    assert model_grid.wave_rng == (0, 40)
+
+
+def test_customize_resolution(tmpdir):
+    """
+    Test that a binned grid customized to a narrow wavelength range
+    serves its grid points and the points between them on the same
+    pixels, evenly spaced in log wavelength
+    """
+    path = write_grid(str(tmpdir))
+    model_grid = modelgrid.ModelGrid(path, resolution=100)
+    model_grid.load_flux()
+    model_grid.customize(wave_rng=(1, 1.2))
+
+    spec = model_grid.get(3100., 4.5, 0.)
+    assert len(spec['wave']) == 19
+    assert np.allclose(np.diff(np.log(spec['wave'])), 0.01)
+    for other in [model_grid.grid_interp(3100., 4.5, 0.),
+                  modelgrid.ModelGrid(path, resolution=100, lazy=True,
+                                      wave_rng=(1, 1.2)).get(3150., 4.5, 0.)]:
+        assert np.array_equal(other['wave'], spec['wave'])
+    many = model_grid.get_many([3100.], [4.5], [0.])
+    assert np.array_equal(many['wave'], spec['wave'])
+    assert np.allclose(many['flux'][0], spec['flux'])
+    assert np.allclose(model_grid.grid_interp(3100., 4.5, 0.)['flux'],
+                       spec['flux'])
+
+
+def test_customized_view(tmpdir):
+    """
+    Test that a view of a customized grid keeps the ranges it does not
+    change
+    """
+    model_grid = modelgrid.ModelGrid(write_grid(str(tmpdir)))
+    model_grid.customize(FeH_rng=(0, 0), wave_rng=(1, 2))
+    view = model_grid.view(Teff_rng=(3000, 3100))
+    assert view.wave_rng == (1, 2)
+    assert list(view.Teff_vals) == [3000, 3100]
+    assert list(view.FeH_vals) == [0]
+    spec = view.get(3050., 4.5, 0.)
+    assert np.all((spec['wave'] >= 1) & (spec['wave'] <= 2))
+
+    # The grid is unchanged and can still be widened
+    assert list(model_grid.Teff_vals) == [3000, 3100, 3200]
+    assert list(model_grid.view(FeH_rng=(-1, 0)).FeH_vals) == [-0.5, 0]
+
+
+def test_cache_invalidation(tmpdir):
+    """
+    Test that recently retrieved spectra are reused, but not after
+    customizing the grid or changing its units
+    """
+    model_grid = modelgrid.ModelGrid(write_grid(str(tmpdir)), cache_size=2)
+    first = model_grid.get(3100., 4.5, 0.)
+    first_file = model_grid.flux_file
+    again = model_grid.get(3100., 4.5, 0.)
+    assert np.array_equal(again['flux'], first['flux'])
+    assert model_grid.cache_info()['hits'] == 1
+
+    # A narrower wavelength range
+    model_grid.customize(wave_rng=(1, 2))
+    spec = model_grid.get(3100., 4.5, 0.)
+    assert model_grid.cache_info()['hits'] == 1
+    assert len(spec['wave']) < len(first['wave'])
+
+    # Other wavelength units
+    between = model_grid.grid_interp(3150., 4.5, 0., cache=False)
+    model_grid.set_units(q.nm)
+    spec = model_grid.get(3100., 4.5, 0.)
+    assert model_grid.cache_info() == {'hits': 1, 'misses': 3, 'size': 2,
+                                       'maxsize': 2}
+
+    # Points on and off the grid in the same range of the new units
+    assert np.all((spec['wave'] >= 1000) & (spec['wave'] <= 2000))
+    assert np.allclose(spec['wave'], first['wave'][(first['wave'] >= 1) &
+                                                   (first['wave'] <= 2)]*1000)
+    interp = model_grid.grid_interp(3150., 4.5, 0.)
+    assert np.allclose(interp['wave'], spec['wave'])
+    assert np.allclose(interp['flux'], between['flux'])
+    assert model_grid.flux_file != first_file
+
+    # And back again
+    model_grid.set_units(q.um)
+    assert np.allclose(model_grid.get(3100., 4.5, 0.)['wave'],
+                       spec['wave']/1000)
+    assert model_grid.flux_file == first_file
+
+
+def test_get_many(tmpdir):
+    """
+    Test that the spectra of many stars match those retrieved one at a
+    time, in memory, from a lazy cube and in chunks
+    """
+    path = write_grid(str(tmpdir))
+    rng = np.random.RandomState(5)
+    Teff, logg, FeH = [np.append(rng.uniform(lo, hi, 6), val) for lo, hi, val
+                       in [(3000, 3200, 3500), (4, 5, 4.5), (-0.5, 0, 0.)]]
+    Teff[0], logg[0], FeH[0] = 3100., 4.5, 0.
+
+    for lazy in [False, True]:
+        model_grid = modelgrid.ModelGrid(path, lazy=lazy)
+        many = model_grid.get_many(Teff, logg, FeH)
+        for n in range(len(Teff)-1):
+            spec = model_grid.get(Teff[n], logg[n], FeH[n])
+            assert np.allclose(many['flux'][n], spec['flux'])
+            assert np.isclose(many['r_eff'][n], spec['r_eff'])
+        assert np.all(np.isnan(many['flux'][-1]))
+
+        chunks = list(model_grid.get_many(Teff, logg, FeH, chunk_size=3))
+        assert len(chunks) == 3
+        assert np.allclose(np.concatenate([c['flux'] for c in chunks]),
+                           many['flux'], equal_nan=True)
+        model_grid.close()
+
+
+def test_pyramid_levels(tmpdir):
+    """
+    Test that spectra at a given resolution are served on and off the
+    grid from the nearest level of the pyramid
+    """
+    model_grid = modelgrid.ModelGrid(write_grid(str(tmpdir)),
+                                     pyramid=(20, 60))
+    assert model_grid.nearest_level(30)[0] == 20
+    assert model_grid.nearest_level(45)[0] == 60
+    assert model_grid.nearest_level(1000)[0] == 60
+
+    # Both the grid points and the points between them
+    wave = model_grid.levels[20]['wavelength']
+    lower = model_grid.get(3000., 4.5, 0., resolution=30)
+    upper = model_grid.get(3100., 4.5, 0., resolution=30)
+    between = model_grid.get(3050., 4.5, 0., resolution=30)
+    for spec in [lower, upper, between]:
+        assert np.array_equal(spec['wave'], wave)
+    assert np.allclose(between['flux'], (lower['flux']+upper['flux'])/2)
+
+    # The native resolution without one
+    native = model_grid.get(3050., 4.5, 0.)
+    assert len(native['wave']) > len(wave)
+
+    # The grid resolution without one, on and off the grid
+    model_grid.resolution = 30
+    for params in [(3000., 4.5, 0.), (3050., 4.5, 0.)]:
+        spec = model_grid.get(*params)
+        assert np.array_equal(spec['wave'], wave)
+        assert spec['resolution'] == 20
+
+
+def test_cold_lazy_get(tmpdir):
+    """
+    Test that a lazy grid with no flux cache reads only the models
+    around a star, without building or opening a cache, and interpolates
+    the same spectrum as a loaded grid
+    """
+    path = write_grid(str(tmpdir))
+    model_grid = modelgrid.ModelGrid(path, lazy=True)
+    read_model = model_grid.read_model
+    reads = []
+
+    def counted(*args, **kwargs):
+        reads.append(args[0]['filename'])
+        return read_model(*args, **kwargs)
+
+    model_grid.read_model = counted
+    cold = model_grid.get(3050., 4.2, -0.3)
+    assert len(reads) == 8
+    assert model_grid.flux == ''
+    assert not glob(path+'model_grid_flux_*')
+
+    loaded = modelgrid.ModelGrid(path).get(3050., 4.2, -0.3)
+    assert np.array_equal(cold['wave'], loaded['wave'])
+    assert np.allclose(cold['flux'], loaded['flux'])
+
+
+def test_triangulation_reuse(tmpdir):
+    """
+    Test that the triangulation is made once for the models in range,
+    reused for every query and restored when the ranges are widened back
+    """
+    model_grid = modelgrid.ModelGrid(write_grid(str(tmpdir)),
+                                     method='delaunay')
+    model_grid.load_flux()
+    model_grid.simplex_weights(3150., 4.7, -0.2)
+    tri = model_grid.tri
+    digest = tri['digest']
+
+    # Many queries do not index the models again
+    many = model_grid.get_many([3150., 3050., 3120.], [4.7, 4.2, 4.9],
+                               [-0.2, -0.3, -0.1])
+    assert model_grid.tri is tri
+    spec = model_grid.get(3050., 4.2, -0.3)
+    assert np.allclose(many['flux'][1], spec['flux'])
+    assert model_grid.tri is tri
+
+    # Fewer models give another triangulation
+    model_grid.customize(Teff_rng=(3000, 3100))
+    model_grid.simplex_weights(3050., 4.2, -0.3)
+    assert model_grid.tri['digest'] != digest
+    model_grid.customize()
+    model_grid.simplex_weights(3050., 4.2, -0.3)
+    assert model_grid.tri['digest'] == digest
+
+
+def test_wave_major_grid(tmpdir):
+    """
+    Test that a grid with a wavelength-major copy of its cache stores
+    the same cube in both layouts and retrieves the same spectra
+    """
+    path = write_grid(str(tmpdir))
+    model_grid = modelgrid.ModelGrid(path, wave_major=True, lazy=True)
+    model_grid.load_flux()
+    with h5py.File(model_grid.flux_file, 'r') as f:
+        assert np.array_equal(f['flux_wave'][:],
+                              np.moveaxis(f['flux'][:], -1, 0))
+    assert model_grid.flux.wave_major is not None
+
+    # A narrow wavelength bin of many stars
+    loaded = modelgrid.ModelGrid(path, wave_rng=(1, 1.1))
+    model_grid.customize(wave_rng=(1, 1.1))
+    Teff, logg, FeH = [3050., 3150., 3100.], [4.2, 4.7, 4.5], [-0.3, -0.2, 0.]
+    many = model_grid.get_many(Teff, logg, FeH)
+    assert np.allclose(many['flux'], loaded.get_many(Teff, logg, FeH)['flux'])
+    model_grid.close()
+
+
+def test_transpose_flux(tmpdir):
+    """
+    Test that the wavelength-major copy is made in passes of whole
+    columns of cube chunks
+    """
+    model_grid = modelgrid.ModelGrid(write_grid(str(tmpdir)),
+                                     wave_major=True, max_memory=1)
+    cube = np.random.RandomState(2).rand(3, 2, 2, 4, 50)
+    filename = os.path.join(str(tmpdir), 'flux.hdf5')
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset('flux', data=cube, chunks=(1, 1, 1, 4, 7))
+        model_grid.transpose_flux(f)
+        assert np.array_equal(f['flux_wave'][:], np.moveaxis(cube, -1, 0))
+
+
+def test_emulator(tmpdir):
+    """
+    Test that an emulator with a component for every model rebuilds the
+    cube, is rebuilt for a newer cache and interpolates the customized
+    grid like the flux cube
+    """
+    model_grid = modelgrid.ModelGrid(write_grid(str(tmpdir)))
+    model_grid.load_emulator(n_components=20)
+    em = model_grid.emulator
+    rebuilt = em['mean']+np.tensordot(em['weights'], em['basis'], axes=1)
+    assert np.allclose(rebuilt, model_grid.flux)
+    assert np.nanmax(em['max_err']) < 1E-10
+    assert np.nanmax(em['rms_err']) < 1E-10
+
+    # Rebuild it when the cache changes
+    flux_file = model_grid.flux_file
+    stat = os.stat(flux_file)
+    os.utime(flux_file, (stat.st_atime, stat.st_mtime+10))
+    model_grid.load_emulator()
+    with h5py.File(model_grid.emulator_file, 'r') as f:
+        assert f.attrs['source_mtime'] == os.path.getmtime(flux_file)
+        assert f.attrs['n_components'] == 20
+
+    # Slice it like the flux cube
+    model_grid.customize(Teff_rng=(3000, 3100), wave_rng=(1, 2))
+    W = model_grid.cube_slices()[-1]
+    T, G, M = model_grid.cube_slices()[:3]
+    em = model_grid.emulator
+    rebuilt = em['mean'][:, W]+np.tensordot(em['weights'][T, G, M],
+                                            em['basis'][:, :, W], axes=1)
+    assert np.allclose(rebuilt, model_grid.flux)
+    fast = model_grid.grid_interp(3050., 4.2, -0.3, emulator=True)
+    spec = model_grid.grid_interp(3050., 4.2, -0.3)
+    assert fast['flux'].shape == spec['flux'].shape
+    assert np.allclose(fast['flux'], spec['flux'])
+
+
+def test_max_memory(tmpdir):
+    """
+    Test that a grid with a memory limit smaller than one spectrum
+    streams the same spectra as a grid loaded into memory
+    """
+    path = write_grid(str(tmpdir))
+    loaded = modelgrid.ModelGrid(path)
+    model_grid = modelgrid.ModelGrid(path, max_memory=1000)
+    model_grid.load_flux()
+    assert isinstance(model_grid.flux, modelgrid.LazyFlux)
+
+    Teff, logg, FeH = [3050., 3150., 3100.], [4.2, 4.7, 4.5], [-0.3, -0.2, 0.]
+    for method in ['linear', 'delaunay']:
+        blocks = list(model_grid.stream(3050., 4.2, -0.3, method=method))
+        assert len(blocks) > 1
+        spec = loaded.grid_interp(3050., 4.2, -0.3, method=method)
+        assert np.allclose(np.concatenate([b['flux'] for b in blocks],
+                                          axis=-1), spec['flux'])
+        assert np.array_equal(np.concatenate([b['wave'] for b in blocks]),
+                              spec['wave'])
+        assert np.allclose(blocks[0]['mu'], spec['mu'])
+
+        streamed = model_grid.grid_interp(3050., 4.2, -0.3, method=method)
+        assert np.allclose(streamed['flux'], spec['flux'])
+        many = model_grid.get_many(Teff, logg, FeH, method=method)
+        assert np.allclose(many['flux'],
+                           loaded.get_many(Teff, logg, FeH,
+                                           method=method)['flux'])
+    model_grid.close()
+
+
+def test_worker_pool(tmpdir):
+    """
+    Test that the worker pool interpolates the same spectra as one
+    process, is reused and removes its mapped cube when closed
+    """
+    path = write_grid(str(tmpdir))
+    expected = modelgrid.ModelGrid(path).grid_interp(3050., 4.2, -0.3)
+    model_grid = modelgrid.ModelGrid(path, processes=2)
+    spec = model_grid.grid_interp(3050., 4.2, -0.3)
+    assert np.allclose(spec['flux'], expected['flux'])
+    pool, pool_file = model_grid.pool, model_grid.pool_file
+    assert os.path.isfile(pool_file)
+    assert isinstance(model_grid.full['flux'], np.memmap)
+
+    # A second call uses the same pool
+    spec = model_grid.grid_interp(3150., 4.7, -0.2)
+    assert model_grid.pool is pool
+
+    # Closing removes the file and reads the cube back into memory
+    model_grid.close()
+    assert model_grid.pool is None
+    assert not os.path.isfile(pool_file)
+    assert not isinstance(model_grid.full['flux'], np.memmap)
+    assert np.allclose(model_grid.grid_interp(3150., 4.7, -0.2,
+                                              cache=False)['flux'],
+                       spec['flux'])
+    model_grid.close()
+
+
+def test_mu_grid(tmpdir):
+    """
+    Test that a grid with a mu grid caches the intensities resampled
+    onto it, with mu=1 added
+    """
+    path = write_grid(str(tmpdir))
+    mu_grid = [0.2, 0.5, 0.8]
+    model_grid = modelgrid.ModelGrid(path, mu_grid=mu_grid)
+    model_grid.load_flux()
+    assert model_grid.flux.shape[3] == len(mu_grid)+1
+    with h5py.File(model_grid.flux_file, 'r') as f:
+        assert f['flux'].shape[3] == len(mu_grid)+1
+        assert np.array_equal(f['mu'][0, 0, 0], [0.2, 0.5, 0.8, 1.])
+
+    # Each model is resampled from its own mu values
+    native = modelgrid.ModelGrid(path).get(3100., 4.5, 0.)
+    spec = model_grid.get(3100., 4.5, 0.)
+    assert np.allclose(spec['flux'], utils.resample_mu(
+        native['mu'], native['flux'], model_grid.mu_grid))
+    assert np.allclose(model_grid.mu[1, 1, 1], model_grid.mu_grid)
+
+
+def test_reduced_precision(tmpdir):
+    """
+    Test that grids stored in reduced precision build, load and
+    interpolate to within the precision of their types
+    """
+    path = write_grid(str(tmpdir))
+    reference = modelgrid.ModelGrid(path)
+    Teff, logg, FeH = [3100., 3050., 3150.], [4.5, 4.2, 4.7], [0., -0.3, -0.2]
+    for precision, tol in [('int16', 1E-4), ('float16', 1E-3),
+                           ('float32', 1E-6)]:
+        model_grid = modelgrid.ModelGrid(path, precision=precision)
+        model_grid.load_flux()
+        assert model_grid.flux.dtype == np.dtype(precision)
+        assert (model_grid.scale is not None) == \
+            (precision in ('int16', 'float16'))
+        assert model_grid.flux_file != reference.flux_file
+
+        table = modelgrid.compare_grids(reference, model_grid, Teff, logg,
+                                        FeH)
+        assert len(table) == 3
+        assert np.all(table['max_err'] < tol)
+        assert np.all(table['rms_err'] < tol)
+
+        # A single interpolated spectrum
+        spec = model_grid.get(3050., 4.2, -0.3)
+        assert np.allclose(spec['flux'],
+                           reference.get(3050., 4.2, -0.3)['flux'], rtol=tol)
+
+
+def test_wavelength_axis(tmpdir):
+    """
+    Test that a model read on its own gets its own wavelength axis even
+    if the previous model had another axis of the same size
+    """
+    path = write_grid(str(tmpdir))
+    filename = os.path.join(path, 'lte03100-4.50+0.0.fits')
+    with fits.open(filename) as hdu:
+        hdu['WAVELENGTH'].data = hdu['WAVELENGTH'].data+100.
+        hdu.writeto(filename, overwrite=True)
+
+    model_grid = modelgrid.ModelGrid(path)
+    first = model_grid.get(3000., 4.5, 0.)
+    shifted = model_grid.get(3100., 4.5, 0.)
+    assert len(shifted['wave']) == len(first['wave'])
+    assert np.allclose(shifted['wave'], first['wave']+0.01)
+
+
+def test_build_shifted_axis(tmpdir):
+    """
+    Test that a model whose wavelength axis has the size of the others
+    but is shifted is put onto the axis of the flux cube, and that the
+    models read after it keep the axis of the cube
+    """
+    path = write_grid(str(tmpdir))
+    filename = os.path.join(path, 'lte03100-4.50+0.0.fits')
+    with fits.open(filename) as hdu:
+        hdu['WAVELENGTH'].data = hdu['WAVELENGTH'].data+100.
+        hdu.writeto(filename, overwrite=True)
+
+    model_grid = modelgrid.ModelGrid(path, workers=1)
+    model_grid.build_flux()
+    with h5py.File(model_grid.flux_file, 'r') as f:
+        wave = f['wavelength'][:]
+        flux = f['flux'][:]
+
+    for (i, T), (j, G), (k, M) in product(
+            enumerate(model_grid.Teff_vals), enumerate(model_grid.logg_vals),
+            enumerate(model_grid.FeH_vals)):
+        row = model_grid.data[model_grid.points[(T, G, M)]]
+        spec = model_grid.read_model(row, model_grid.cube_wave_rng)
+        expected = [np.interp(wave, spec['wave'], f) for f in spec['flux']]
+        assert np.allclose(flux[i, j, k], expected)
+
+
+def test_index_pool(tmpdir):
+    """
+    Test that a grid indexes its models into the same table with
+    parallel thread and process pools as with one worker
+    """
+    tables = []
+    for name, kwargs in [('serial', {}),
+                         ('thread', {'workers': 4, 'index_pool': 'thread'}),
+                         ('process', {'workers': 4,
+                                      'index_pool': 'process'})]:
+        path = write_grid(str(tmpdir.mkdir(name)))
+        tables.append(modelgrid.ModelGrid(path, **kwargs).data)
+
+    serial = tables[0]
+    for table in tables[1:]:
+        assert table.colnames == serial.colnames
+        for col in serial.colnames:
+            assert list(table[col]) == list(serial[col])
+
+
+def test_warm_cache(tmpdir):
+    """
+    Test that a grid loads the mu, r_eff and wavelength arrays from an up
+    to date cache without reading any model file, and rebuilds a cache
+    with another version or other parameter axes
+    """
+    path = write_grid(str(tmpdir))
+    built = modelgrid.ModelGrid(path)
+    built.load_flux()
+
+    def unread(*args, **kwargs):
+        raise AssertionError('A model file was read')
+
+    model_grid = modelgrid.ModelGrid(path)
+    model_grid.read_model = unread
+    model_grid.load_flux()
+    for name in ['mu', 'r_eff', 'wavelength', 'flux']:
+        assert np.array_equal(model_grid.full[name], built.full[name])
+    assert np.isfinite(model_grid.full['r_eff']).all()
+    assert (model_grid.full['mu'] > 0).all()
+    assert len(model_grid.full['wavelength']) == \
+        model_grid.full['flux'].shape[-1]
+
+    # Stale caches are rebuilt from the model files
+    for name in ['version', 'Teff_vals']:
+        with h5py.File(built.flux_file, 'r+') as f:
+            if name == 'version':
+                f.attrs['version'] = modelgrid.CACHE_VERSION-1
+            else:
+                f[name][0] -= 100.
+
+        model_grid = modelgrid.ModelGrid(path)
+        read_model = model_grid.read_model
+        reads = []
+
+        def counted(*args, **kwargs):
+            reads.append(args[0]['filename'])
+            return read_model(*args, **kwargs)
+
+        model_grid.read_model = counted
+        model_grid.load_flux()
+        assert len(reads) == len(model_grid.data)
+        assert model_grid.check_cache()
+        assert np.array_equal(model_grid.full['flux'], built.full['flux'])
+
+
+def test_grid_point_lookup(tmpdir):
+    """
+    Test that get() finds a grid point given as ints, floats or numpy
+    scalars, before and after the grid is customized
+    """
+    path = write_grid(str(tmpdir))
+    model_grid = modelgrid.ModelGrid(path)
+
+    def interpolated(*args, **kwargs):
+        raise AssertionError('A grid point was interpolated')
+
+    model_grid.grid_interp = interpolated
+    expected = model_grid.get(3100., 4.5, 0., cache=False)
+    for params in [(3100, 4.5, 0), (np.float32(3100.), np.float32(4.5),
+                                    np.int64(0))]:
+        spec = model_grid.get(*params, cache=False)
+        assert spec['filename'] == expected['filename']
+        assert np.array_equal(spec['flux'], expected['flux'])
+
+    # The positions follow the customized axes
+    model_grid.customize(Teff_rng=(3100, 3200), FeH_rng=(0, 0))
+    assert model_grid.positions['Teff'] == {3100.: 0, 3200.: 1}
+    assert model_grid.positions['FeH'] == {0.: 0}
+    spec = model_grid.get(3200, 5, 0, cache=False)
+    assert spec['filename'] == 'lte03200-5.00+0.0.fits'
+
+
+def test_views_share_cache(tmpdir):
+    """
+    Test that a view made for each request finds the spectra retrieved
+    through earlier views of the same ranges, and not those of other
+    ranges
+    """
+    model_grid = modelgrid.ModelGrid(write_grid(str(tmpdir)), cache_size=8)
+    first = model_grid.view(wave_rng=(1, 2)).get(3150., 4.7, -0.2)
+    spec = model_grid.view(wave_rng=(1, 2)).get(3150., 4.7, -0.2)
+    assert model_grid.cache_info()['hits'] == 1
+    assert np.array_equal(spec['flux'], first['flux'])
+
+    other = model_grid.view(wave_rng=(2, 3)).get(3150., 4.7, -0.2)
+    assert model_grid.cache_info() == {'hits': 1, 'misses': 2, 'size': 2,
+                                       'maxsize': 8}
+    assert np.all(other['wave'] >= 2)
+
+
+def test_worker_pool_scale(tmpdir):
+    """
+    Test that the worker pool interpolates a customized grid stored in
+    reduced precision like one process does, sending each task only the
+    scale factors of the cell
+    """
+    path = write_grid(str(tmpdir))
+    ranges = {'Teff_rng': (3100, 3200), 'logg_rng': (4.5, 5.0)}
+    expected = modelgrid.ModelGrid(path, precision='int16')
+    expected.customize(**ranges)
+    model_grid = modelgrid.ModelGrid(path, precision='int16', processes=2)
+    model_grid.customize(**ranges)
+
+    # Record the scale factors sent to the workers
+    model_grid.load_flux()
+    pool = model_grid.start_pool().pool
+    starmap, sent = pool.starmap, []
+
+    def recorded(func, args):
+        sent.extend(arg[-1] for arg in args)
+        return starmap(func, args)
+
+    pool.starmap = recorded
+    for params in [(3150., 4.7, -0.2), (3120., 4.9, -0.4)]:
+        spec = model_grid.grid_interp(*params)
+        assert np.allclose(spec['flux'], expected.grid_interp(*params)['flux'])
+    assert sent and all(scale.shape[:3] == (2, 2, 2) for scale in sent)
+    model_grid.close()
@@ -0,0 +1,228 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Tests of the interpolation, resampling and storage functions
+"""
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+
+from .. import utils
+
+
+def make_cube():
+    """
+    A (Teff, logg, FeH, mu, wavelength) cube on an uneven grid
+    """
+    rng = np.random.RandomState(42)
+    axes = [np.array([3000., 3100., 3300., 3600.]), np.array([4., 4.5, 5.]),
+            np.array([-0.5, 0.])]
+    cube = rng.uniform(1, 2, size=[len(a) for a in axes]+[3, 20])
+
+    return axes, cube
+
+
+def test_grid_cell():
+    """
+    Test that the cell interpolation matches scipy's multilinear
+    interpolation, on and between the grid points
+    """
+    axes, cube = make_cube()
+    interp = RegularGridInterpolator(axes, cube)
+    for point in [(3050., 4.2, -0.1), (3600., 5., 0.), (3100., 4.5, -0.5),
+                  (3450., 4.75, -0.25)]:
+        cell, weights = utils.grid_cell(axes, point)
+        assert np.isclose(weights.sum(), 1)
+        assert np.allclose(utils.interp_cell(cube, cell, weights),
+                           interp([point])[0])
+
+
+def test_grid_cell_outside():
+    """
+    Test that a point outside the grid is refused
+    """
+    axes, cube = make_cube()
+    try:
+        utils.grid_cell(axes, (2900., 4.5, 0.))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('No error for a point outside the grid')
+
+
+def test_grid_cells():
+    """
+    Test that the cells of many points match those of each point
+    """
+    axes, cube = make_cube()
+    points = np.array([(3050., 4.2, -0.1), (3450., 4.75, -0.25),
+                       (5000., 4.5, 0.)])
+    lower, sizes, weights, inside = utils.grid_cells(axes, points.T)
+    assert list(inside) == [True, True, False]
+    for n, point in enumerate(points[inside]):
+        cell, w = utils.grid_cell(axes, point)
+        assert [c.start for c in cell] == list(lower[n])
+        assert np.allclose(weights[n], w)
+
+
+def test_encode_flux():
+    """
+    Test that each storage type decodes to the flux within its precision
+    """
+    rng = np.random.RandomState(0)
+    flux = rng.uniform(1E-3, 1E3, size=(4, 3, 50))*np.logspace(-5, 5, 4)[
+        :, None, None]
+    for dtype, rtol in [('float64', 0), ('float32', 1E-6),
+                        ('float16', 1E-3), ('int16', 1E-4)]:
+        stored, scale = utils.encode_flux(flux, dtype)
+        assert stored.dtype == np.dtype(dtype)
+        assert (scale is None) == (np.dtype(dtype) not in utils.SCALED_TYPES)
+        decoded = utils.decode_flux(stored, scale)
+        peak = np.abs(flux).max(axis=-1)[..., None]
+        assert np.all(np.abs(decoded-flux) <= rtol*peak+1E-300)
+
+
+def test_interp_cell_scaled():
+    """
+    Test that interpolating an encoded cube matches the decoded cube
+    """
+    axes, cube = make_cube()
+    stored, scale = utils.encode_flux(cube, 'int16')
+    cell, weights = utils.grid_cell(axes, (3200., 4.6, -0.2))
+    assert np.allclose(utils.interp_cell(stored, cell, weights, scale),
+                       utils.interp_cell(utils.decode_flux(stored, scale),
+                                         cell, weights))
+
+
+def test_resample_matrix():
+    """
+    Test that binning onto a lower resolution conserves the integrated
+    flux and a flat spectrum, on pixels evenly spaced in log wavelength
+    which are the same for part of the spectrum
+    """
+    wave = np.sort(np.random.RandomState(1).uniform(1, 2, 500))
+    flux = np.sin(wave*20)+2
+    new_wave, matrix = utils.resample_matrix(wave, 100)
+    assert len(new_wave) < len(wave)
+    assert np.allclose(np.diff(np.log(new_wave)), 0.01)
+    assert np.allclose(matrix.dot(np.ones_like(wave)), 1)
+
+    # Each new pixel holds the integral of the old pixels it covers
+    in_edges = utils.bin_edges(wave)
+    out_edges = np.append(new_wave, new_wave[-1]*np.exp(0.01))*np.exp(-0.005)
+    total = np.concatenate([[0], np.cumsum(flux*np.diff(in_edges))])
+    expected = np.diff(np.interp(out_edges, in_edges, total)) / \
+        np.diff(out_edges)
+    inner = (out_edges[:-1] >= in_edges[0]) & (out_edges[1:] <= in_edges[-1])
+    assert np.allclose(matrix.dot(flux)[inner], expected[inner])
+
+    # Part of the spectrum is binned onto the same pixels
+    part, sub = utils.resample_matrix(wave[100:400], 100)
+    n = new_wave.searchsorted(part[0])
+    assert np.allclose(part, new_wave[n:n+len(part)])
+    inside = (out_edges[n+1:n+len(part)-1] >= wave[100]) & \
+        (out_edges[n+2:n+len(part)] <= wave[399])
+    assert inside.sum() > 30
+    assert np.allclose(sub.dot(flux[100:400])[1:-1][inside],
+                       matrix.dot(flux)[n+1:n+len(part)-1][inside])
+
+    # The same matrix is returned for the same wavelengths
+    assert utils.resample_matrix(wave.copy(), 100)[1] is matrix
+
+
+def test_resample_matrix_threads():
+    """
+    Test that threads evicting each other's matrices from the cache
+    get the same matrices as one thread
+    """
+    waves = [np.linspace(1, 2+n/10., 50) for n in range(24)]
+    expected = [utils.resample_matrix(w, 20)[1].toarray() for w in waves]
+
+    def work(n):
+        return utils.resample_matrix(waves[n % 24], 20, cache_size=4)[1]
+
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        for n, matrix in enumerate(ex.map(work, range(2000))):
+            assert np.array_equal(matrix.toarray(), expected[n % 24])
+
+
+def test_simplex_weights():
+    """
+    Test that the barycentric weights reproduce a linear function of
+    scattered points
+    """
+    rng = np.random.RandomState(3)
+    points = rng.uniform(0, 10, size=(40, 3))
+    tri = utils.triangulate(points)
+    coeffs = np.array([1.5, -2., 0.5])
+    values = points.dot(coeffs)+3.
+    for point in points[:5]*0.5+2.5:
+        verts, weights = utils.simplex_weights(tri, point)
+        assert np.all(weights >= -1E-9)
+        assert np.isclose(weights.sum(), 1)
+        assert np.isclose(weights.dot(values[verts]), point.dot(coeffs)+3.)
+
+
+def test_simplex_weights_flat_axis():
+    """
+    Test that the axes along which the points do not vary are ignored
+    """
+    points = np.array([[0., 1., 0.], [2., 1., 0.], [0., 1., 2.],
+                       [2., 1., 2.]])
+    tri = utils.triangulate(points)
+    assert list(tri['axes']) == [0, 2]
+    verts, weights = utils.simplex_weights(tri, [1., 1., 1.5])
+    assert np.allclose(weights.dot(points[verts]), [1., 1., 1.5])
+
+
+def test_simplex_weights_lattice(monkeypatch):
+    """
+    Test that every simplex of a regular grid has a finite transform and
+    that the walk finds the simplex of each point without checking them
+    all
+    """
+    points = np.array(list(product(range(8), range(6), range(5))),
+                      dtype=float)
+    tri = utils.triangulate(points)
+    assert np.all(np.isfinite(tri['transform']))
+
+    def scan(*args):
+        raise AssertionError('The walk did not find the simplex')
+
+    monkeypatch.setattr(utils, '_scan_simplices', scan)
+    rng = np.random.RandomState(4)
+    coeffs = np.array([1.5, -2., 0.5])
+    values = points.dot(coeffs)
+    queries = np.vstack([rng.uniform(0, 1, size=(500, 3))*[7, 5, 4], points,
+                         np.minimum(points+0.5, [7, 5, 4])])
+    for point in queries:
+        verts, weights = utils.simplex_weights(tri, point)
+        assert np.isclose(weights.dot(values[verts]), point.dot(coeffs),
+                          atol=1E-6)
+
+
+def test_mu_nodes():
+    """
+    Test that both spacings give n values below mu=1 and mu=1 itself
+    """
+    for kind in ['r', 'gauss']:
+        mu = utils.mu_nodes(6, kind)
+        assert len(mu) == 7
+        assert mu[-1] == 1 and np.all(np.diff(mu) > 0)
+        assert np.all((mu >= 0) & (mu <= 1))
+
+
+def test_resample_mu():
+    """
+    Test that an intensity linear in mu is reproduced from unsorted mu
+    values and held at the end values beyond them
+    """
+    mu = np.array([1., 0.7, 0.4, 0.1])
+    wave = np.linspace(1, 2, 20)
+    flux = np.outer(mu, wave)+np.outer(np.ones(4), wave**2)
+    new = np.array([0.05, 0.25, 0.5, 0.85, 1.])
+    result = utils.resample_mu(mu, flux, new)
+    assert result.shape == (5, 20)
+    inside = np.clip(new, 0.1, 1)
+    assert np.allclose(result, np.outer(inside, wave)+wave**2)
@@ -4,45 +4,520 @@
 A module for utility funtions
 """
 from astropy.io import fits
-from scipy.interpolate import RegularGridInterpolator
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
 import matplotlib.pyplot as plt
 import numpy as np
+import os
+import scipy.sparse as sp
+import threading
+from scipy.spatial import cKDTree, Delaunay
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
-def interp_flux(mu, flux, params, values):
+# The storage types which hold each spectrum divided by a scale factor
+SCALED_TYPES = (np.dtype('float16'), np.dtype('int16'))
+
+
+def grid_cell(axes, values):
+    """
+    Find the grid cell bracketing the given point and the
+    (multi)linear weights of each of its corners
+
+    Parameters
+    ----------
+    axes: list
+        A list of the sorted parameter values along each grid axis
+    values: array-like
+        The parameter values of the point to interpolate to
+
+    Returns
+    -------
+    tuple
+        The slices of the cell along each axis and the array of
+        corner weights with one dimension per axis
+    """
+    slices, weights = [], np.ones(())
+    for axis, value in zip(axes, values):
+        axis = np.asarray(axis)
+
+        # Make sure the point is within the grid
+        if value < axis[0] or value > axis[-1]:
+            raise ValueError('Value {} outside grid range {}-{}.'
+                             .format(value, axis[0], axis[-1]))
+
+        # A single valued axis has a single corner of unit weight
+        if len(axis) == 1:
+            slices.append(slice(0, 1))
+            weights = weights[..., None]
+            continue
+
+        # Get the lower bound of the cell and the fractional distance
+        idx = int(np.clip(axis.searchsorted(value, side='right')-1,
+                          0, len(axis)-2))
+        frac = (value-axis[idx])/(axis[idx+1]-axis[idx])
+        slices.append(slice(idx, idx+2))
+        weights = weights[..., None]*np.array([1.-frac, frac])
+
+    return tuple(slices), weights
+
+
+def grid_cells(axes, values):
     """
-    Interpolate a cube of synthetic spectra for a
-    given index of mu
+    Find the grid cells bracketing many points at once and the
+    (multi)linear weights of their corners
 
     Parameters
     ----------
-    mu: int
-        The index of the (Teff, logg, FeH, *mu*, wavelength)
-        data cube to interpolate
-    flux: np.ndarray
-        The 5D data array
-    params: list
-        A list of each free parameter range
+    axes: list
+        A list of the sorted parameter values along each grid axis
     values: list
-        A list of each free parameter values
+        A list of the arrays of parameter values along each axis
+
+    Returns
+    -------
+    tuple
+        The (n_points, n_axes) array of lower cell indexes, the number
+        of corners along each axis, the array of corner weights with
+        shape (n_points, corners...) and the boolean mask of the points
+        within the grid
+    """
+    values = [np.atleast_1d(np.asarray(v, dtype=float)) for v in values]
+    n = len(values[0])
+    lower = np.zeros((n, len(axes)), dtype=int)
+    weights = np.ones(n)
+    inside = np.ones(n, dtype=bool)
+    sizes = []
+    for dim, (axis, value) in enumerate(zip(axes, values)):
+        axis = np.asarray(axis, dtype=float)
+        inside &= (value >= axis[0]) & (value <= axis[-1])
+
+        # A single valued axis has a single corner of unit weight
+        if len(axis) == 1:
+            sizes.append(1)
+            weights = weights[..., None]
+            continue
+
+        # Get the lower bound of each cell and the fractional distance
+        idx = np.clip(axis.searchsorted(value, side='right')-1,
+                      0, len(axis)-2)
+        frac = (value-axis[idx])/(axis[idx+1]-axis[idx])
+        lower[:, dim] = idx
+        sizes.append(2)
+        w = np.stack([1.-frac, frac], axis=-1)
+        weights = weights[..., None]*w.reshape((n,)+(1,)*dim+(2,))
+
+    return lower, tuple(sizes), weights, inside
+
+
+def interp_cell(cube, cell, weights, scale=None):
+    """
+    Interpolate a cube to a point given the bracketing cell and
+    corner weights from `grid_cell`. All trailing dimensions,
+    e.g. (mu, wavelength), are interpolated at once, in single
+    precision if the cube is stored in reduced precision.
+
+    Parameters
+    ----------
+    cube: array-like
+        The data array with the grid axes first
+    cell: tuple
+        The slices of the cell along each grid axis
+    weights: np.ndarray
+        The corner weights with one dimension per grid axis
+    scale: array-like (optional)
+        The scale factors of an encoded cube from `encode_flux`
+
+    Returns
+    -------
+    np.ndarray
+        The interpolated array of the trailing dimensions
+    """
+    # Read only the neighboring grid points and take the weighted sum
+    slab = decode_flux(cube[cell], None if scale is None else scale[cell])
+    weights = weights.astype(np.result_type(slab.dtype, np.float32))
+
+    return np.tensordot(weights, slab, axes=weights.ndim)
+
+
+def triangulate(points):
+    """
+    Triangulate scattered grid points, ignoring the axes along which
+    they do not vary
+
+    Parameters
+    ----------
+    points: array-like
+        The (n_points, n_axes) coordinates
+
+    Returns
+    -------
+    dict
+        The varying axes, the points along them, the vertices, neighbors
+        and barycentric transform of each simplex, and a simplex
+        containing each point
+    """
+    points = np.asarray(points, dtype=float)
+    axes, = np.where(np.ptp(points, axis=0) > 0)
+    if len(axes) == 0:
+        raise ValueError('At least two distinct points are needed.')
+    pts = points[:, axes]
+
+    # Join neighboring points along a single axis...
+    if len(axes) == 1:
+        order = np.argsort(pts[:, 0])
+        simplices = np.array([order[:-1], order[1:]]).T
+        x0, x1 = pts[simplices[:, 0], 0], pts[simplices[:, 1], 0]
+        transform = np.array([1./(x0-x1), x1]).T[:, :, None]
+        n = len(simplices)
+        neighbors = np.array([np.arange(1, n+1), np.arange(-1, n-1)]).T
+        neighbors[neighbors == n] = -1
+        vertex_simplex = np.zeros(len(pts), dtype=int)
+        vertex_simplex[order] = np.minimum(np.arange(len(pts)), n-1)
+
+    # ...or make the Delaunay triangulation of the points moved by a tiny
+    # fixed amount, so that no simplex of a regular grid is flat, and
+    # keep the barycentric transforms of those same positions
+    else:
+        rng = np.random.RandomState(0)
+        moved = pts+1E-8*np.ptp(pts, axis=0)*rng.uniform(-1, 1, pts.shape)
+        tri = Delaunay(moved)
+        simplices, transform = tri.simplices, tri.transform
+        neighbors = tri.neighbors
+
+        # Start the walks from the largest simplex around each point, as
+        # the nearly flat ones magnify the distance to the moved point
+        volume = np.abs(np.linalg.det(moved[simplices[:, :-1]] -
+                                      moved[simplices[:, -1:]]))
+        verts = simplices.ravel()
+        simplex = np.repeat(np.arange(len(simplices)), simplices.shape[1])
+        order = np.lexsort((volume[simplex], verts))
+        verts, simplex = verts[order], simplex[order]
+        last = np.append(verts[1:] != verts[:-1], True)
+        vertex_simplex = np.zeros(len(pts), dtype=int)
+        vertex_simplex[verts[last]] = simplex[last]
+
+    return {'axes': axes, 'points': pts, 'simplices': simplices,
+            'neighbors': neighbors, 'transform': transform,
+            'vertex_simplex': vertex_simplex}
+
+
+def simplex_weights(tri, point, tree=None, tol=1E-6):
+    """
+    Find the simplex of a triangulation from `triangulate` which contains
+    the given point by walking from a simplex of the nearest point, and
+    the barycentric weights of its vertices
+
+    Parameters
+    ----------
+    tri: dict
+        The triangulation
+    point: array-like
+        The coordinates along all axes
+    tree: scipy.spatial.cKDTree (optional)
+        The tree of the triangulated points
+    tol: float
+        The tolerance for a point on the edge of a simplex, which is
+        larger than the offsets of the triangulated positions
 
     Returns
     -------
-    tu
-        The array of new flux values
+    tuple
+        The indexes of the vertices and their weights
     """
-    # Iterate over each wavelength (-1 index of flux array)
-    shp = flux.shape[-1]
-    flx = np.zeros(shp)
-    generators = []
-    for lam in range(shp):
-        interp_f = RegularGridInterpolator(params, flux[:, :, :, mu, lam])
-        f, = interp_f(values)
+    x = np.asarray(point, dtype=float)[tri['axes']]
+    T = tri['transform']
+    ndim = len(x)
+
+    def bary(s):
+        c = T[s, :ndim].dot(x-T[s, ndim])
+        return np.append(c, 1-c.sum())
 
-        flx[lam] = f
-        generators.append(interp_f)
+    # Start from the nearest point
+    tree = tree or cKDTree(tri['points'])
+    s = tri['vertex_simplex'][tree.query(x)[1]]
 
-    return flx, generators
+    # Step toward the point until a simplex contains it
+    found = False
+    for n in range(len(T)):
+        b = bary(s)
+        k = np.argmin(b)
+        if b[k] >= -tol:
+            found = True
+            break
+        s = tri['neighbors'][s, k]
+        if s < 0:
+            break
+
+    # Check every simplex if the walk left the hull
+    if not found:
+        s, b = _scan_simplices(T, x, tol)
+
+    b = np.clip(b, 0, None)
+
+    return tri['simplices'][s], b/b.sum()
+
+
+def _scan_simplices(T, x, tol):
+    """
+    Find a simplex which contains the point by checking all of them
+
+    Parameters
+    ----------
+    T: np.ndarray
+        The barycentric transform of each simplex
+    x: np.ndarray
+        The coordinates along the triangulated axes
+    tol: float
+        The tolerance for a point on the edge of a simplex
+
+    Returns
+    -------
+    tuple
+        The index of the simplex and the barycentric weights
+    """
+    ndim = len(x)
+    c = np.einsum('ijk,ik->ij', T[:, :ndim], x-T[:, ndim])
+    b = np.hstack([c, 1-c.sum(axis=1, keepdims=True)])
+    inside, = np.where(b.min(axis=1) >= -tol)
+    if len(inside) == 0:
+        raise ValueError('Point is outside the triangulated grid.')
+
+    return inside[0], b[inside[0]]
+
+
+def encode_flux(flux, dtype=float):
+    """
+    Convert the flux to the given storage type. The float16 and int16
+    types hold each spectrum divided by its scale factor so that the
+    values fit in their range.
+
+    Parameters
+    ----------
+    flux: array-like
+        The flux array with wavelength as the last axis
+    dtype: str, type
+        The storage type, i.e. 'float64', 'float32', 'float16' or 'int16'
+
+    Returns
+    -------
+    tuple
+        The stored flux array and the single precision scale factor of
+        each spectrum, or None for the unscaled types
+    """
+    dtype = np.dtype(dtype)
+    flux = np.asarray(flux)
+    if dtype not in SCALED_TYPES:
+        return flux.astype(dtype), None
+
+    # Scale each spectrum by its peak, or to full range for integers
+    scale = np.abs(flux).max(axis=-1).astype(np.float32)
+    scale[~(scale > 0)] = 1
+    if dtype.kind == 'i':
+        scale /= np.iinfo(dtype).max
+    flux = np.nan_to_num(flux/scale[..., None])
+    if dtype.kind == 'i':
+        flux = np.round(flux)
+
+    return flux.astype(dtype), scale
+
+
+def decode_flux(flux, scale=None):
+    """
+    Convert the flux from its storage type
+
+    Parameters
+    ----------
+    flux: array-like
+        The stored flux array
+    scale: array-like (optional)
+        The scale factor of each spectrum from `encode_flux`
+
+    Returns
+    -------
+    np.ndarray
+        The flux array, in single precision if it was scaled
+    """
+    if scale is None:
+        return np.asarray(flux)
+
+    return np.asarray(flux, dtype=np.float32) * \
+        np.asarray(scale, dtype=np.float32)[..., None]
+
+
+def wave_blocks(n_wave, bytes_per_wave, max_memory=None):
+    """
+    Split the wavelength axis into contiguous blocks which each
+    need at most the given memory
+
+    Parameters
+    ----------
+    n_wave: int
+        The number of wavelengths
+    bytes_per_wave: int
+        The memory needed for each wavelength
+    max_memory: int (optional)
+        The memory limit in bytes, or None for one block
+
+    Returns
+    -------
+    list
+        The slices of the wavelength axis
+    """
+    step = max(n_wave, 1)
+    if max_memory:
+        step = int(max(1, min(step, max_memory//max(bytes_per_wave, 1))))
+
+    return [slice(i, min(i+step, n_wave))
+            for i in range(0, max(n_wave, 1), step)]
+
+
+def flux_chunks(shape, chunk_bytes=2**20, itemsize=8):
+    """
+    Choose the HDF5 chunk shape of a (Teff, logg, FeH, mu, wavelength)
+    flux cube so that each chunk holds one model and a contiguous block
+    of wavelengths for all mu values
+
+    Parameters
+    ----------
+    shape: tuple
+        The shape of the flux cube
+    chunk_bytes: int
+        The target size of each chunk in bytes
+    itemsize: int
+        The number of bytes per value
+
+    Returns
+    -------
+    tuple
+        The chunk shape
+    """
+    n_mu, n_wave = shape[-2:]
+    n_wave = int(min(n_wave, max(1, chunk_bytes//(itemsize*max(n_mu, 1)))))
+
+    return (1,)*(len(shape)-2)+(max(n_mu, 1), max(n_wave, 1))
+
+
+def wave_chunks(shape, chunk_bytes=2**20, itemsize=8):
+    """
+    Choose the HDF5 chunk shape of a wavelength-major (wavelength, Teff,
+    logg, FeH, mu) flux cube so that each chunk holds a contiguous block
+    of wavelengths for every model and mu value
+
+    Parameters
+    ----------
+    shape: tuple
+        The shape of the wavelength-major flux cube
+    chunk_bytes: int
+        The target size of each chunk in bytes
+    itemsize: int
+        The number of bytes per value
+
+    Returns
+    -------
+    tuple
+        The chunk shape
+    """
+    per_wave = itemsize*max(int(np.prod(shape[1:])), 1)
+    n_wave = int(min(shape[0], max(1, chunk_bytes//per_wave)))
+
+    return (max(n_wave, 1),)+tuple(max(n, 1) for n in shape[1:])
+
+
+def chunk_bytes(shape, chunks, index, itemsize=8):
+    """
+    Count the bytes of the HDF5 chunks which must be read to get
+    a hyperslab of a dataset
+
+    Parameters
+    ----------
+    shape: tuple
+        The shape of the dataset
+    chunks: tuple, None
+        The chunk shape, or None for a contiguous dataset
+    index: tuple
+        The slice or integer index into each dimension
+
+    Returns
+    -------
+    int
+        The number of bytes read
+    """
+    chunks = chunks or (1,)*(len(shape)-1)+(shape[-1],)
+    n_bytes = itemsize
+    for n, c, k in zip(shape, chunks, index):
+        i, j = (k.start, k.stop) if isinstance(k, slice) else (k, k+1)
+        n_bytes *= ((j-1)//c-i//c+1)*c if j > i else 0
+
+    return n_bytes
+
+
+@contextmanager
+def file_lock(filename, remove=False):
+    """
+    Hold an exclusive lock on the given file, blocking until it is free,
+    so that processes sharing a cache directory do not clobber each
+    other's writes
+
+    Parameters
+    ----------
+    filename: str
+        The path to the lock file, which is created if necessary
+    remove: bool
+        Remove the lock file on release, which a process waiting for
+        the lock notices and locks a new file instead
+    """
+    while True:
+        f = open(filename, 'a')
+        _lock(f)
+
+        # Try again if the file was removed while waiting for it
+        try:
+            current = os.stat(filename).st_ino == os.fstat(f.fileno()).st_ino
+        except OSError:
+            current = False
+        if current:
+            break
+        _unlock(f)
+        f.close()
+
+    try:
+        yield
+    finally:
+        if remove:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        _unlock(f)
+        f.close()
+
+
+def _lock(f):
+    """
+    Block until the exclusive lock on an open file is acquired
+    """
+    if fcntl:
+        fcntl.flock(f, fcntl.LOCK_EX)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+
+def _unlock(f):
+    """
+    Release the lock on an open file
+    """
+    if fcntl:
+        fcntl.flock(f, fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
 
 
 def calc_zoom(R_f, arr):
@@ -69,6 +544,178 @@ def calc_zoom(R_f, arr):
     return z
 
 
+# Recently used resampling matrices, shared by all threads
+_resample_cache = OrderedDict()
+_resample_lock = threading.Lock()
+
+
+def bin_edges(wave):
+    """
+    Get the edges of the pixels centered on the given wavelengths
+
+    Parameters
+    ----------
+    wave: array-like
+        The sorted wavelength array
+
+    Returns
+    -------
+    np.ndarray
+        The len(wave)+1 pixel edges
+    """
+    wave = np.asarray(wave, dtype=float)
+    mid = (wave[1:]+wave[:-1])/2.
+
+    return np.concatenate([[wave[0]-(mid[0]-wave[0])], mid,
+                           [wave[-1]+(wave[-1]-mid[-1])]])
+
+
+def resample_matrix(wave, resolution, cache_size=16):
+    """
+    Make the sparse matrix which bins a spectrum onto a wavelength array
+    evenly spaced in log wavelength at the given resolution while
+    conserving flux. The pixels are centered on exp(k/resolution) for
+    integer k, so resampling part of a spectrum gives the same pixels as
+    resampling all of it. Each weight is the fraction of an output pixel
+    covered by an input pixel. The matrices are cached for each input
+    wavelength array and resolution.
+
+    Parameters
+    ----------
+    wave: array-like
+        The input wavelength array
+    resolution: int
+        The desired wavelength resolution (lambda/d_lambda)
+    cache_size: int
+        The number of matrices to keep
+
+    Returns
+    -------
+    tuple
+        The new wavelength array and the (new, old) sparse matrix
+    """
+    wave = np.ascontiguousarray(wave, dtype=float)
+    key = (hashlib.sha1(wave.tobytes()).hexdigest(), float(resolution))
+    with _resample_lock:
+        if key in _resample_cache:
+            _resample_cache.move_to_end(key)
+            return _resample_cache[key]
+
+    # Make the new wavelength array of the pixels centered within
+    # the input wavelength range
+    R = float(resolution)
+    k = np.arange(np.ceil(np.log(wave[0])*R), np.floor(np.log(wave[-1])*R)+1)
+    new_wave = np.exp(k/R)
+    n_new = len(new_wave)
+
+    # Split the wavelength axis at every input and output pixel edge
+    in_edges = bin_edges(wave)
+    out_edges = np.exp((np.append(k, k[-1]+1 if n_new else 0)-0.5)/R)
+    edges = np.union1d(in_edges, out_edges)
+    mid = (edges[1:]+edges[:-1])/2.
+    i = in_edges.searchsorted(mid)-1
+    j = out_edges.searchsorted(mid)-1
+    ok = (i >= 0) & (i < len(wave)) & (j >= 0) & (j < n_new)
+
+    # Weight each overlap by the covered part of the output pixel
+    overlap = np.diff(edges)[ok]
+    covered = np.bincount(j[ok], weights=overlap, minlength=n_new)
+    weights = overlap/covered[j[ok]]
+    matrix = sp.csr_matrix((weights, (j[ok], i[ok])),
+                           shape=(n_new, len(wave)))
+
+    with _resample_lock:
+        _resample_cache[key] = new_wave, matrix
+        while len(_resample_cache) > cache_size:
+            _resample_cache.popitem(last=False)
+
+    return new_wave, matrix
+
+
+def resample(wave, flux, resolution):
+    """
+    Bin the flux onto a wavelength array evenly spaced in log wavelength
+    at the given resolution, conserving flux, for every row at once
+
+    Parameters
+    ----------
+    wave: array-like
+        The input wavelength array
+    flux: array-like
+        The flux array with wavelength as the last axis, e.g. (mu, wave)
+    resolution: int
+        The desired wavelength resolution (lambda/d_lambda)
+
+    Returns
+    -------
+    tuple
+        The new wavelength and flux arrays
+    """
+    new_wave, matrix = resample_matrix(wave, resolution)
+    flux = np.asarray(flux, dtype=float)
+
+    return new_wave, matrix.dot(flux.T).T
+
+
+def mu_nodes(n, kind='r'):
+    """
+    Make a grid of mu values for resampling the intensity cube,
+    always including mu=1 where the limb darkening is normalized
+
+    Parameters
+    ----------
+    n: int
+        The number of mu values, not counting mu=1
+    kind: str
+        The spacing, 'r' for uniform in the radius r=sqrt(1-mu**2)
+        out to the limb or 'gauss' for the Gauss-Legendre nodes on [0, 1]
+
+    Returns
+    -------
+    np.ndarray
+        The n+1 increasing mu values
+    """
+    if kind == 'r':
+        mu = np.sqrt(1.-np.linspace(0, 1, n+1)[1:]**2)
+    elif kind == 'gauss':
+        mu = (np.polynomial.legendre.leggauss(n)[0]+1.)/2.
+    else:
+        raise ValueError("kind must be 'r' or 'gauss', not {}".format(kind))
+
+    return np.union1d(mu, [1.])
+
+
+def resample_mu(mu, flux, mu_grid):
+    """
+    Linearly interpolate the intensity onto a new grid of mu values,
+    holding the end values beyond the range of the model
+
+    Parameters
+    ----------
+    mu: array-like
+        The mu values of the model
+    flux: array-like
+        The (mu, wavelength) intensity array
+    mu_grid: array-like
+        The new mu values
+
+    Returns
+    -------
+    np.ndarray
+        The (mu_grid, wavelength) intensity array
+    """
+    mu = np.asarray(mu, dtype=float).ravel()
+    order = np.argsort(mu)
+    mu, flux = mu[order], np.asarray(flux)[order]
+
+    # Get the bracketing mu values and their weights
+    new = np.clip(mu_grid, mu[0], mu[-1])
+    j = np.clip(mu.searchsorted(new), 1, len(mu)-1)
+    w = ((new-mu[j-1])/(mu[j]-mu[j-1]))[:, None]
+
+    return flux[j-1]*(1.-w)+flux[j]*w
+
+
 def rebin_spec(spec, wavnew, oversamp=100, plot=False):
     """
     Rebin a spectrum to a new wavelength array while preserving